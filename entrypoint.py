@@ -27,7 +27,7 @@ def init_ee():
 
 
 if __name__ == "__main__":
-    required_folders = ['input_photos', 'result_photos', 'osm']
+    required_folders = ['input_photos', 'result_photos']
     for folder in required_folders:
         if not os.path.exists(folder):
             os.makedirs(folder)
@@ -0,0 +1,56 @@
+from threading import Thread, Condition
+from typing import Callable
+import traceback
+import itertools
+import heapq
+import time
+
+
+class DelayedExecutor:
+    """
+    Runs tasks after a delay, e.g. retries of failed sends. Pending tasks wait in a heap watched by a single thread,
+    so waiting takes no thread per task. Tasks run on that thread and should be short,
+    like submitting the real work to a pool
+    """
+
+    def __init__(self):
+        self.tasks = []  # heap of (due time, order of submit, task)
+        self.order = itertools.count()
+        self.condition = Condition()
+        self.stopped = False
+        self.thread = None
+
+    def start(self) -> None:
+        self.thread = Thread(target=self.__observe_tasks, name="delayed_executor", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        """Stop the thread, pending tasks are dropped"""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def submit(self, delay: float, task: Callable[[], None]) -> None:
+        """Run task() after delay in seconds"""
+        with self.condition:
+            heapq.heappush(self.tasks, (time.monotonic() + delay, next(self.order), task))
+            # New task could be due earlier than the one the thread waits for
+            self.condition.notify()
+
+    def __len__(self) -> int:
+        """Number of pending tasks"""
+        with self.condition:
+            return len(self.tasks)
+
+    def __observe_tasks(self) -> None:
+        while True:
+            with self.condition:
+                while not self.stopped and (not self.tasks or self.tasks[0][0] > time.monotonic()):
+                    self.condition.wait(self.tasks[0][0] - time.monotonic() if self.tasks else None)
+                if self.stopped:
+                    return
+                _, _, task = heapq.heappop(self.tasks)
+            try:
+                task()
+            except Exception:
+                print(f"Delayed task failed:\n{traceback.format_exc()}")
@@ -0,0 +1,97 @@
+from collections import OrderedDict, deque
+from threading import Thread, Condition
+import traceback
+import time
+
+
+class DownloadExecutor:
+    """
+    Runs satellite downloads on a bounded number of threads.
+    Chats are served round-robin, so a chat with many requests does not delay the others
+    """
+    max_stored_service_times = 100
+
+    def __init__(self, max_workers: int):
+        """
+        :param max_workers: max number of downloads running at the same time
+        """
+        self.max_workers = max_workers
+        self.chat_queues = OrderedDict()  # chat_id -> deque of pending jobs, next chat to serve first
+        self.n_pending = 0
+        self.n_running = 0
+        self.condition = Condition()
+        self.stopped = False
+        self.workers = []
+        self.service_times = deque(maxlen=DownloadExecutor.max_stored_service_times)  # in seconds
+
+    def start(self) -> None:
+        for i in range(self.max_workers):
+            worker = Thread(target=self.__observe_jobs, name=f"download_worker_{i}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self) -> None:
+        """Stop the workers after the running downloads, pending ones are dropped"""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    def submit(self, chat_id, func, /, **kwargs) -> int:
+        """
+        Schedule func(**kwargs)
+        :return: number of downloads which will be started before this one
+        """
+        with self.condition:
+            chat_queue = self.chat_queues.setdefault(chat_id, deque())
+            # Every other chat gets one turn per each pending job of this chat and one more before the new job
+            position = len(chat_queue) + sum(min(len(queue), len(chat_queue) + 1)
+                                             for other_chat_id, queue in self.chat_queues.items()
+                                             if other_chat_id != chat_id)
+            chat_queue.append((func, kwargs))
+            self.n_pending += 1
+            self.condition.notify()
+        return position
+
+    def __len__(self) -> int:
+        """Number of pending and running downloads"""
+        with self.condition:
+            return self.n_pending + self.n_running
+
+    def estimate_wait_time(self) -> float:
+        """Time until a new download starts, from durations of recent downloads, in seconds"""
+        with self.condition:
+            if not self.service_times:
+                return 0.0
+            average = sum(self.service_times) / len(self.service_times)
+            return average * (self.n_pending + self.n_running) / self.max_workers
+
+    def __next_job(self):
+        """Take the first job of the next chat, the chat goes to the end of the round. Caller holds the lock"""
+        chat_id, chat_queue = next(iter(self.chat_queues.items()))
+        job = chat_queue.popleft()
+        if chat_queue:
+            self.chat_queues.move_to_end(chat_id)
+        else:
+            del self.chat_queues[chat_id]
+        self.n_pending -= 1
+        return job
+
+    def __observe_jobs(self) -> None:
+        while True:
+            with self.condition:
+                while not self.chat_queues and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                func, kwargs = self.__next_job()
+                self.n_running += 1
+
+            start_time = time.monotonic()
+            try:
+                func(**kwargs)
+            except Exception:
+                print(f"Download failed:\n{traceback.format_exc()}")
+            finally:
+                with self.condition:
+                    self.n_running -= 1
+                    self.service_times.append(time.monotonic() - start_time)
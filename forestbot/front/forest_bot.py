@@ -1,16 +1,30 @@
-import urllib.request
 from forestbot.ml_backend.controller import Controller, Artifact
-from forestbot.front.image_analyzer.size_analyzer import is_correct_size
-from forestbot.satellite.satellite_data import download_rect
+from forestbot.ml_backend.prediction_cache import PredictionCache
+from forestbot.ml_backend.job_queue import JobQueue
+from forestbot.front.image_analyzer.size_analyzer import fetch_image, get_max_file_size
+from forestbot.satellite.satellite_data import download_rect, get_pixel_size_m
+from forestbot.satellite.tile_cache import TileCache
+from forestbot.front.download_executor import DownloadExecutor
+from forestbot.front.delayed_executor import DelayedExecutor
+from forestbot.front.image_store import ImageStore
+from forestbot.front.mask_store import MaskStore
+from forestbot.front.settings_store import SettingsStore
+from forestbot.ml_backend.utils import encode_image
 from forestbot.satellite.osm_convert import generate_osm
 from forestbot.front.utils import *
-from threading import Thread, Lock
+from threading import Thread, Lock, BoundedSemaphore
+from concurrent.futures import Executor, ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 import telebot
 import numpy as np
 import configparser
-import xml.etree.ElementTree as ET
+import traceback
+import queue
+import math
 import os
+import cv2
+from typing import Union, List
 
 
 class ForestBot:
@@ -21,6 +35,45 @@ class ForestBot:
     model_input_size = 224
     use_crop = True
     crop_size = 224
+    crop_overlap = 0.25  # Part of the crop shared with its neighbours. Higher is more accurate, but slower
+    crop_blend = "gaussian"  # How overlapping crops are blended: "gaussian" or "linear"
+    inference_batch_size = 8  # Number of crops passed to the model at once
+    inference_workers = 4  # Number of images processed at the same time
+    inference_threads = None  # Cores used by the model for all workers together. None means ONNX Runtime default
+    use_batching = True  # Run crops of images from different users in shared batches
+    max_batch_size = 16  # Max number of crops in a shared batch
+    max_batch_delay = 0.005  # Max time to wait for crops of other images, in seconds
+    result_format = ".jpg"  # Telegram recompresses photos to JPEG anyway, so PNG only makes upload longer
+    keep_files_on_disk = False  # Save received photos and results into input_photos and result_photos for debugging
+    use_prediction_cache = True  # Repeated images and threshold changes skip the model
+    prediction_cache_memory_mb = 256
+    prediction_cache_disk_mb = 2048  # Predictions evicted from memory are kept on disk in prediction_cache_dir
+    prediction_cache_dir = Path("prediction_cache")
+    download_workers = 4  # Max number of satellite downloads running at the same time
+    cell_download_workers = 8  # Grid cells of the satellite cache downloaded at the same time by all downloads
+    satellite_images_memory_mb = 512  # Downloaded satellite images waiting for the user to start analysis
+    masks_memory_mb = 64  # Bit-packed masks waiting for export to OSM
+    masks_disk_mb = 1024  # Masks evicted from memory are kept on disk in masks_dir
+    masks_dir = Path("masks")
+    max_satellite_transforms = 10000  # Coordinate transforms of satellite images, they are small
+    settings_path = Path("settings.db")  # Thresholds and radiuses of the users
+    persist_jobs = True  # Keep queued images on disk, so they are processed after restart
+    job_queue_path = Path("jobs.db")
+    max_running_per_chat = 2  # Images of a chat processed at the same time, the other chats are not delayed
+    max_queued_per_chat = 10  # Images of a chat waiting for processing, the rest are refused
+    job_visibility_timeout = 15 * 60  # Job not finished in this time is given to another worker, in seconds
+    job_max_attempts = 3
+    max_queued_images = 100  # New requests are refused when so many images are queued
+    max_queued_downloads = 50  # New coordinates are refused when so many downloads are queued
+    max_wait_minutes = 30  # New requests are refused when the estimated wait is longer
+    send_workers = 16  # Threads sending messages and results
+    osm_workers = 2  # OSM documents generated at the same time, generation takes the CPU for seconds
+    max_animations = 20  # Loading animations running at the same time, each takes a thread
+    auto_analyse_satellite = False  # Start analysis of satellite images before the user confirms it
+    compress_osm = False  # Send roads as .osm.gz, several times smaller. Not every editor opens it
+    satellite_cache_dir = Path("satellite_cache")  # Downloaded satellite rasters, reused by nearby requests
+    satellite_cache_mb = 4096
+    satellite_cache_max_age_days = 90
     default_radius_deg = convert_km_to_deg(2.0)
     max_radius_km = 7.0
     min_radius_km = 1.0
@@ -28,6 +81,9 @@ class ForestBot:
     out_date_time = 60 * 10  # in seconds
     min_photo_size = 200
     max_photo_size = 2000
+    max_document_size = 12000  # Larger documents are processed from disk by bands, result is sent as a file
+    max_document_bytes = get_max_file_size(max_document_size)  # Limit for documents whose size is not parsed
+    large_image_memory_mb = 256  # Memory for a band of a large document
     valid_formats = ['png', 'jpeg', 'jpg', 'bmp']
     min_download_size_to_notify = 5
 
@@ -36,30 +92,89 @@ class ForestBot:
         config.read(Path("credentials.ini"))
 
         token = config['BOT']['bot_token']
-        # TODO: save + load from save. make static?
-        self.user_radiuses_deg = dict()
-        self.user_thresholds = dict()
+        self.settings = SettingsStore(ForestBot.settings_path)
+        self.user_radiuses_deg = self.settings.get_setting("radius_deg")
+        self.user_thresholds = self.settings.get_setting("threshold")
         self.bot = telebot.TeleBot(token)
         self.__init_messages()
         self.__add_handlers()
         self.controller = Controller(
             callback=self.__send_prediction_callback,
+            failure_callback=self.__handle_failed_prediction,
             model_input_size=ForestBot.model_input_size,
             use_crop=ForestBot.use_crop,
-            crop_size=ForestBot.crop_size if ForestBot.use_crop else None
+            crop_size=ForestBot.crop_size if ForestBot.use_crop else None,
+            batch_size=ForestBot.inference_batch_size,
+            overlap=ForestBot.crop_overlap,
+            blend=ForestBot.crop_blend,
+            n_workers=ForestBot.inference_workers,
+            n_threads=ForestBot.inference_threads,
+            use_batching=ForestBot.use_batching,
+            max_batch_size=ForestBot.max_batch_size,
+            max_batch_delay=ForestBot.max_batch_delay,
+            result_format=ForestBot.result_format,
+            save_results=ForestBot.keep_files_on_disk,
+            large_image_memory_mb=ForestBot.large_image_memory_mb,
+            job_queue=JobQueue(
+                path=ForestBot.job_queue_path if ForestBot.persist_jobs else ":memory:",
+                visibility_timeout=ForestBot.job_visibility_timeout,
+                max_attempts=ForestBot.job_max_attempts,
+                max_running_per_chat=ForestBot.max_running_per_chat,
+                max_queued_per_chat=ForestBot.max_queued_per_chat
+            ),
+            prediction_cache=PredictionCache(
+                max_memory_bytes=ForestBot.prediction_cache_memory_mb * 1024 ** 2,
+                cache_dir=ForestBot.prediction_cache_dir,
+                max_disk_bytes=ForestBot.prediction_cache_disk_mb * 1024 ** 2
+            ) if ForestBot.use_prediction_cache else None
         )
-        self.download_satellite_lock = Lock()
-        self.download_satellite_queue_size = 0
-
-        self.img_to_mask = dict()
-        self.img_to_func = dict()
-
-        Thread(target=self.controller.observe_updates).start()
+        self.satellite_cache = TileCache(
+            cache_dir=ForestBot.satellite_cache_dir,
+            max_bytes=ForestBot.satellite_cache_mb * 1024 ** 2,
+            max_age_seconds=ForestBot.satellite_cache_max_age_days * 24 * 60 * 60
+        )
+        self.download_executor = DownloadExecutor(max_workers=ForestBot.download_workers)
+        self.cell_executor = ThreadPoolExecutor(max_workers=ForestBot.cell_download_workers,
+                                                thread_name_prefix="cell_download")
+        self.send_executor = ThreadPoolExecutor(max_workers=ForestBot.send_workers, thread_name_prefix="sender")
+        self.osm_executor = ThreadPoolExecutor(max_workers=ForestBot.osm_workers, thread_name_prefix="osm")
+        self.retry_executor = DelayedExecutor()  # Retries of failed sends wait here, not in sending threads
+        self.animation_slots = BoundedSemaphore(ForestBot.max_animations)
+
+        # Buttons of the messages expire after out_date_time, so the data for them expires too
+        self.img_to_mask = MaskStore(
+            max_memory_bytes=ForestBot.masks_memory_mb * 1024 ** 2,
+            max_age_seconds=ForestBot.out_date_time,
+            spill_dir=ForestBot.masks_dir,
+            max_disk_bytes=ForestBot.masks_disk_mb * 1024 ** 2
+        )
+        # Transform lives through the choice of processing and the analysis. It is renewed when the user confirms
+        # the analysis, so it outlives the longest accepted wait, and then with the mask for the export button
+        self.img_to_func = ImageStore(max_bytes=0, max_items=ForestBot.max_satellite_transforms,
+                                      max_age_seconds=ForestBot.out_date_time + ForestBot.max_wait_minutes * 60)
+        self.satellite_images = ImageStore(max_bytes=ForestBot.satellite_images_memory_mb * 1024 ** 2)
+        self.speculative_lock = Lock()
+        self.speculative_running = dict()  # image_name -> [threshold, user decision: None, 'y' or 'n']
+        self.speculative_results = ImageStore(max_bytes=ForestBot.satellite_images_memory_mb * 1024 ** 2)
+
+        self.settings.start()
+        self.controller.start()
+        self.download_executor.start()
+        self.retry_executor.start()
         print("Bot is running")
 
     def start(self) -> None:
         """Start the bot. Thread will be captured"""
-        self.bot.polling(none_stop=True)
+        try:
+            self.bot.polling(none_stop=True)
+        finally:
+            self.controller.stop()
+            self.download_executor.stop()
+            self.retry_executor.stop()
+            self.cell_executor.shutdown(wait=False)
+            self.osm_executor.shutdown(wait=False)
+            self.send_executor.shutdown(wait=False)
+            self.settings.stop()
 
     def __add_handlers(self) -> None:
         """Method for initialize message handlers from Telegram bot"""
@@ -108,6 +223,10 @@ class ForestBot:
             # TODO: add processing of several photos in one message
             # TODO: move validation to another method
             if message.content_type == 'photo':
+                # Telegram provides photo size, so there is no need to probe the file
+                if not ForestBot.is_image_size_correct(message.photo):
+                    self.send_text_message(message.chat.id, self.wrong_size_message)
+                    return
                 file_id = message.photo[-1].file_id
                 file_format = "png"
 
@@ -118,21 +237,54 @@ class ForestBot:
                     self.send_text_message(message.chat.id, self.wrong_file_format_message)
                     return
 
+            chat_id = message.chat.id
+            # Refused before downloading, the limit of the chat is checked again when the image is queued
+            busy_minutes = self.__get_busy_minutes()
+            if busy_minutes is not None:
+                self.__send_busy_message(chat_id, busy_minutes)
+                return
+            if self.controller.request_queue.get_n_queued(chat_id) >= ForestBot.max_queued_per_chat:
+                self.send_text_message(chat_id, self.too_many_images_message)
+                return
+
             file_info = self.bot.get_file(file_id)
-            file_url = f'https://api.telegram.org/file/bot{self.bot.token}/{file_info.file_path}'
 
-            if not is_correct_size(url=file_url, max_size=ForestBot.max_photo_size, min_size=ForestBot.min_photo_size):
-                self.send_text_message(message.chat.id, self.wrong_size_message)
-                return
+            if message.content_type == 'photo':
+                image = self.bot.download_file(file_info.file_path)
+                size = message.photo[-1].width, message.photo[-1].height
+            else:
+                # Size of the document is parsed while it is downloaded
+                file_url = f'https://api.telegram.org/file/bot{self.bot.token}/{file_info.file_path}'
+                success, image, size = fetch_image(url=file_url, max_size=ForestBot.max_document_size,
+                                                   min_size=ForestBot.min_photo_size,
+                                                   max_size_bytes=ForestBot.max_document_bytes)
+                if not success:
+                    # Also documents which are not images, their size is unknown
+                    self.send_text_message(message.chat.id, self.wrong_size_message)
+                    return
 
-            self.send_text_message(message.chat.id, self.accept_photo_message)
             image_name = generate_image_name(chat_id=message.chat.id, file_format=file_format)
-            urllib.request.urlretrieve(file_url, f"input_photos/{image_name}")
-            chat_id = message.chat.id
-
-            # A pair of image and id is added to the processing queue
-            self.controller.request_queue.put(
-                Artifact(chat_id, image_name, self.user_thresholds.get(chat_id, self.default_threshold)))
+            is_large = max(size) > ForestBot.max_photo_size
+            if ForestBot.keep_files_on_disk or is_large:
+                with open(f"input_photos/{image_name}", 'wb') as f:
+                    f.write(image)
+            if is_large:
+                # Decoded image could take gigabytes, so it is read from disk by bands
+                image = Path("input_photos") / image_name
+
+            # Image is kept in memory and added to the processing queue together with chat id.
+            # Its size is the cost for the scheduler, small images of other chats are not stuck behind large ones
+            try:
+                position = self.controller.request_queue.put(Artifact(
+                    chat_id, image_name, self.user_thresholds.get(chat_id, self.default_threshold), image=image,
+                    n_pixels=size[0] * size[1]))
+            except queue.Full:
+                if is_large and not ForestBot.keep_files_on_disk:
+                    os.remove(image)
+                self.send_text_message(chat_id, self.too_many_images_message)
+                return
+            self.send_text_message(chat_id, self.accept_photo_message + (
+                f"\nСнимков в очереди перед вашим: {position}" if position else ""))
 
         @self.bot.message_handler(content_types=['text'])
         def handle_text_cords_message(message) -> None:
@@ -153,20 +305,22 @@ class ForestBot:
             msg_id = call.message.message_id
             date = call.message.date
 
-            if time.time() - date > ForestBot.out_date_time:
+            img_name = call.data.split()[1]
+            mask = self.img_to_mask.get(img_name)
+            func = self.img_to_func.get(img_name)
+
+            if time.time() - date > ForestBot.out_date_time or mask is None or func is None:
                 self.bot.answer_callback_query(call.id, 'Сообщение устарело ⌛')
                 self.send_text_message(chat_id, 'Похоже, прошло слишком много времени 😱\n'
                                                 'Отправьте ваши координаты снова, а мы их обработаем 🚀')
-
-            img_name = call.data.split()[1]
-            mask = self.img_to_mask[img_name]
-            func = self.img_to_func[img_name]
+                return
 
             self.bot.answer_callback_query(call.id, 'Принято 👍')
             self.bot.edit_message_reply_markup(chat_id=chat_id, message_id=msg_id, reply_markup=None)
             self.send_text_message(chat_id, "Экспортируем результат в формат OSM...")
 
-            Thread(target=__send_osm, args=[chat_id, mask, func]).start()
+            # Sending threads are kept for I/O, the document is sent from there when it is generated
+            self.__run_in_background(__send_osm, executor=self.osm_executor, chat_id=chat_id, mask=mask, func=func)
 
         def __send_osm(chat_id, mask, func) -> None:
             """
@@ -176,23 +330,14 @@ class ForestBot:
             :param func: function for converting coordinates
             """
 
-            def send_document(chat_id, document):
-                Thread(target=send_document_with_retry, kwargs={
-                    'bot': self.bot,
-                    'chat_id': chat_id,
-                    'document': document,
-                    'max_attempts': ForestBot.max_attempts
-                }).start()
-
-            file_name = f"{round(time.time() * 100000)}.osm"
-            file_path = Path(f'osm/{file_name}')
-            result = generate_osm(mask, func)
-
-            with open(file_path, 'w') as f:
-                ET.ElementTree(result).write(f, encoding='unicode', xml_declaration=True)
-
-            f = open(file_path, 'rb')
-            send_document(chat_id=chat_id, document=f)
+            # Document is generated and sent from memory
+            extension = ".osm.gz" if ForestBot.compress_osm else ".osm"
+            # Mask is in EPSG:3857, where the ground size of a pixel depends on the latitude
+            pixel_size_m = get_pixel_size_m(func, mask.shape[1] / 2, mask.shape[0] / 2)
+            document = generate_osm(mask, func, pixel_size_m=pixel_size_m, compress=ForestBot.compress_osm)
+            self.__run_in_background(send_document_with_retry, bot=self.bot, chat_id=chat_id, document=document,
+                                     max_attempts=ForestBot.max_attempts, schedule=self.__run_later,
+                                     visible_file_name=f"{round(time.time() * 100000)}{extension}")
 
         @self.bot.callback_query_handler(func=is_processing_call)
         def callback_for_processing_choice(call):
@@ -208,15 +353,16 @@ class ForestBot:
                     self.bot.answer_callback_query(call.id, 'Сообщение устарело ⌛')
                     self.send_text_message(chat_id, 'Похоже, прошло слишком много времени 😱\n'
                                                     'Отправьте ваши координаты снова, а мы их обработаем 🚀')
+                    self.__cancel_analysis(image_name)
                 else:
                     self.bot.answer_callback_query(call.id, 'Принято 👍')
                     self.send_text_message(chat_id, 'Начинаем поиск 🔍')
-                    self.controller.request_queue.put(
-                        Artifact(chat_id, image_name, self.user_thresholds.get(chat_id, self.default_threshold)))
+                    self.__start_analysis(chat_id, image_name)
             else:
                 self.bot.answer_callback_query(call.id, 'Отмена 🚫')
                 self.send_text_message(chat_id, 'Поиск отменен. Хотите изучить другую местность ?🤗'
                                                 '\nПросто отправьте координаты или снимок!')
+                self.__cancel_analysis(image_name)
 
     def __handle_cords_input(self, chat_id, cords) -> None:
         """
@@ -224,62 +370,155 @@ class ForestBot:
         :param chat_id: user id
         :param cords: extracted coordinates from geoteg or text message
         """
-        Thread(target=self.__send_loading_animation_message, kwargs={'chat_id': chat_id}).start()
+        busy_minutes = self.__get_busy_minutes(with_download=True)
+        if busy_minutes is not None:
+            self.__send_busy_message(chat_id, busy_minutes)
+            return
         image_name = generate_image_name(chat_id)
         radius = self.user_radiuses_deg.get(chat_id, ForestBot.default_radius_deg)
-        self.download_satellite_queue_size += 1
-        Thread(
-            target=self.__download_satellite,
-            kwargs={
-                'image_name': image_name,
-                'cords': cords,
-                'radius': radius,
-                'download_dir': Path("input_photos"),
-                'chat_id': chat_id
-            }
-        ).start()
-
-    def __send_loading_animation_message(self, chat_id: int) -> None:
+        queue_position = self.download_executor.submit(
+            chat_id,
+            self.__download_satellite,
+            image_name=image_name,
+            cords=cords,
+            radius=radius,
+            download_dir=Path("input_photos"),
+            chat_id=chat_id
+        )
+        # Animation takes a thread for a minute, so their number is limited and under load the message stays still
+        if self.animation_slots.acquire(blocking=False):
+            Thread(target=self.__send_loading_animation_message,
+                   kwargs={'chat_id': chat_id, 'queue_position': queue_position, 'animate': True}).start()
+        else:
+            self.__run_in_background(self.__send_loading_animation_message, chat_id=chat_id,
+                                     queue_position=queue_position, animate=False)
+
+    def __send_loading_animation_message(self, chat_id: int, queue_position: int = 0, animate: bool = True) -> None:
         """
         Method to show cool rotating globe in message
         :param chat_id: user id
+        :param queue_position: number of downloads which will be started before the request of the user
+        :param animate: rotate the globe, the caller has acquired a slot of animation_slots for it
         """
         states = ['🌍', '🌎', '🌏']
         message_text = "Ваши координаты приняты. Загружаем снимок "
-        msg = self.bot.send_message(chat_id, message_text + states[0])
-        if self.download_satellite_queue_size > ForestBot.min_download_size_to_notify:
-            self.send_text_message(chat_id,
-                                   f"В данный момент нам поступило достаточно много запросов на загрузку снимков.\n"
-                                   f"Номер вашего запроса в очереди: {self.download_satellite_queue_size}")
-        for i in range(1, 124):
-            try:
-                self.bot.edit_message_text(message_text + states[i % 3], chat_id, msg.id)
-            except Exception as e:
-                time.sleep(3)
-            time.sleep(0.5)
+        try:
+            msg = self.bot.send_message(chat_id, message_text + states[0])
+            if queue_position > ForestBot.min_download_size_to_notify:
+                self.send_text_message(chat_id,
+                                       f"В данный момент нам поступило достаточно много запросов на загрузку снимков.\n"
+                                       f"Номер вашего запроса в очереди: {queue_position + 1}")
+            for i in range(1, 124 if animate else 1):
+                try:
+                    self.bot.edit_message_text(message_text + states[i % 3], chat_id, msg.id)
+                except Exception as e:
+                    time.sleep(3)
+                time.sleep(0.5)
+        finally:
+            if animate:
+                self.animation_slots.release()
 
     def __download_satellite(self, image_name, cords, radius, download_dir, chat_id) -> None:
         """
         Method to download satellite image on disk.
         """
-        with self.download_satellite_lock:
-            try:
-                transform_func = download_rect(image_name=image_name, center=cords, radius=radius,
-                                               download_dir=download_dir)
-                self.img_to_func[image_name] = transform_func
-                self.__send_image_with_retry(
-                    result_path=download_dir / image_name,
-                    chat_id=chat_id,
-                    delete_result=False,
-                    caption=f'Снимок местности по вашим координатам:\n{cords[0]}, {cords[1]}\n',
-                    reply_markup=generate_buttons_continue(image_name)
-                )
-            except Exception as ex:
-                print(f"Failed to load satellite images:\n{ex}")
-                self.send_text_message(chat_id, "Не удалось обнаружить спутниковые снимки в данном районе. Похоже, "
-                                                "Вы - отважный путешественник, раз решили отправиться туда!")
-            finally:
-                self.download_satellite_queue_size -= 1
+        try:
+            image, transform_func = download_rect(image_name=image_name, center=cords, radius=radius,
+                                                  download_dir=download_dir, cache=self.satellite_cache,
+                                                  executor=self.cell_executor)
+            self.img_to_func.put(image_name, transform_func)
+            # Image is kept in memory, so analysis starts without reading it back
+            self.satellite_images.put(image_name, image)
+            encoded_image = encode_image(cv2.cvtColor(image, cv2.COLOR_RGB2BGR), ForestBot.result_format)
+            if ForestBot.keep_files_on_disk:
+                cv2.imwrite(str(download_dir / image_name), cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+            if ForestBot.auto_analyse_satellite:
+                self.__start_speculative_analysis(chat_id, image_name, image)
+            self.__send_image_with_retry(
+                photo=encoded_image,
+                chat_id=chat_id,
+                caption=f'Снимок местности по вашим координатам:\n{cords[0]}, {cords[1]}\n',
+                reply_markup=generate_buttons_continue(image_name)
+            )
+        except Exception as ex:
+            print(f"Failed to load satellite images:\n{ex}")
+            self.send_text_message(chat_id, "Не удалось обнаружить спутниковые снимки в данном районе. Похоже, "
+                                            "Вы - отважный путешественник, раз решили отправиться туда!")
+
+    def __start_speculative_analysis(self, chat_id: int, image_name: str, image: np.ndarray) -> None:
+        """
+        Start analysis of satellite image while the user decides. The result is kept until the answer
+        """
+        threshold = self.user_thresholds.get(chat_id, ForestBot.default_threshold)
+        with self.speculative_lock:
+            self.speculative_running[image_name] = [threshold, None]
+        # Postprocessing draws on the image, the original is kept for analysis with another threshold.
+        # The answer of the user is not known after restart, so the job is not persistent
+        try:
+            self.controller.request_queue.put(
+                Artifact(chat_id, image_name, threshold, image=image.copy(), persistent=False))
+        except queue.Full:
+            # Analysis starts after the answer as usual
+            with self.speculative_lock:
+                del self.speculative_running[image_name]
+
+    def __start_analysis(self, chat_id: int, image_name: str) -> None:
+        """Analyse satellite image confirmed by the user, the result of speculative analysis is used if possible"""
+        threshold = self.user_thresholds.get(chat_id, ForestBot.default_threshold)
+        func = self.img_to_func.get(image_name)
+        if func is not None:
+            # Analysis could wait in the queue, the result should still get the export button
+            self.img_to_func.put(image_name, func)
+        with self.speculative_lock:
+            running = self.speculative_running.get(image_name)
+            if running is not None and running[0] == threshold:
+                # Result is sent when ready. Image is kept until then, the analysis is repeated if it fails
+                running[1] = 'y'
+                return
+            if running is not None:
+                running[1] = 'n'  # threshold was changed, result is useless
+            speculative_result = self.speculative_results.pop(image_name)
+
+        if speculative_result is not None and speculative_result[2] == threshold:
+            self.satellite_images.pop(image_name)
+            self.__send_prediction_callback(speculative_result[0], chat_id, speculative_result[1], image_name)
+            return
+
+        image = self.satellite_images.pop(image_name)
+        if image is None and not (Path("input_photos") / image_name).exists():
+            # Message is not outdated, so the image was evicted by images of other users
+            self.send_text_message(chat_id, self.image_evicted_message)
+            return
+        try:
+            self.controller.request_queue.put(Artifact(chat_id, image_name, threshold, image=image))
+        except queue.Full:
+            self.send_text_message(chat_id, self.too_many_images_message)
+
+    def __handle_failed_prediction(self, chat_id: int, image_name: str) -> None:
+        """
+        Callback for image which failed to process, retries of the job are used up.
+        Speculative analysis confirmed by the user is repeated, the user is told about other failed images
+        """
+        with self.speculative_lock:
+            running = self.speculative_running.pop(image_name, None)
+        if running is not None:
+            if running[1] == 'y':
+                # Speculative job is not persistent, the analysis is repeated by a regular one
+                self.__start_analysis(chat_id, image_name)
+            return
+        input_path = Path('input_photos') / image_name
+        if not ForestBot.keep_files_on_disk and input_path.exists():
+            # Large image is not needed anymore
+            input_path.unlink()
+        self.send_text_message(chat_id, self.failed_to_send_message)
+
+    def __cancel_analysis(self, image_name: str) -> None:
+        """Free memory of satellite image the user refused to analyse"""
+        with self.speculative_lock:
+            if image_name in self.speculative_running:
+                self.speculative_running[image_name][1] = 'n'
+            self.speculative_results.pop(image_name)
+        self.satellite_images.pop(image_name)
 
     def __init_messages(self) -> None:
         """Loads basic messages from files."""
@@ -312,66 +551,89 @@ class ForestBot:
         with open(msg_path / "wrong_threshold.txt", encoding="UTF-8") as f:
             self.wrong_threshold = f.read()
 
+        self.too_many_images_message = f"У вас уже {ForestBot.max_queued_per_chat} снимков в очереди ⏳\n" \
+                                       "Дождитесь результатов и отправьте снимок снова"
+        self.image_evicted_message = "Сейчас слишком много запросов, снимок не сохранился 😔\n" \
+                                     "Отправьте ваши координаты снова чуть позже"
         self.wrong_change_radius_message = "Для изменения радиуса снимка используйте команду таким образом:\n" \
                                            "/set_radius " \
                                            f"{{число в пределах " \
                                            f"[{ForestBot.min_radius_km}, {ForestBot.max_radius_km}]}}\n\n" \
                                            "Пример:\n/set_radius 2.5"
 
-    def __send_prediction_callback(self, result_path: Path, chat_id: int, mask: np.ndarray, image_name=None) -> None:
+    def __send_prediction_callback(self, result: Union[bytes, Path], chat_id: int, mask: np.ndarray,
+                                   image_name=None) -> None:
         """
         Callback for completed prediction.
-        :param Path result_path: path to the result image
+        :param result: encoded result image or path to the result of a large image
         :param int chat_id: chat id
         """
-        self.img_to_mask[image_name] = mask
-        Thread(
-            target=self.__send_image_with_retry,
-            kwargs={
-                'result_path': result_path,
-                'chat_id': chat_id,
-                'delete_result': True,
-                'reply_markup': generate_buttons_osm(image_name) if image_name in self.img_to_func else None
-            }
-        ).start()
-
-    def __send_image_with_retry(self, result_path: Path, chat_id: int, attempt: int = 0, caption: str = "Готово!🥳",
-                                delete_result: bool = False, **kwargs) -> None:
+        if isinstance(result, Path):
+            # Large result is sent as a file, Telegram would compress it as a photo. The file is deleted after sending
+            self.__run_in_background(send_document_with_retry, bot=self.bot, chat_id=chat_id,
+                                     document=open(result, 'rb'), max_attempts=ForestBot.max_attempts,
+                                     schedule=self.__run_later, visible_file_name=f"{Path(image_name).stem}.tif")
+            return
+
+        with self.speculative_lock:
+            if image_name in self.speculative_running:
+                threshold, decision = self.speculative_running.pop(image_name)
+                if decision is None:
+                    # User has not answered yet
+                    self.speculative_results.put(image_name, (result, mask, threshold))
+                if decision != 'y':
+                    return
+                self.satellite_images.pop(image_name)
+
+        func = self.img_to_func.get(image_name)
+        if func is not None:
+            # Message with the export button is sent now, its data should live as long as the button
+            self.img_to_mask.put(image_name, mask)
+            self.img_to_func.put(image_name, func)
+        input_path = Path('input_photos') / image_name
+        self.__run_in_background(
+            self.__send_image_with_retry,
+            photo=result,
+            chat_id=chat_id,
+            # satellite images are still kept on disk until analysis
+            delete_files=[] if ForestBot.keep_files_on_disk or not input_path.exists() else [input_path],
+            reply_markup=generate_buttons_osm(image_name) if func is not None else None
+        )
+
+    def __send_image_with_retry(self, photo: Union[bytes, Path], chat_id: int, attempt: int = 0,
+                                caption: str = "Готово!🥳", delete_files: List[Path] = (), **kwargs) -> None:
         """
         Method for sending the processed image. Applies multiple retries on failed submission.
-        :param Path result_path: path to the image
+        :param photo: encoded image or path to the image
         :param int chat_id: chat id
         :param int attempt: attempt number (starts from 0)
         :param str caption: (optional) text message
+        :param delete_files: (optional) files to delete after sending
         """
         try:
             # Try to read and send result
-            with open(result_path, 'rb') as result:
-                self.bot.send_photo(chat_id=chat_id, photo=result, caption=caption, **kwargs)
-            if delete_result:
-                try:
-                    os.remove(result_path)
-                    os.remove(Path('input_photos') / result_path.name)
-                except Exception as e:
-                    print(e)
+            if isinstance(photo, Path):
+                with open(photo, 'rb') as result:
+                    self.bot.send_photo(chat_id=chat_id, photo=result, caption=caption, **kwargs)
+            else:
+                self.bot.send_photo(chat_id=chat_id, photo=photo, caption=caption, **kwargs)
+            ForestBot.__delete_files(delete_files)
         except Exception as exception:
             print(
                 f"Attempt {attempt}/{ForestBot.max_attempts} failed. Trying again...\n"
-                f"Chat id = {chat_id},\npath={result_path}\n{exception}\n\n"
+                f"Chat id = {chat_id},\nphoto={ForestBot.__describe_photo(photo)}\n{exception}\n\n"
             )
 
             if attempt < ForestBot.max_attempts:
-                # Do another attempt with delay
-                time.sleep(1)
-                self.__send_image_with_retry(result_path=result_path, chat_id=chat_id, attempt=attempt + 1,
-                                             caption=caption, **kwargs)
+                # Do another attempt with delay, the sending thread is not held while waiting
+                self.__run_later(1, partial(self.__send_image_with_retry, photo=photo, chat_id=chat_id,
+                                            attempt=attempt + 1, caption=caption, delete_files=delete_files,
+                                            **kwargs))
             else:
                 # Maximum number of attempts made. Ask user to retry
-                print('=' * 10, f"\nFailed to send\nchat_id = {chat_id}\nimg = {result_path}\n", '=' * 10, sep='')
-                try:
-                    os.remove(result_path)
-                except Exception as e:
-                    print(e)
+                print('=' * 10, f"\nFailed to send\nchat_id = {chat_id}\nimg = {ForestBot.__describe_photo(photo)}\n",
+                      '=' * 10, sep='')
+                ForestBot.__delete_files(delete_files)
                 try:
                     # Try to ask user for retry if it is possible
                     self.send_text_message(chat_id, self.failed_to_send_message)
@@ -379,13 +641,62 @@ class ForestBot:
                     print('=' * 10, f"\nLost connection with chat id = {chat_id}\n{exception}\n", '=' * 10, sep='')
         else:
             if attempt:
-                print(
-                    f"!!!\nSuccessfully send by {attempt}th attempt.\nChat id = {chat_id}, img = {result_path}\n!!!\n")
+                print(f"!!!\nSuccessfully send by {attempt}th attempt.\n"
+                      f"Chat id = {chat_id}, img = {ForestBot.__describe_photo(photo)}\n!!!\n")
+
+    @staticmethod
+    def __describe_photo(photo: Union[bytes, Path]) -> str:
+        return str(photo) if isinstance(photo, Path) else f"<{len(photo)} bytes in memory>"
+
+    @staticmethod
+    def __delete_files(files: List[Path]) -> None:
+        for file in files:
+            try:
+                os.remove(file)
+            except Exception as e:
+                print(e)
 
     def send_text_message(self, chat_id: int, text: str) -> None:
-        Thread(target=send_text_message_with_retry, kwargs={
-            'bot': self.bot, 'chat_id': chat_id, 'text': text, 'max_attempts': ForestBot.max_attempts
-        }).start()
+        self.__run_in_background(send_text_message_with_retry, bot=self.bot, chat_id=chat_id, text=text,
+                                 max_attempts=ForestBot.max_attempts, schedule=self.__run_later)
+
+    def __run_in_background(self, task, executor: Executor = None, **kwargs) -> None:
+        """
+        Run task(**kwargs) on a bounded pool of threads, so bursts do not create a thread per message
+        :param executor: (optional) pool for the task, the pool of sending threads by default
+        """
+        def run():
+            try:
+                task(**kwargs)
+            except Exception:
+                print(f"Background task failed:\n{traceback.format_exc()}")
+
+        (self.send_executor if executor is None else executor).submit(run)
+
+    def __run_later(self, delay: float, task) -> None:
+        """Run task() on the pool of sending threads after delay, e.g. a retry. No thread of the pool waits for it"""
+        self.retry_executor.submit(delay, partial(self.__run_in_background, task))
+
+    def __get_busy_minutes(self, with_download: bool = False) -> Union[int, None]:
+        """
+        Admission control. New request is refused when too many requests are queued
+        or the wait estimated from measured processing times is too long
+        :param with_download: the request needs a satellite download before analysis
+        :return: None if the request is admitted, estimated wait in minutes otherwise
+        """
+        jobs = self.controller.request_queue
+        wait = self.controller.estimate_wait_time()
+        overloaded = len(jobs) >= ForestBot.max_queued_images
+        if with_download:
+            wait += self.download_executor.estimate_wait_time()
+            overloaded = overloaded or len(self.download_executor) >= ForestBot.max_queued_downloads
+        if not overloaded and wait <= ForestBot.max_wait_minutes * 60:
+            return None
+        return max(1, math.ceil(wait / 60))
+
+    def __send_busy_message(self, chat_id: int, minutes: int) -> None:
+        self.send_text_message(chat_id, f"Сейчас у нас очень много запросов 😥\n"
+                                        f"Попробуйте снова через {minutes} мин.")
 
     @classmethod
     def is_image_size_correct(cls, photo) -> bool:
@@ -1,31 +1,71 @@
 from urllib import request
-from PIL import ImageFile
-
-
-def get_sizes(url):
-    # source: https://stackoverflow.com/questions/7460218/get-image-size-without-downloading-it-in-python
-    # get file size *and* image size (None if not known)
-    file = request.urlopen(url)
-    size = file.headers.get("content-length")
-    if size:
-        size = int(size)
-    p = ImageFile.Parser()
-    while True:
-        data = file.read(1024)
-        if not data:
-            break
-        p.feed(data)
-        if p.image:
-            return size, p.image.size
-    file.close()
-    return size, None
-
-
-def is_correct_size(url, max_size, min_size) -> bool:
-    max_size_bytes = 15 * 1024 ** 3
-    mem_size, size = get_sizes(url)
-    if size is not None:
-        return (min_size <= size[0] <= max_size) and (min_size <= size[1] <= max_size)
-
-    else:
-        return mem_size < max_size_bytes
+from PIL import Image, ImageFile
+from typing import Tuple, Union
+import warnings
+
+chunk_size = 64 * 1024
+max_header_size = 1024 * 1024  # metadata, e.g. EXIF or color profile, on top of pixels
+
+
+def get_max_file_size(max_size) -> int:
+    """Largest file of an image with sides up to max_size, uncompressed 24-bit BMP is the largest valid format"""
+    return max_size * max_size * 3 + max_header_size
+
+
+def fetch_image(url, max_size, min_size,
+                max_size_bytes=None) -> Tuple[bool, Union[bytes, None], Union[Tuple[int, int], None]]:
+    """
+    Download image in a single pass. Image size is parsed from the first chunks, so images of wrong size
+    are rejected without downloading the rest of the file
+    :param url: url of the image
+    :param max_size: maximum allowable size of each side
+    :param min_size: minimum allowable size of each side
+    :param max_size_bytes: (optional) maximum allowable file size, used before the header is parsed.
+    Largest file of a valid image by default, see get_max_file_size
+    :return: (True, file content, (width, height)) if image size is correct.
+    (False, None, None) if it is wrong or could not be parsed
+    """
+    if max_size_bytes is None:
+        max_size_bytes = get_max_file_size(max_size)
+    with request.urlopen(url) as file:
+        mem_size = file.headers.get("content-length")
+        if mem_size and int(mem_size) > max_size_bytes:
+            return False, None, None
+
+        parser = ImageFile.Parser()
+        chunks = []
+        n_bytes = 0
+        size = None
+        while data := file.read(chunk_size):
+            chunks.append(data)
+            n_bytes += len(data)
+            if n_bytes > max_size_bytes:
+                return False, None, None
+            if size is None:
+                try:
+                    with warnings.catch_warnings():
+                        # Large documents are expected, they are never decoded at once
+                        warnings.simplefilter("ignore", Image.DecompressionBombWarning)
+                        parser.feed(data)
+                except (OSError, SyntaxError, ValueError) as e:
+                    # Image without a valid header is refused, the rest of the file is not downloaded
+                    print(f"Failed to parse image header:\n{e}")
+                    return False, None, None
+                if parser.image:
+                    size = parser.image.size
+                    if not is_size_correct(size, max_size=max_size, min_size=min_size):
+                        return False, None, None
+                elif n_bytes > max_header_size:
+                    # Size of a valid image is known after the header, the file is not an image
+                    print("Failed to parse image header: format is not recognized")
+                    return False, None, None
+
+    if size is None:
+        print("Failed to parse image header: format is not recognized")
+        return False, None, None
+    return True, b"".join(chunks), size
+
+
+def is_size_correct(size: Tuple[int, int], max_size, min_size) -> bool:
+    return (min_size <= size[0] <= max_size) and (min_size <= size[1] <= max_size)
+
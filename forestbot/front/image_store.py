@@ -0,0 +1,89 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Any
+import numpy as np
+import time
+
+
+class ImageStore:
+    """
+    Bounded in-memory storage of images and other large objects by name.
+    When the total size or number of items exceeds the budget, least recently used items are dropped.
+    Items could also expire some time after they are put
+    """
+
+    def __init__(self, max_bytes: int, max_items: int = None, max_age_seconds: float = None):
+        """
+        :param max_bytes: max total size of stored items
+        :param max_items: (optional) max number of stored items, for items without size such as functions
+        :param max_age_seconds: (optional) items are dropped this time after they are put
+        """
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.max_age_seconds = max_age_seconds
+        self.items = OrderedDict()  # name -> (item, size, time of put), least recently used first
+        self.total_bytes = 0
+        self.lock = Lock()
+
+    @staticmethod
+    def get_size(item: Any) -> int:
+        """Size of arrays, bytes and tuples of them"""
+        if isinstance(item, np.ndarray):
+            return item.nbytes
+        if isinstance(item, (bytes, bytearray)):
+            return len(item)
+        if isinstance(item, tuple):
+            return sum(ImageStore.get_size(x) for x in item)
+        return 0
+
+    def put(self, name: str, item: Any) -> None:
+        with self.lock:
+            self.__remove(name)
+            self.__remove_expired()
+            self.items[name] = item, ImageStore.get_size(item), time.monotonic()
+            self.total_bytes += self.items[name][1]
+            while self.items and (self.total_bytes > self.max_bytes or
+                                  self.max_items is not None and len(self.items) > self.max_items):
+                self.__remove(next(iter(self.items)))
+
+    def get(self, name: str, default=None) -> Any:
+        with self.lock:
+            if not self.__is_alive(name):
+                return default
+            self.items.move_to_end(name)
+            return self.items[name][0]
+
+    def pop(self, name: str, default=None) -> Any:
+        with self.lock:
+            if not self.__is_alive(name):
+                return default
+            item = self.items[name][0]
+            self.__remove(name)
+            return item
+
+    def __contains__(self, name: str) -> bool:
+        with self.lock:
+            return self.__is_alive(name)
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.items)
+
+    def __is_alive(self, name: str) -> bool:
+        """Whether the item is stored, expired item is removed"""
+        if name not in self.items:
+            return False
+        if self.max_age_seconds is not None and time.monotonic() - self.items[name][2] > self.max_age_seconds:
+            self.__remove(name)
+            return False
+        return True
+
+    def __remove_expired(self) -> None:
+        if self.max_age_seconds is not None:
+            deadline = time.monotonic() - self.max_age_seconds
+            for name in [name for name, (_, _, put_time) in self.items.items() if put_time < deadline]:
+                self.__remove(name)
+
+    def __remove(self, name: str) -> None:
+        if name in self.items:
+            self.total_bytes -= self.items.pop(name)[1]
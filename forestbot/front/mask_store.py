@@ -0,0 +1,135 @@
+from collections import OrderedDict
+from threading import Lock
+from pathlib import Path
+from typing import Union
+import numpy as np
+import time
+import os
+
+
+class MaskStore:
+    """
+    Storage of predicted masks by image name until the user asks for export.
+    Masks are bit-packed, 8 times smaller than uint8 ones. Recently used ones are kept in memory,
+    evicted ones are spilled to disk and deleted from there when the disk budget is exceeded.
+    Masks expire some time after they are put, like the buttons of the messages they belong to
+    """
+
+    def __init__(self, max_memory_bytes: int, max_age_seconds: float, spill_dir: Path = None,
+                 max_disk_bytes: int = 0):
+        """
+        :param max_memory_bytes: max total size of packed masks kept in memory
+        :param max_age_seconds: masks are dropped this time after they are put
+        :param spill_dir: (optional) folder for masks evicted from memory
+        :param max_disk_bytes: max total size of files in spill_dir
+        """
+        self.max_memory_bytes = max_memory_bytes
+        self.max_age_seconds = max_age_seconds
+        self.spill_dir = spill_dir
+        self.max_disk_bytes = max_disk_bytes if spill_dir is not None else 0
+
+        self.memory = OrderedDict()  # name -> (packed mask, shape, time of put), least recently used first
+        self.memory_bytes = 0
+        self.disk = OrderedDict()  # name -> (file size, shape, time of put), least recently used first
+        self.disk_bytes = 0
+        self.lock = Lock()
+
+        if self.spill_dir is not None:
+            # Spilled masks of the previous run are useless, their messages are outdated
+            self.spill_dir.mkdir(parents=True, exist_ok=True)
+            for path in self.spill_dir.glob("*.npy"):
+                os.remove(path)
+
+    @staticmethod
+    def pack(mask: np.ndarray) -> np.ndarray:
+        return np.packbits(mask > 0)
+
+    @staticmethod
+    def unpack(packed: np.ndarray, shape) -> np.ndarray:
+        """:return: mask with values 0 and 255, like the one from postprocess"""
+        mask = np.unpackbits(packed, count=int(np.prod(shape))).reshape(shape)
+        return np.multiply(mask, 255, out=mask)
+
+    def put(self, name: str, mask: np.ndarray) -> None:
+        with self.lock:
+            self.__remove(name)
+            self.__remove_expired()
+            self.__put_to_memory(name, MaskStore.pack(mask), mask.shape, time.monotonic())
+
+    def get(self, name: str) -> Union[np.ndarray, None]:
+        """
+        :return: mask with values 0 and 255 or None if it is not stored or expired
+        """
+        with self.lock:
+            self.__remove_expired()
+            if name in self.memory:
+                self.memory.move_to_end(name)
+                packed, shape, _ = self.memory[name]
+                return MaskStore.unpack(packed, shape)
+
+            if name in self.disk:
+                _, shape, put_time = self.disk[name]
+                try:
+                    packed = np.load(self.__get_path(name))
+                except Exception as e:
+                    print(f"Failed to read spilled mask:\n{e}")
+                    self.__remove_from_disk(name)
+                    return None
+                self.__remove_from_disk(name)
+                self.__put_to_memory(name, packed, shape, put_time)
+                return MaskStore.unpack(packed, shape)
+
+            return None
+
+    def __contains__(self, name: str) -> bool:
+        with self.lock:
+            self.__remove_expired()
+            return name in self.memory or name in self.disk
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.memory) + len(self.disk)
+
+    def __put_to_memory(self, name: str, packed: np.ndarray, shape, put_time: float) -> None:
+        self.memory[name] = packed, shape, put_time
+        self.memory_bytes += packed.nbytes
+        while self.memory_bytes > self.max_memory_bytes and self.memory:
+            evicted_name, (evicted, evicted_shape, evicted_time) = self.memory.popitem(last=False)
+            self.memory_bytes -= evicted.nbytes
+            self.__spill_to_disk(evicted_name, evicted, evicted_shape, evicted_time)
+
+    def __spill_to_disk(self, name: str, packed: np.ndarray, shape, put_time: float) -> None:
+        if self.max_disk_bytes <= 0:
+            return
+        path = self.__get_path(name)
+        try:
+            np.save(path, packed)
+            self.disk[name] = path.stat().st_size, shape, put_time
+            self.disk_bytes += self.disk[name][0]
+        except Exception as e:
+            print(f"Failed to spill mask to disk:\n{e}")
+        while self.disk_bytes > self.max_disk_bytes and self.disk:
+            self.__remove_from_disk(next(iter(self.disk)))
+
+    def __remove_expired(self) -> None:
+        deadline = time.monotonic() - self.max_age_seconds
+        for name in [name for name, (_, _, put_time) in self.memory.items() if put_time < deadline]:
+            self.memory_bytes -= self.memory.pop(name)[0].nbytes
+        for name in [name for name, (_, _, put_time) in self.disk.items() if put_time < deadline]:
+            self.__remove_from_disk(name)
+
+    def __remove(self, name: str) -> None:
+        if name in self.memory:
+            self.memory_bytes -= self.memory.pop(name)[0].nbytes
+        if name in self.disk:
+            self.__remove_from_disk(name)
+
+    def __remove_from_disk(self, name: str) -> None:
+        self.disk_bytes -= self.disk.pop(name)[0]
+        try:
+            os.remove(self.__get_path(name))
+        except OSError as e:
+            print(e)
+
+    def __get_path(self, name: str) -> Path:
+        return self.spill_dir / f"{name}.npy"
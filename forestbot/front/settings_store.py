@@ -0,0 +1,133 @@
+from threading import Thread, Lock, Event
+from pathlib import Path
+from typing import Any
+import traceback
+import sqlite3
+
+
+class SettingsStore:
+    """
+    Persistent settings of chats in SQLite. Writes are buffered and flushed by a background thread,
+    so handlers never wait for the disk. Settings of a chat are read on the first access to it
+    """
+
+    def __init__(self, path: Path, flush_interval: float = 1.0):
+        """
+        :param path: database file
+        :param flush_interval: max time in seconds between a change and its write to disk
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.chats = dict()  # chat_id -> {name: value}, only chats accessed since start
+        self.pending = dict()  # (chat_id, name) -> value not written yet
+        self.lock = Lock()
+        self.stopped = Event()
+        self.writer = None
+
+        # Reads of handlers and writes of the flushing thread do not block each other in WAL mode
+        self.connection = self.__connect()
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS settings ("
+                                "chat_id INTEGER, name TEXT, value, PRIMARY KEY (chat_id, name))")
+        self.connection.commit()
+
+    def start(self) -> None:
+        self.writer = Thread(target=self.__write_behind, name="settings_writer", daemon=True)
+        self.writer.start()
+
+    def stop(self) -> None:
+        """Stop the flushing thread, pending changes are written"""
+        self.stopped.set()
+        if self.writer is not None:
+            self.writer.join()
+        else:
+            self.flush()
+
+    def get(self, chat_id: int, name: str, default=None) -> Any:
+        with self.lock:
+            return self.__load(chat_id).get(name, default)
+
+    def set(self, chat_id: int, name: str, value: Any) -> None:
+        with self.lock:
+            self.__load(chat_id)[name] = value
+            self.pending[(chat_id, name)] = value
+
+    def get_setting(self, name: str) -> "Setting":
+        """:return: dict-like view of one setting, keyed by chat id"""
+        return Setting(self, name)
+
+    def flush(self, connection: sqlite3.Connection = None) -> None:
+        """
+        Write pending changes to disk
+        :param connection: (optional) connection of the calling thread, a new one is opened otherwise
+        """
+        with self.lock:
+            pending, self.pending = self.pending, dict()
+        if not pending:
+            return
+        try:
+            if connection is None:
+                connection = self.__connect()
+                try:
+                    self.__write(connection, pending)
+                finally:
+                    connection.close()
+            else:
+                self.__write(connection, pending)
+        except Exception:
+            # Changes are kept for the next flush, unless they were overwritten meanwhile
+            with self.lock:
+                self.pending = {**pending, **self.pending}
+            raise
+
+    @staticmethod
+    def __write(connection: sqlite3.Connection, pending: dict) -> None:
+        with connection:
+            connection.executemany("INSERT OR REPLACE INTO settings (chat_id, name, value) VALUES (?, ?, ?)",
+                                   [(chat_id, name, value) for (chat_id, name), value in pending.items()])
+
+    def __load(self, chat_id: int) -> dict:
+        """Settings of the chat, they are read from disk on the first access. Caller holds the lock"""
+        if chat_id not in self.chats:
+            rows = self.connection.execute("SELECT name, value FROM settings WHERE chat_id = ?", (chat_id,))
+            self.chats[chat_id] = dict(rows.fetchall())
+        return self.chats[chat_id]
+
+    def __connect(self) -> sqlite3.Connection:
+        # Connection of the store is used under the lock, others by a single thread
+        return sqlite3.connect(self.path, check_same_thread=False)
+
+    def __write_behind(self) -> None:
+        connection = self.__connect()
+        try:
+            while not self.stopped.wait(self.flush_interval):
+                try:
+                    self.flush(connection)
+                except Exception:
+                    print(f"Failed to save settings:\n{traceback.format_exc()}")
+            self.flush(connection)
+        finally:
+            connection.close()
+
+
+class Setting:
+    """One setting of all chats with the interface of dict: setting[chat_id] = value"""
+
+    def __init__(self, store: SettingsStore, name: str):
+        self.store = store
+        self.name = name
+
+    def get(self, chat_id: int, default=None) -> Any:
+        return self.store.get(chat_id, self.name, default)
+
+    def __getitem__(self, chat_id: int) -> Any:
+        value = self.get(chat_id, Setting)
+        if value is Setting:
+            raise KeyError(chat_id)
+        return value
+
+    def __setitem__(self, chat_id: int, value: Any) -> None:
+        self.store.set(chat_id, self.name, value)
+
+    def __contains__(self, chat_id: int) -> bool:
+        return self.get(chat_id, Setting) is not Setting
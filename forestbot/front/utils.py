@@ -1,4 +1,5 @@
-from typing import Union, Tuple
+from typing import Union, Tuple, Callable
+from functools import partial
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
 import time
 import os
@@ -112,35 +113,54 @@ def is_osm_call(call) -> bool:
     return call.data.split()[0] == 'osm'
 
 
+def retry_later(delay: float, schedule: Union[Callable, None], retry: Callable) -> None:
+    """Call retry after delay, with schedule(delay, retry) if it is provided or after sleeping otherwise"""
+    if schedule is None:
+        time.sleep(delay)
+        retry()
+    else:
+        schedule(delay, retry)
+
+
 def send_text_message_with_retry(bot, chat_id: int, text: str, max_attempts: int = 10, delay: float = 1,
-                                 attempt: int = 1) -> None:
+                                 attempt: int = 1, schedule: Callable = None) -> None:
+    """
+    :param schedule: (optional) function(delay, retry) which calls retry() after delay without blocking,
+    the calling thread sleeps by default
+    """
     try:
         bot.send_message(chat_id=chat_id, text=text)
     except Exception as e:
         if attempt < max_attempts:
-            time.sleep(delay)
-            send_text_message_with_retry(bot=bot, chat_id=chat_id, text=text, max_attempts=max_attempts, delay=delay,
-                                         attempt=attempt + 1)
             print(e)
+            retry_later(delay, schedule, partial(send_text_message_with_retry, bot=bot, chat_id=chat_id, text=text,
+                                                 max_attempts=max_attempts, delay=delay, attempt=attempt + 1,
+                                                 schedule=schedule))
         else:
             print('=' * 10, f"\nFailed to send message\nchat_id = {chat_id}\n", '=' * 10, sep='')
 
 
 def send_document_with_retry(bot, chat_id: int, document, max_attempts: int = 10, delay: float = 1,
-                             attempt: int = 1) -> None:
+                             attempt: int = 1, schedule: Callable = None, **kwargs) -> None:
+    """
+    :param document: opened file, it is closed and deleted after sending, or content of the file
+    :param schedule: (optional) function(delay, retry), see send_text_message_with_retry
+    :param kwargs: passed to send_document, e.g. visible_file_name for the content
+    """
     try:
-        bot.send_document(chat_id=chat_id, document=document, caption="Готово!")
-        try:
-            document.close()
-            os.remove(document.name)
-        except Exception as e:
-            print(e)
+        bot.send_document(chat_id=chat_id, document=document, caption="Готово!", **kwargs)
+        if not isinstance(document, bytes):
+            try:
+                document.close()
+                os.remove(document.name)
+            except Exception as e:
+                print(e)
 
     except Exception as e:
         if attempt < max_attempts:
-            time.sleep(delay)
-            send_document_with_retry(bot=bot, chat_id=chat_id, document=document, max_attempts=max_attempts,
-                                     delay=delay, attempt=attempt + 1)
             print(e)
+            retry_later(delay, schedule, partial(send_document_with_retry, bot=bot, chat_id=chat_id,
+                                                 document=document, max_attempts=max_attempts, delay=delay,
+                                                 attempt=attempt + 1, schedule=schedule, **kwargs))
         else:
             print('=' * 10, f"\nFailed to send message\nchat_id = {chat_id}\n", '=' * 10, sep='')
@@ -0,0 +1,154 @@
+from forestbot.ml_backend.model import Model
+from forestbot.ml_backend.sliding_window import SlidingWindow
+from threading import Thread, Condition, Event, Lock
+from collections import deque
+import numpy as np
+import time
+
+
+class ScheduledImage:
+    """
+    Image waiting for its windows to be processed by BatchScheduler
+    """
+
+    def __init__(self, image: np.ndarray, window: SlidingWindow):
+        self.image = image
+        self.window = window
+        self.next_index = 0  # next window to be put into a batch
+        self.remaining = len(window)  # windows without model output
+        self.done = Event()
+        self.error = None
+        self.lock = Lock()  # outputs of the image can come from several runners at once
+
+    def has_windows(self) -> bool:
+        return self.next_index < len(self.window)
+
+
+class BatchScheduler:
+    """
+    Runs windows of several images through the model in shared batches.
+    Each request waits for its own windows, outputs are blended by its own SlidingWindow.
+    Batches are run by several runner threads, so the model is not idle while a batch is collected
+    and several batches can be run at once, like images of several workers without batching.
+    """
+    default_max_batch_size = 16
+    default_max_delay = 0.005  # in seconds
+    wait_timeout = 1.0  # in seconds
+
+    def __init__(self, model: Model, max_batch_size=None, max_delay=None, n_runners=1):
+        """
+        :param model: model shared by all requests
+        :param n_runners: number of batches run at the same time
+        :param max_batch_size: max number of windows in one model run
+        :param max_delay: max time to wait for more windows when the batch is not full, in seconds
+        """
+        self.model = model
+        self.max_batch_size = BatchScheduler.default_max_batch_size if max_batch_size is None else max_batch_size
+        if model.fixed_batch_size is not None:
+            self.max_batch_size = model.fixed_batch_size
+        self.max_delay = BatchScheduler.default_max_delay if max_delay is None else max_delay
+        self.n_runners = n_runners
+
+        self.images = deque()
+        self.condition = Condition()
+        self.is_running = False
+        self.runners = []
+
+    def start(self) -> None:
+        """Start batching in background threads"""
+        self.is_running = True
+        self.runners = [Thread(target=self.observe_updates, name=f"batch_runner_{i}", daemon=True)
+                        for i in range(self.n_runners)]
+        for runner in self.runners:
+            runner.start()
+
+    def stop(self) -> None:
+        """Stop batching. Images already submitted are finished first"""
+        with self.condition:
+            self.is_running = False
+            self.condition.notify_all()
+
+    def predict_proba_sliding(self, input: np.ndarray, window_size: int, overlap: float = 0.25,
+                              blend: str = "gaussian") -> np.ndarray:
+        """
+        Same as Model.predict_proba_sliding, but windows are batched together with other requests.
+        Blocks until the prediction is ready.
+        :raises RuntimeError: the scheduler is stopped before the prediction is ready
+        """
+        window = SlidingWindow(input.shape, window_size=window_size, overlap=overlap, blend=blend)
+        scheduled = ScheduledImage(window.pad(input), window)
+        with self.condition:
+            if not self.is_running:
+                raise RuntimeError("Batch scheduler is stopped")
+            self.images.append(scheduled)
+            self.condition.notify_all()
+
+        while not scheduled.done.wait(timeout=BatchScheduler.wait_timeout):
+            # Runners finish submitted images before they exit, so a dead runner means the image is lost
+            if not any(runner.is_alive() for runner in self.runners):
+                scheduled.error = RuntimeError("Batch scheduler is stopped")
+                break
+        if scheduled.error is not None:
+            raise scheduled.error
+        return Model.sigmoid_inplace(window.result())
+
+    def observe_updates(self) -> None:
+        """Collects windows into batches and runs them until the scheduler is stopped"""
+        batch = np.empty((self.max_batch_size, 3, self.model.input_size, self.model.input_size), dtype=np.float32)
+        while True:
+            items = self.__collect_batch()
+            if items is None:
+                return
+            self.__run_batch(items, batch)
+
+    def __pending_windows(self) -> int:
+        return sum(len(image.window) - image.next_index for image in self.images)
+
+    def __collect_batch(self):
+        """
+        Waits for windows and takes them round-robin from all waiting images, so small images
+        are not stuck behind big ones
+        :return: list of (image, window index) or None if scheduler is stopped and all images are done
+        """
+        with self.condition:
+            while self.is_running and not self.images:
+                self.condition.wait(timeout=BatchScheduler.wait_timeout)
+            if not self.images:
+                return None
+
+            deadline = time.monotonic() + self.max_delay
+            while self.__pending_windows() < self.max_batch_size and (delay := deadline - time.monotonic()) > 0:
+                self.condition.wait(timeout=delay)
+
+            items = []
+            while self.images and len(items) < self.max_batch_size:
+                image = self.images.popleft()
+                if image.error is not None:
+                    continue
+                items.append((image, image.next_index))
+                image.next_index += 1
+                if image.has_windows():
+                    self.images.append(image)
+            return items
+
+    def __run_batch(self, items, batch: np.ndarray) -> None:
+        """Run model for collected windows and route outputs back to their images"""
+        try:
+            for k, (image, index) in enumerate(items):
+                image.window.fill_batch(image.image, [index], batch[k:k + 1])
+            outputs = self.model.run(batch[:len(items)])
+        except Exception as e:
+            for image, _ in items:
+                with image.lock:
+                    image.error = e
+                image.done.set()
+            return
+
+        for (image, index), output in zip(items, outputs):
+            with image.lock:
+                if image.error is not None:
+                    continue
+                image.window.add(index, output)
+                image.remaining -= 1
+                if image.remaining == 0:
+                    image.done.set()
@@ -1,8 +1,14 @@
 import queue
 import time
+import os
+import traceback
+from threading import Thread, Event, Lock
+from collections import deque
 from forestbot.ml_backend.model import Model
+from forestbot.ml_backend.batch_scheduler import BatchScheduler
+from forestbot.ml_backend.prediction_cache import PredictionCache
+from forestbot.ml_backend.large_image import process_large_image
 from forestbot.ml_backend.utils import *
-from PIL import Image
 from pathlib import Path
 import cv2
 import numpy as np
@@ -14,10 +20,23 @@ class Artifact:
     Entity received from ForestBot
     """
 
-    def __init__(self, chat_id, img_name, threshold):
+    def __init__(self, chat_id, img_name, threshold, image=None, persistent=True, n_pixels=None):
+        """
+        :param image: (optional) content of the image file or decoded RGB image.
+        Path means a large image on disk, which is processed by bands and sent back as a file.
+        If not provided, image is read from input_photos/img_name
+        :param persistent: whether the job should be processed after restart, see JobQueue
+        :param n_pixels: (optional) size of the encoded image, used for scheduling
+        """
         self.chat_id = chat_id
         self.img_name = img_name
         self.threshold = threshold
+        self.image = image
+        self.persistent = persistent
+        self.n_pixels = n_pixels
+        self.enqueue_time = time.monotonic()
+        self.job_id = None  # set by JobQueue
+        self.lease = None
 
 
 class Controller:
@@ -25,13 +44,45 @@ class Controller:
     Class for manage all back-end work.
     """
     default_crop_size = 400
-    request_queue = queue.Queue()
+    default_overlap = 0.25
+    stop_signal = None  # Wakes up a waiting worker to check if it should stop
+    wait_timeout = 1.0  # in seconds
+    max_stored_wait_times = 1000
 
-    def __init__(self, callback, model_input_size, use_crop=True, crop_size=None):
+    def __init__(self, callback, model_input_size, use_crop=True, crop_size=None, batch_size=None, overlap=None,
+                 blend="gaussian", n_workers=1, n_threads=None, use_batching=False, max_batch_size=None,
+                 max_batch_delay=None, result_format=".png", save_results=False, prediction_cache=None,
+                 large_image_memory_mb=256, job_queue=None, failure_callback=None):
+        """
+        :param n_workers: number of images processed at the same time. Workers share one model
+        :param n_threads: number of threads used by the model for all workers together.
+        ONNX Runtime default by default, it counts physical cores available to the process
+        :param use_batching: run crops of different images in shared batches. Works only with cropping
+        :param max_batch_size: max number of crops in a shared batch
+        :param max_batch_delay: max time to wait for crops of other images, in seconds
+        :param result_format: format the result is encoded to before passing to callback, e.g. ".png" or ".jpg"
+        :param save_results: also write results into result_photos, for debugging
+        :param PredictionCache prediction_cache: (optional) cache for predictions of repeated images
+        :param large_image_memory_mb: memory for a band of a large image, see process_large_image
+        :param JobQueue job_queue: (optional) persistent queue used instead of the in-memory request_queue
+        :param failure_callback: (optional) called with chat id and image name when an image failed
+        and will not be retried
+        """
         self.callback = callback
+        self.failure_callback = failure_callback
+        self.n_workers = n_workers
         self.model_input_size = model_input_size
         self.use_crop = use_crop
         self.crop_size = crop_size
+        self.overlap = Controller.default_overlap if overlap is None else overlap
+        self.blend = blend
+        self.result_format = result_format
+        self.save_results = save_results
+        self.prediction_cache = prediction_cache
+        self.large_image_memory_mb = large_image_memory_mb
+        self.job_queue = job_queue
+        # Queue belongs to the controller, so stop signals of a stopped controller do not reach another one
+        self.request_queue = queue.Queue() if job_queue is None else job_queue
         if use_crop and crop_size is None:
             self.crop_size = Controller.default_crop_size
             warnings.warn(f"Selected cropping, but crop_size is not provided. "
@@ -41,32 +92,189 @@ class Controller:
             warnings.warn(f"Selected no cropping, but crop_size is provided. "
                           f"It will have no effect")
 
-        self.model = Model(input_size=self.model_input_size)
+        self.model = Model(input_size=self.model_input_size, batch_size=batch_size,
+                           n_threads=n_threads)
+        # Cached predictions are valid only for the same model and cropping parameters
+        self.cache_signature = f"{Model.model_variant}|{self.model_input_size}|{self.use_crop}|{self.crop_size}|" \
+                               f"{self.overlap}|{self.blend}"
+        self.scheduler = None
+        if use_batching and use_crop:
+            # As many batches are run at once as images are processed without batching
+            self.scheduler = BatchScheduler(self.model, max_batch_size=max_batch_size, max_delay=max_batch_delay,
+                                            n_runners=n_workers)
+        elif use_batching:
+            warnings.warn("Selected batching, but cropping is not selected. It will have no effect")
+
+        self.stop_event = Event()
+        self.wait_times = deque(maxlen=Controller.max_stored_wait_times)  # from enqueue to start, in seconds
+        self.service_times = deque(maxlen=Controller.max_stored_wait_times)  # processing time per pixel, in seconds
+        self.workers = []
+        self.in_progress = set()  # artifacts of job_queue being processed, their leases are renewed
+        self.in_progress_lock = Lock()
+
+    def start(self) -> None:
+        """Start workers in background threads"""
+        if self.scheduler is not None:
+            self.scheduler.start()
+        self.workers = [Thread(target=self.observe_updates, name=f"inference_worker_{i}", daemon=True)
+                        for i in range(self.n_workers)]
+        for worker in self.workers:
+            worker.start()
+        if self.job_queue is not None:
+            Thread(target=self.__renew_leases, name="lease_renewer", daemon=True).start()
+
+    def stop(self) -> None:
+        """Stop workers. Images being processed are finished first"""
+        self.stop_event.set()
+        if self.job_queue is None:
+            for _ in range(self.n_workers):
+                self.request_queue.put(Controller.stop_signal)
+        else:
+            self.job_queue.wake_up(self.n_workers)
+        if self.scheduler is not None:
+            self.scheduler.stop()
 
     def observe_updates(self) -> None:
-        """Checks if there are new images for prediction"""
-        while True:
-            if not Controller.request_queue.empty():
-                self.__analyse_image()
-            time.sleep(0.1)
+        """Waits for new images for prediction until the controller is stopped"""
+        while not self.stop_event.is_set():
+            try:
+                current = self.request_queue.get(timeout=Controller.wait_timeout)
+            except queue.Empty:
+                continue
+            if current is Controller.stop_signal:
+                continue
+
+            wait_time = time.monotonic() - current.enqueue_time
+            self.wait_times.append(wait_time)
+            print(f"Started {current.img_name} after {wait_time:.3f}s in queue")
+            start_time = time.monotonic()
+            with self.in_progress_lock:
+                self.in_progress.add(current)
+            try:
+                self.__analyse_image(current)
+                if current.n_pixels:
+                    self.service_times.append((time.monotonic() - start_time) / current.n_pixels)
+            except Exception:
+                print(f"Failed to process {current.img_name}:\n{traceback.format_exc()}")
+                if self.job_queue is not None and self.job_queue.fail(current):
+                    print(f"{current.img_name} will be retried")
+                elif self.failure_callback is not None:
+                    self.failure_callback(current.chat_id, current.img_name)
+            finally:
+                with self.in_progress_lock:
+                    self.in_progress.discard(current)
 
-    def __analyse_image(self) -> None:
+    def average_wait_time(self) -> float:
+        """Average time between enqueue and start of processing for recent images, in seconds"""
+        wait_times = list(self.wait_times)
+        return sum(wait_times) / len(wait_times) if wait_times else 0.0
+
+    def estimate_wait_time(self) -> float:
+        """
+        Time until a new image starts processing, from the queued pixels and the speed of recent images.
+        Works only with job_queue, which knows the size of queued images
+        :return: time in seconds
+        """
+        service_times = list(self.service_times)
+        if self.job_queue is None or not service_times:
+            return 0.0
+        return self.job_queue.get_queued_cost() * sum(service_times) / len(service_times) / self.n_workers
+
+    def __analyse_image(self, current: Artifact) -> None:
         """Do all prediction work and notify bot about finish using callback"""
-        current = Controller.request_queue.get()
-        raw_input = np.asarray(Image.open(Path(f"input_photos/{current.img_name}")).convert("RGB"))
-        model_input = preprocess(raw_input)
+        if isinstance(current.image, Path):
+            self.__analyse_large_image(current)
+            return
 
-        if self.use_crop:
-            model_input = resize_for_cropping(model_input, self.crop_size)
-            prediction = self.model.predict_proba_crop(model_input, crop_size=self.crop_size)
+        raw_input = Controller.__load_input(current)
+        current.image = None  # is not needed anymore, let it be freed
+        current.n_pixels = raw_input.shape[0] * raw_input.shape[1]
 
+        if self.prediction_cache is None:
+            prediction = self.__predict(raw_input)
         else:
-            model_input = resize_to_model_input(model_input, self.crop_size)
-            prediction = self.model.predict_proba(model_input)
+            # Same image with another threshold needs only postprocessing
+            key = PredictionCache.get_key(raw_input, self.cache_signature)
+            prediction = self.prediction_cache.get(key)
+            if prediction is None:
+                prediction = quantize_prediction(self.__predict(raw_input))
+                self.prediction_cache.put(key, prediction)
 
         result, mask = postprocess(raw_input, prediction, current.threshold)
 
-        result_path = Path(f"result_photos/{current.img_name}").with_suffix(".png")
-        cv2.imwrite(str(result_path), result)
+        encoded_result = encode_image(result, self.result_format)
+        if self.save_results:
+            with open(Path(f"result_photos/{current.img_name}").with_suffix(self.result_format), 'wb') as f:
+                f.write(encoded_result)
+
+        self.__deliver(current, encoded_result, current.chat_id, mask, image_name=current.img_name)
+
+    def __renew_leases(self) -> None:
+        """Renew leases of the jobs being processed, so long jobs such as large images are not given to other workers"""
+        while not self.stop_event.wait(self.job_queue.visibility_timeout / 3):
+            with self.in_progress_lock:
+                in_progress = list(self.in_progress)
+            for current in in_progress:
+                try:
+                    if not self.job_queue.renew(current):
+                        print(f"Lease of {current.img_name} is lost, its result will not be delivered")
+                except Exception:
+                    print(f"Failed to renew lease of {current.img_name}:\n{traceback.format_exc()}")
+
+    def __analyse_large_image(self, current: Artifact) -> None:
+        """Process image from disk by bands, the callback gets path to the result instead of its content"""
+        # Job processed again after an expired lease writes its own result, so the delivered one is not overwritten
+        stem = Path(current.img_name).stem
+        name = stem if current.lease is None else f"{stem}.{current.lease}"
+        result_path = Path("result_photos") / f"{name}.tif"
+        predictor = self.model if self.scheduler is None else self.scheduler
+        # Without cropping the image is still cut into windows of the model input size, resizing is impossible
+        process_large_image(predictor, current.image, result_path, current.threshold,
+                            window_size=self.crop_size if self.use_crop else self.model_input_size,
+                            overlap=self.overlap, blend=self.blend,
+                            memory_budget_bytes=self.large_image_memory_mb * 1024 ** 2)
+        if not self.__complete(current):
+            Controller.__remove_file(result_path)
+            return
+        # Input is kept for retries until the job is completed
+        if not self.save_results:
+            Controller.__remove_file(current.image)
+        self.callback(result_path, current.chat_id, None, image_name=current.img_name)
+
+    def __deliver(self, current: Artifact, *args, **kwargs) -> None:
+        """Pass the result to callback"""
+        if self.__complete(current):
+            self.callback(*args, **kwargs)
+
+    def __complete(self, current: Artifact) -> bool:
+        """
+        :return: whether the result should be delivered. Job processed twice after an expired lease is delivered once
+        """
+        return self.job_queue is None or self.job_queue.complete(current)
+
+    @staticmethod
+    def __remove_file(path: Path) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # removed by the worker of another lease
+
+    def __predict(self, raw_input: np.ndarray) -> np.ndarray:
+        """Run the model, returns probabilities"""
+        if self.use_crop:
+            # Windows are preprocessed one by one, so raw image is passed
+            predictor = self.model if self.scheduler is None else self.scheduler
+            return predictor.predict_proba_sliding(
+                raw_input, window_size=self.crop_size, overlap=self.overlap, blend=self.blend)
+
+        model_input = preprocess(resize_to_model_input(raw_input, self.model_input_size))
+        return self.model.predict_proba(model_input)
 
-        self.callback(result_path, current.chat_id, mask, image_name=current.img_name)
+    @staticmethod
+    def __load_input(current: Artifact) -> np.ndarray:
+        """Get RGB image of the artifact from memory or from disk if it is not in memory"""
+        if isinstance(current.image, np.ndarray):
+            return current.image
+        if current.image is not None:
+            return decode_image(current.image)
+        return load_image(Path(f"input_photos/{current.img_name}"))
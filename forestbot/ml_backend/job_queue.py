@@ -0,0 +1,261 @@
+from forestbot.ml_backend.controller import Artifact
+from threading import Condition
+from pathlib import Path
+from typing import Union
+import numpy as np
+import sqlite3
+import sys
+import queue
+import time
+import uuid
+import io
+
+
+class JobQueue:
+    """
+    Persistent queue of images for the Controller, so jobs survive restarts and crashes.
+    A taken job is leased for a visibility timeout, which the worker renews while it processes the job.
+    If the lease is neither renewed nor the job completed in time, e.g. the worker died, the job is given
+    to another worker. Failed jobs are retried with exponential backoff.
+    Jobs left running by the previous process are pending again after the start.
+    Chats share the workers fairly: jobs are ordered by weighted fair queueing with the number of pixels as cost.
+    Every job gets a virtual finish time, start of the job plus its cost, and the job finishing first is taken.
+    So a chat with many images does not delay the others, and small images overtake large ones.
+    Images of jobs which are not persistent are kept in memory, only their scheduling data is in the database.
+    Has the same put and get as queue.Queue
+    """
+    default_cost = 1000 * 1000  # pixels of an image of unknown size
+
+    def __init__(self, path: Union[Path, str], visibility_timeout: float = 15 * 60, max_attempts: int = 3,
+                 retry_backoff: float = 5.0, max_running_per_chat: int = None, max_queued_per_chat: int = None):
+        """
+        :param path: database file, ":memory:" for a queue which is not persistent
+        :param visibility_timeout: time in seconds a taken job is hidden from other workers
+        :param max_attempts: max number of attempts to process a job
+        :param retry_backoff: delay before the first retry in seconds, doubled for every next one
+        :param max_running_per_chat: (optional) max number of images of a chat processed at the same time
+        :param max_queued_per_chat: (optional) max number of pending and running jobs of a chat
+        """
+        self.path = path
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.max_running_per_chat = max_running_per_chat
+        self.max_queued_per_chat = max_queued_per_chat
+        self.condition = Condition()
+        self.woken_up = 0
+        self.images = dict()  # job_id -> image of a job which is not persistent, used under the lock
+
+        # Connection is used under the lock of the condition
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER, img_name TEXT, threshold REAL, "
+                "image_kind TEXT, image BLOB, persistent INTEGER, created_at REAL, "
+                "state TEXT, attempts INTEGER DEFAULT 0, available_at REAL, lease TEXT, "
+                "virtual_start REAL, virtual_finish REAL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_by_finish ON jobs (virtual_finish, id)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_by_chat ON jobs (chat_id, state)")
+            # Results of jobs which are not persistent are not expected anymore, others are replayed.
+            # Job which was running at every crash is dropped after max_attempts, it could be the cause
+            self.connection.execute("DELETE FROM jobs WHERE persistent = 0 OR (state = 'running' AND attempts >= ?)",
+                                    (max_attempts,))
+            self.connection.execute("UPDATE jobs SET state = 'pending', lease = NULL, available_at = ? "
+                                    "WHERE state = 'running'", (time.time(),))
+        # Virtual time is the start of the last taken job, replayed jobs continue from the earliest one
+        self.virtual_time = self.connection.execute("SELECT MIN(virtual_start) FROM jobs").fetchone()[0] or 0.0
+
+    def put(self, artifact: Artifact) -> int:
+        """
+        :param Artifact artifact: job, it is kept only in memory if artifact.persistent is False
+        :return: number of jobs which will be started before this one, if no more jobs come
+        :raises queue.Full: the chat has max_queued_per_chat jobs already
+        """
+        # Image is serialized before taking the lock, jobs which are not persistent keep it as is
+        image_kind, image = JobQueue.serialize_image(artifact.image) if artifact.persistent else ("memory", None)
+        # Time in queue is stored as wall clock time, monotonic one is not valid after restart
+        created_at = time.time() - (time.monotonic() - artifact.enqueue_time)
+        with self.condition:
+            with self.connection:
+                n_queued, last_finish = self.connection.execute(
+                    "SELECT COUNT(*), MAX(virtual_finish) FROM jobs WHERE chat_id = ?", (artifact.chat_id,)).fetchone()
+                if self.max_queued_per_chat is not None and n_queued >= self.max_queued_per_chat:
+                    raise queue.Full
+                # Job of a chat starts after its previous job, or now if the chat has no jobs
+                virtual_start = max(self.virtual_time, last_finish or 0.0)
+                virtual_finish = virtual_start + JobQueue.get_cost(artifact)
+                artifact.job_id = self.connection.execute(
+                    "INSERT INTO jobs (chat_id, img_name, threshold, image_kind, image, persistent, created_at, "
+                    "state, available_at, virtual_start, virtual_finish) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, 'pending', ?, ?, ?)",
+                    (artifact.chat_id, artifact.img_name, artifact.threshold, image_kind, image,
+                     int(artifact.persistent), created_at, created_at, virtual_start, virtual_finish)).lastrowid
+                position = self.connection.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE state = 'pending' AND "
+                    "(virtual_finish < ? OR virtual_finish = ? AND id < ?)",
+                    (virtual_finish, virtual_finish, artifact.job_id)).fetchone()[0]
+            if not artifact.persistent:
+                self.images[artifact.job_id] = artifact.image
+            self.condition.notify()
+        return position
+
+    def get(self, timeout: float = None) -> Artifact:
+        """
+        Take the oldest available job and lease it to the caller
+        :return: Artifact with job_id and lease
+        :raises queue.Empty: no job in timeout or woken up by wake_up
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while True:
+                if self.woken_up:
+                    self.woken_up -= 1
+                    raise queue.Empty
+                artifact = self.__take()
+                if artifact is not None:
+                    return artifact
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise queue.Empty
+                # Delayed retries and expired leases become available without notification
+                self.condition.wait(self.retry_backoff if remaining is None else min(remaining, self.retry_backoff))
+
+    def wake_up(self, n: int = 1) -> None:
+        """Make n calls of get return without a job, e.g. to stop workers"""
+        with self.condition:
+            self.woken_up += n
+            self.condition.notify(n)
+
+    def complete(self, artifact: Artifact) -> bool:
+        """
+        Mark the job as done. Only the worker holding the current lease succeeds,
+        so the result of a job processed twice after an expired lease is delivered once
+        :return: whether the caller should deliver the result
+        """
+        with self.condition, self.connection:
+            # Next job of the chat could be waiting for this one because of max_running_per_chat
+            self.condition.notify()
+            if self.connection.execute("DELETE FROM jobs WHERE id = ? AND lease = ?",
+                                       (artifact.job_id, artifact.lease)).rowcount == 0:
+                return False
+            self.images.pop(artifact.job_id, None)
+            return True
+
+    def renew(self, artifact: Artifact) -> bool:
+        """
+        Extend the lease for another visibility timeout, workers call it while they process long jobs
+        :return: whether the caller still holds the lease
+        """
+        with self.condition, self.connection:
+            return self.connection.execute("UPDATE jobs SET available_at = ? WHERE id = ? AND lease = ?",
+                                           (time.time() + self.visibility_timeout, artifact.job_id,
+                                            artifact.lease)).rowcount == 1
+
+    def fail(self, artifact: Artifact) -> bool:
+        """
+        Return the job to the queue with a delay, or drop it after max_attempts
+        :return: whether the job will be processed again, by this or another worker
+        """
+        with self.condition, self.connection:
+            self.condition.notify()
+            job = self.connection.execute("SELECT attempts, lease FROM jobs WHERE id = ?",
+                                          (artifact.job_id,)).fetchone()
+            if job is None:
+                return False  # Done by another worker or dropped
+            attempts, lease = job
+            if lease != artifact.lease:
+                return True  # Leased to another worker after the lease of this one expired
+            if attempts >= self.max_attempts:
+                self.connection.execute("DELETE FROM jobs WHERE id = ?", (artifact.job_id,))
+                self.images.pop(artifact.job_id, None)
+                return False
+            self.connection.execute(
+                "UPDATE jobs SET state = 'pending', lease = NULL, available_at = ? WHERE id = ?",
+                (time.time() + self.retry_backoff * 2 ** (attempts - 1), artifact.job_id))
+            return True
+
+    def get_n_queued(self, chat_id: int) -> int:
+        """Number of pending and running jobs of the chat"""
+        with self.condition:
+            return self.connection.execute("SELECT COUNT(*) FROM jobs WHERE chat_id = ?", (chat_id,)).fetchone()[0]
+
+    def get_queued_cost(self) -> float:
+        """Total cost of pending and running jobs, see get_cost"""
+        with self.condition:
+            return self.connection.execute(
+                "SELECT COALESCE(SUM(virtual_finish - virtual_start), 0) FROM jobs").fetchone()[0]
+
+    def __len__(self) -> int:
+        """Number of pending and running jobs"""
+        with self.condition:
+            return self.connection.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+
+    def __take(self) -> Artifact:
+        """Lease the next job, caller holds the lock"""
+        now = time.time()
+        with self.connection:
+            dropped = self.connection.execute(
+                "SELECT id FROM jobs WHERE state = 'running' AND available_at <= ? AND attempts >= ?",
+                (now, self.max_attempts)).fetchall()
+            self.connection.executemany("DELETE FROM jobs WHERE id = ?", dropped)
+            for job_id, in dropped:
+                self.images.pop(job_id, None)
+            # Chats with max_running_per_chat jobs under a valid lease wait
+            row = self.connection.execute(
+                "SELECT id, chat_id, img_name, threshold, image_kind, image, persistent, created_at, attempts, "
+                "virtual_start, virtual_finish FROM jobs AS job "
+                "WHERE state IN ('pending', 'running') AND available_at <= ? AND "
+                "(SELECT COUNT(*) FROM jobs WHERE chat_id = job.chat_id AND state = 'running' AND available_at > ?) "
+                "< ? ORDER BY virtual_finish, id LIMIT 1",
+                (now, now, sys.maxsize if self.max_running_per_chat is None else self.max_running_per_chat)).fetchone()
+            if row is None:
+                return None
+            job_id, chat_id, img_name, threshold, image_kind, image, persistent, created_at, attempts, \
+                virtual_start, virtual_finish = row
+            self.virtual_time = max(self.virtual_time, virtual_start)
+            lease = uuid.uuid4().hex
+            # For a running job available_at is the end of its lease
+            self.connection.execute(
+                "UPDATE jobs SET state = 'running', lease = ?, attempts = ?, available_at = ? WHERE id = ?",
+                (lease, attempts + 1, now + self.visibility_timeout, job_id))
+
+        # Image of a job which is not persistent stays in memory until the job is done, it could be retried
+        image = self.images.get(job_id) if image_kind == "memory" else JobQueue.deserialize_image(image_kind, image)
+        artifact = Artifact(chat_id, img_name, threshold, image=image, persistent=bool(persistent),
+                            n_pixels=virtual_finish - virtual_start)
+        artifact.enqueue_time = time.monotonic() - (now - created_at)
+        artifact.job_id = job_id
+        artifact.lease = lease
+        return artifact
+
+    @staticmethod
+    def get_cost(artifact: Artifact) -> float:
+        """Cost of the job is the number of pixels of the image"""
+        if isinstance(artifact.image, np.ndarray):
+            return artifact.image.shape[0] * artifact.image.shape[1]
+        return JobQueue.default_cost if artifact.n_pixels is None else artifact.n_pixels
+
+    @staticmethod
+    def serialize_image(image):
+        """:return: (kind of the image, content for the database)"""
+        if image is None:
+            return "none", None
+        if isinstance(image, Path):
+            return "path", str(image)
+        if isinstance(image, np.ndarray):
+            buffer = io.BytesIO()
+            np.save(buffer, image, allow_pickle=False)
+            return "array", buffer.getvalue()
+        return "bytes", bytes(image)
+
+    @staticmethod
+    def deserialize_image(image_kind: str, image):
+        if image_kind == "path":
+            return Path(image)
+        if image_kind == "array":
+            return np.load(io.BytesIO(image), allow_pickle=False)
+        if image_kind == "bytes":
+            return bytes(image)
+        return None
@@ -0,0 +1,65 @@
+from forestbot.ml_backend.utils import postprocess
+from rasterio.windows import Window
+from rasterio.errors import NotGeoreferencedWarning
+from pathlib import Path
+import numpy as np
+import rasterio
+import warnings
+import cv2
+
+block_size = 256  # side of the tiles of the output file, bands are aligned to it
+# Memory used for each pixel of a band: uint8 RGB input, which becomes the result in place,
+# float32 prediction and blending weights, uint8 mask
+bytes_per_pixel = 3 + 4 + 4 + 1
+
+
+def get_band_height(width: int, margin: int, memory_budget_bytes: int) -> int:
+    """
+    :return: number of rows processed at once, a multiple of block_size
+    """
+    rows = memory_budget_bytes // (width * bytes_per_pixel) - 2 * margin
+    return max(block_size, rows // block_size * block_size)
+
+
+def read_rows(src, start: int, stop: int) -> np.ndarray:
+    """Read rows of the image as contiguous RGB array of shape (H, W, 3)"""
+    bands = [1, 2, 3] if src.count >= 3 else [1, 1, 1]
+    data = src.read(bands, window=Window(0, start, src.width, stop - start))
+    return np.ascontiguousarray(data.transpose(1, 2, 0))
+
+
+def process_large_image(predictor, src_path: Path, dst_path: Path, threshold: float, window_size: int,
+                        overlap: float, blend: str, memory_budget_bytes: int) -> None:
+    """
+    Predict and postprocess image by bands of rows, so memory does not depend on the height of the image.
+    Each band is read with a margin of context above and below, which is dropped after prediction.
+    Result is written to tiled TIFF band by band
+    :param predictor: object with predict_proba_sliding, e.g. Model or BatchScheduler
+    :param Path src_path: image in any format readable by GDAL
+    :param Path dst_path: where to write the result, RGB TIFF
+    :param float threshold: threshold for prediction
+    :param int window_size: size of the sliding window
+    :param float overlap: overlap of the sliding windows
+    :param str blend: blending of the sliding windows
+    :param int memory_budget_bytes: approximate memory for a band
+    """
+    margin = window_size // 2
+    with warnings.catch_warnings():
+        # Photos have no georeference, it is fine
+        warnings.simplefilter("ignore", NotGeoreferencedWarning)
+        with rasterio.open(src_path) as src, rasterio.open(
+                dst_path, 'w', driver='GTiff', width=src.width, height=src.height, count=3, dtype=np.uint8,
+                tiled=True, blockxsize=block_size, blockysize=block_size, compress='jpeg', photometric='ycbcr',
+                jpeg_quality=90) as dst:
+            band_height = get_band_height(src.width, margin, memory_budget_bytes)
+            for start in range(0, src.height, band_height):
+                stop = min(start + band_height, src.height)
+                read_start, read_stop = max(0, start - margin), min(src.height, stop + margin)
+                rows = read_rows(src, read_start, read_stop)
+                prediction = predictor.predict_proba_sliding(rows, window_size=window_size, overlap=overlap,
+                                                             blend=blend)
+
+                band = rows[start - read_start:stop - read_start]
+                result, _ = postprocess(band, prediction[start - read_start:stop - read_start], threshold)
+                cv2.cvtColor(result, cv2.COLOR_BGR2RGB, dst=result)
+                dst.write(result.transpose(2, 0, 1), window=Window(0, start, src.width, stop - start))
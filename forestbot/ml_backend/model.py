@@ -1,47 +1,158 @@
-import segmentation_models_pytorch as smp
 import numpy as np
-from forestbot.ml_backend.utils import resize_to_model_input
+from forestbot.ml_backend.sliding_window import SlidingWindow
 from pathlib import Path
 from tqdm import tqdm
 import onnxruntime
+import warnings
 
 
 class Model:
     """
     Entity for ML model
     """
+    default_batch_size = 8
+    model_variants = {
+        "fp32": Path('forestbot/processes/model.onnx'),
+        "int8_dynamic": Path('forestbot/processes/model.int8_dynamic.onnx'),
+        "int8_static": Path('forestbot/processes/model.int8_static.onnx')
+    }  # INT8 variants are made by processes/convert_to_onnx.py
+    model_variant = "fp32"  # check quality of INT8 variants with processes/compare_quantized.py before using them
 
-    def __init__(self, input_size):
-        self.model = smp.Unet(classes=1, decoder_attention_type="scse")
-        model_path = Path('forestbot/processes/model.onnx')
-        self.model = onnxruntime.InferenceSession(str(model_path))
+    # ONNX Runtime session config
+    providers = ['CPUExecutionProvider']
+    graph_optimization_level = "all"  # "disable", "basic", "extended" or "all"
+    execution_mode = "sequential"  # "sequential" or "parallel". Parallel runs independent graph branches at once
+    inter_op_num_threads = None  # threads for graph branches, used only in parallel mode. None means ORT default
+    enable_cpu_mem_arena = True  # reuse allocated memory between runs. Faster, but memory is not given back
+    enable_mem_pattern = True  # preallocate memory based on previous runs with the same input shape
+    cache_optimized_model = True  # save optimized graph next to the model and load it on next start, see
+    # get_cached_optimization_level
+
+    optimization_levels = {
+        "disable": onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+        "basic": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+        "extended": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+        "all": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    }
+    execution_modes = {
+        "sequential": onnxruntime.ExecutionMode.ORT_SEQUENTIAL,
+        "parallel": onnxruntime.ExecutionMode.ORT_PARALLEL
+    }
+
+    def __init__(self, input_size, batch_size=None, n_threads=None):
+        """
+        :param input_size: size of the model input
+        :param batch_size: max number of crops passed to the model at once
+        :param n_threads: number of threads for a single run. Session is shared, so it limits all workers together
+        """
+        self.model = Model.create_session(Model.model_variants[Model.model_variant], n_threads=n_threads)
         self.input_name = self.model.get_inputs()[0].name
         self.input_size = input_size
+        self.batch_size = Model.default_batch_size if batch_size is None else batch_size
+
+        batch_dim = self.model.get_inputs()[0].shape[0]
+        self.fixed_batch_size = batch_dim if isinstance(batch_dim, int) else None
+        if self.fixed_batch_size is not None and self.fixed_batch_size != self.batch_size:
+            warnings.warn(f"Model is exported with fixed batch size {batch_dim}. "
+                          f"Re-export it with processes/convert_to_onnx.py to enable batching")
+            self.batch_size = self.fixed_batch_size
+
+    @classmethod
+    def create_session(cls, model_path: Path, n_threads=None) -> onnxruntime.InferenceSession:
+        """
+        Create ONNX Runtime session using session config of the class
+        :param Path model_path: path to the .onnx model
+        :param n_threads: number of threads for a single run. None means ORT default
+        :return: inference session
+        """
+        level = cls.graph_optimization_level
+        if cls.cache_optimized_model and level != "disable":
+            cached_level = cls.get_cached_optimization_level()
+            optimized_path = cls.get_optimized_model_path(model_path)
+            if not optimized_path.is_file() or optimized_path.stat().st_mtime < model_path.stat().st_mtime:
+                # Graph is saved by the session which optimizes it, a separate one if the level is not cached
+                session_options = cls.__create_session_options(cached_level, n_threads)
+                session_options.optimized_model_filepath = str(optimized_path)
+                session = onnxruntime.InferenceSession(str(model_path), sess_options=session_options,
+                                                       providers=cls.providers)
+                if level == cached_level:
+                    return session
+            model_path = optimized_path
+            if level == cached_level:
+                # Graph is already optimized, so there is no need to do it again
+                level = "disable"
+
+        session_options = cls.__create_session_options(level, n_threads)
+        return onnxruntime.InferenceSession(str(model_path), sess_options=session_options, providers=cls.providers)
+
+    @classmethod
+    def __create_session_options(cls, level: str, n_threads=None) -> onnxruntime.SessionOptions:
+        session_options = onnxruntime.SessionOptions()
+        session_options.graph_optimization_level = cls.optimization_levels[level]
+        session_options.execution_mode = cls.execution_modes[cls.execution_mode]
+        session_options.enable_cpu_mem_arena = cls.enable_cpu_mem_arena
+        session_options.enable_mem_pattern = cls.enable_mem_pattern
+        if n_threads is not None:
+            session_options.intra_op_num_threads = n_threads
+        if cls.inter_op_num_threads is not None:
+            session_options.inter_op_num_threads = cls.inter_op_num_threads
+        return session_options
+
+    @classmethod
+    def get_cached_optimization_level(cls) -> str:
+        """
+        Level of the cached optimized graph. Layout optimizations of "all" depend on the CPU,
+        so a graph saved with them could be wrong on another host. They are applied on every start instead
+        """
+        return "extended" if cls.graph_optimization_level == "all" else cls.graph_optimization_level
+
+    @classmethod
+    def get_optimized_model_path(cls, model_path: Path) -> Path:
+        """Path of the cached optimized graph. It depends on the optimization level"""
+        return model_path.with_name(f"{model_path.stem}.{cls.get_cached_optimization_level()}.optimized.onnx")
 
     @staticmethod
     def sigmoid(x):
         return 1 / (1 + np.exp(-x))
 
-    def predict_proba_crop(self, input: np.ndarray, crop_size: int) -> np.ndarray:
-        """
-        Make prediction
-        """
-        lines = []
-        for i in tqdm(np.arange(input.shape[0] // crop_size)):
-            line = []
-            for j in np.arange(input.shape[1] // crop_size):
-                crop = input[
-                       i * crop_size:(i + 1) * crop_size,
-                       j * crop_size:(j + 1) * crop_size
-                       ]
-                crop = resize_to_model_input(crop, self.input_size)
-                model_input = np.expand_dims(np.array(crop).transpose(2, 0, 1), axis=0)
-                model_output = np.array(self.model.run(None, {self.input_name: model_input})).squeeze()
-                line.append(model_output)
-            lines.append(line)
-
-        result = Model.sigmoid(np.block(lines))
-        return result
+    @staticmethod
+    def sigmoid_inplace(x: np.ndarray) -> np.ndarray:
+        """Sigmoid without temporary arrays, input is overwritten"""
+        np.negative(x, out=x)
+        np.exp(x, out=x)
+        x += 1
+        return np.reciprocal(x, out=x)
+
+    def run(self, batch: np.ndarray) -> np.ndarray:
+        """
+        Run model once
+        :param np.ndarray batch: model input of shape (N, 3, H, W), N must fit the model batch size
+        :return np.ndarray: raw model output of shape (N, H, W)
+        """
+        model_output = self.model.run(None, {self.input_name: batch})[0]
+        return model_output.reshape(-1, *model_output.shape[-2:])
+
+    def predict_proba_sliding(self, input: np.ndarray, window_size: int, overlap: float = 0.25,
+                              blend: str = "gaussian") -> np.ndarray:
+        """
+        Make prediction with overlapping windows. Outputs are blended, so there are no seams between windows
+        :param np.ndarray input: image of any size, raw uint8 or preprocessed
+        :param int window_size: side of each window in image pixels
+        :param float overlap: part of the window shared with the neighbour. Higher is more accurate, but slower
+        :param str blend: weighting of overlapping outputs, "gaussian" or "linear"
+        :return np.ndarray: prediction result of the same size as input
+        """
+        window = SlidingWindow(input.shape, window_size=window_size, overlap=overlap, blend=blend)
+        input = window.pad(input)
+        batch = np.empty((self.batch_size, input.shape[2], self.input_size, self.input_size), dtype=np.float32)
+
+        for start in tqdm(range(0, len(window), self.batch_size)):
+            indices = range(start, min(start + self.batch_size, len(window)))
+            n_items = window.fill_batch(input, indices, batch)
+            for index, output in zip(indices, self.run(batch[:n_items])):
+                window.add(index, output)
+
+        return Model.sigmoid_inplace(window.result())
 
     def predict_proba(self, input: np.ndarray) -> np.ndarray:
         """
@@ -0,0 +1,116 @@
+from collections import OrderedDict
+from threading import Lock
+from pathlib import Path
+from typing import Union
+import numpy as np
+import hashlib
+import cv2
+import os
+
+
+class PredictionCache:
+    """
+    Cache of model predictions keyed by image content, so repeated images skip the model.
+    Predictions are stored quantized to uint8. Recently used ones are kept in memory,
+    evicted ones are spilled to disk and deleted from there when the disk budget is exceeded.
+    """
+
+    def __init__(self, max_memory_bytes: int, cache_dir: Path = None, max_disk_bytes: int = 0):
+        """
+        :param max_memory_bytes: max total size of predictions kept in memory
+        :param cache_dir: (optional) folder for predictions evicted from memory
+        :param max_disk_bytes: max total size of files in cache_dir
+        """
+        self.max_memory_bytes = max_memory_bytes
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes if cache_dir is not None else 0
+
+        self.memory = OrderedDict()  # key -> prediction, least recently used first
+        self.memory_bytes = 0
+        self.disk = OrderedDict()  # key -> file size, least recently used first
+        self.disk_bytes = 0
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            for path in sorted(self.cache_dir.glob("*.png"), key=lambda x: x.stat().st_mtime):
+                self.disk[path.stem] = path.stat().st_size
+                self.disk_bytes += self.disk[path.stem]
+
+    @staticmethod
+    def get_key(image: np.ndarray, signature: str = "") -> str:
+        """
+        Key of the image content
+        :param np.ndarray image: decoded image
+        :param str signature: settings the prediction depends on, e.g. model and cropping parameters
+        """
+        content_hash = hashlib.blake2b(digest_size=20)
+        content_hash.update(f"{signature}|{image.shape}|{image.dtype}|".encode())
+        content_hash.update(np.ascontiguousarray(image).data)
+        return content_hash.hexdigest()
+
+    def get(self, key: str) -> Union[np.ndarray, None]:
+        """
+        :return: quantized prediction or None if it is not cached
+        """
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key]
+
+            if key in self.disk:
+                prediction = cv2.imread(str(self.__get_path(key)), cv2.IMREAD_UNCHANGED)
+                if prediction is not None:
+                    self.__remove_from_disk(key)
+                    self.__put_to_memory(key, prediction)
+                    self.hits += 1
+                    return prediction
+                self.__remove_from_disk(key)
+
+            self.misses += 1
+            return None
+
+    def put(self, key: str, prediction: np.ndarray) -> None:
+        """
+        :param str key: key of the image content
+        :param np.ndarray prediction: quantized prediction
+        """
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return
+            self.__put_to_memory(key, prediction)
+
+    def __put_to_memory(self, key: str, prediction: np.ndarray) -> None:
+        self.memory[key] = prediction
+        self.memory_bytes += prediction.nbytes
+        while self.memory_bytes > self.max_memory_bytes and self.memory:
+            evicted_key, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= evicted.nbytes
+            self.__spill_to_disk(evicted_key, evicted)
+
+    def __spill_to_disk(self, key: str, prediction: np.ndarray) -> None:
+        if self.max_disk_bytes <= 0:
+            return
+        path = self.__get_path(key)
+        try:
+            cv2.imwrite(str(path), prediction, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+            self.disk[key] = path.stat().st_size
+            self.disk_bytes += self.disk[key]
+        except Exception as e:
+            print(f"Failed to save prediction to cache:\n{e}")
+        while self.disk_bytes > self.max_disk_bytes and self.disk:
+            self.__remove_from_disk(next(iter(self.disk)))
+
+    def __remove_from_disk(self, key: str) -> None:
+        self.disk_bytes -= self.disk.pop(key)
+        try:
+            os.remove(self.__get_path(key))
+        except OSError as e:
+            print(e)
+
+    def __get_path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.png"
@@ -0,0 +1,84 @@
+from forestbot.ml_backend.utils import window_positions, blend_weights, preprocess
+from typing import Tuple, Sequence
+import numpy as np
+import cv2
+
+
+class SlidingWindow:
+    """
+    Splits image into overlapping windows and blends model outputs back into a single prediction
+    """
+
+    def __init__(self, image_shape: Tuple[int, ...], window_size: int, overlap: float = 0.25, blend: str = "gaussian"):
+        """
+        :param image_shape: shape of the image, (H, W, C)
+        :param int window_size: side of each window in image pixels
+        :param float overlap: part of the window shared with the neighbour, from 0 (no overlap) to 1 (exclusive)
+        :param str blend: weighting of overlapping outputs, "gaussian" or "linear"
+        """
+        if not 0 <= overlap < 1:
+            raise ValueError(f"Overlap must be in [0, 1), got {overlap}")
+
+        self.height, self.width = image_shape[:2]
+        self.window_size = window_size
+        self.stride = max(1, round(window_size * (1 - overlap)))
+
+        # Images smaller than the window are padded, bigger ones are covered by windows without resizing
+        padded_height, padded_width = max(self.height, window_size), max(self.width, window_size)
+        self.positions = [(y, x)
+                          for y in window_positions(padded_height, window_size, self.stride)
+                          for x in window_positions(padded_width, window_size, self.stride)]
+
+        self.window_weight = blend_weights(window_size, blend)
+        self.prediction = np.zeros((padded_height, padded_width), dtype=np.float32)
+        self.weights = np.zeros((padded_height, padded_width), dtype=np.float32)
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def pad(self, image: np.ndarray) -> np.ndarray:
+        """Pad image to cover at least one window"""
+        pad_bottom = self.prediction.shape[0] - self.height
+        pad_right = self.prediction.shape[1] - self.width
+        if pad_bottom == 0 and pad_right == 0:
+            return image
+        return cv2.copyMakeBorder(image, 0, pad_bottom, 0, pad_right, cv2.BORDER_REFLECT_101)
+
+    def fill_batch(self, image: np.ndarray, indices: Sequence[int], batch: np.ndarray) -> int:
+        """
+        Copy windows into preallocated model input. Raw uint8 windows are preprocessed on the way,
+        so the whole image never has to be converted to float32
+        :param np.ndarray image: padded image of shape (H, W, C), raw uint8 or preprocessed float32
+        :param indices: indices of windows to copy
+        :param np.ndarray batch: buffer of shape (>= len(indices), C, S, S), S is model input size
+        :return int: number of filled items
+        """
+        input_size = batch.shape[-1]
+        for k, index in enumerate(indices):
+            y, x = self.positions[index]
+            window = image[y:y + self.window_size, x:x + self.window_size]
+            if input_size != self.window_size:
+                window = cv2.resize(window, (input_size, input_size), interpolation=cv2.INTER_LINEAR)
+            if window.dtype == np.uint8:
+                preprocess(window.transpose(2, 0, 1), out=batch[k])
+            else:
+                batch[k] = window.transpose(2, 0, 1)
+        return len(indices)
+
+    def add(self, index: int, output: np.ndarray) -> None:
+        """
+        Accumulate model output for a window
+        :param int index: index of the window
+        :param np.ndarray output: model output of shape (S, S)
+        """
+        if output.shape[0] != self.window_size:
+            output = cv2.resize(output, (self.window_size, self.window_size), interpolation=cv2.INTER_LINEAR)
+        y, x = self.positions[index]
+        area = np.s_[y:y + self.window_size, x:x + self.window_size]
+        self.prediction[area] += output * self.window_weight
+        self.weights[area] += self.window_weight
+
+    def result(self) -> np.ndarray:
+        """Blended prediction of the original image shape"""
+        np.divide(self.prediction, self.weights, out=self.prediction)
+        return self.prediction[:self.height, :self.width]
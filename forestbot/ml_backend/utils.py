@@ -1,46 +1,56 @@
 import numpy as np
 import cv2
-from typing import Tuple
+from typing import Tuple, List
+from pathlib import Path
 
 
-def align(size: int, target_size: int) -> int:
+def load_image(path: Path) -> np.ndarray:
     """
-    Bring the number to target_size * n
-    :param int target_size: value by which result should be divided by
-    :param int size: original number
-    :return int: closest target_size * n number to original
+    Read image from disk
+    :param Path path: path to the image
+    :return np.ndarray: writable RGB image of shape (H, W, 3)
     """
-    if size < target_size:
-        return target_size
+    image = cv2.imread(str(path), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError(f"Failed to read image {path}")
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=image)
 
-    if size % target_size < target_size / 2:
-        return (size // target_size) * target_size
-    else:
-        return (size // target_size + 1) * target_size
 
+def decode_image(buffer: bytes) -> np.ndarray:
+    """
+    Decode image file content without touching the disk
+    :param bytes buffer: content of .png, .jpg or other image file
+    :return np.ndarray: writable RGB image of shape (H, W, 3)
+    """
+    image = cv2.imdecode(np.frombuffer(buffer, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Failed to decode image")
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=image)
 
-def preprocess(image: np.ndarray) -> np.ndarray:
+
+def encode_image(image: np.ndarray, file_format: str = ".png") -> bytes:
     """
-    Preprocess image before passing into the model, bring numbers to (0, 1)
-    :param np.ndarray image: input image converted to np
-    :return np.ndarray: preprocessed image
+    Encode image into file content without touching the disk
+    :param np.ndarray image: BGR image
+    :param str file_format: extension of the file, e.g. ".png" or ".jpg"
+    :return bytes: content of the file
     """
-    image = image.astype(np.float32) / 255.0
-    return image
+    success, buffer = cv2.imencode(file_format, image)
+    if not success:
+        raise ValueError(f"Failed to encode image to {file_format}")
+    return buffer.tobytes()
 
 
-def resize_for_cropping(image: np.ndarray, crop_size: int) -> np.ndarray:
+def preprocess(image: np.ndarray, out: np.ndarray = None) -> np.ndarray:
     """
-    Make image size suit for cropping
-    :param np.ndarray image: input image
-    :param crop_size: size of each crop
-    :return np.ndarray: resized image
+    Preprocess image before passing into the model, bring numbers to (0, 1)
+    :param np.ndarray image: input image converted to np
+    :param np.ndarray out: (optional) float32 array to write result into instead of allocating a new one
+    :return np.ndarray: preprocessed image
     """
-    image = cv2.resize(
-        image,
-        (align(image.shape[0], target_size=crop_size), align(image.shape[1], target_size=crop_size)),
-        interpolation=cv2.INTER_NEAREST
-    )
+    if out is not None:
+        return np.divide(image, 255.0, out=out, casting="unsafe")
+    image = image.astype(np.float32) / 255.0
     return image
 
 
@@ -52,22 +62,90 @@ def resize_to_model_input(image: np.ndarray, model_input_size: int) -> np.ndarra
 
 def postprocess(original_img: np.ndarray, prediction: np.ndarray, threshold: float) -> Tuple[np.ndarray, np.ndarray]:
     """
-    Postprocess prediction. Apply threshold, bring to original shape and combine with original image
-    :param np.ndarray original_img: original image
-    :param np.ndarray prediction: model prediction
+    Postprocess prediction. Apply threshold, bring to original shape and combine with original image.
+    Original image is converted to BGR in place and becomes the result, so no full-size copies are made
+    :param np.ndarray original_img: original RGB image, writable
+    :param np.ndarray prediction: model prediction, float or quantized to uint8
     :param float threshold: threshold for prediction
-    :return: (combined prediction and image, mask for convert to osm)
+    :return: (combined prediction and image in BGR, mask for convert to osm)
     """
-    cool_color_bgr = [235, 56, 226]
-    prediction = cv2.resize(prediction, original_img.shape[0:2][::-1], interpolation=cv2.INTER_NEAREST)
+    cool_color_bgr = (235, 56, 226, 0)
+    if prediction.dtype == np.uint8:
+        # q / 255 >= threshold is the same as q >= ceil(threshold * 255) for integer q
+        threshold = float(np.ceil(threshold * 255))
+    if prediction.shape != original_img.shape[:2]:
+        prediction = cv2.resize(prediction, original_img.shape[0:2][::-1], interpolation=cv2.INTER_NEAREST)
 
-    prediction[prediction < threshold] = 0
-    prediction[prediction >= threshold] = 1
-    prediction = (prediction * 255).astype("uint8")
+    # 255 where prediction >= threshold, 0 otherwise
+    mask = cv2.compare(prediction, threshold, cv2.CMP_GE)
 
-    roads = cv2.cvtColor(prediction, cv2.COLOR_GRAY2BGR)
-    roads[np.where((roads == [255, 255, 255]).all(axis=2))] = cool_color_bgr
+    result = cv2.cvtColor(original_img, cv2.COLOR_RGB2BGR, dst=original_img)
+    cv2.add(result, cool_color_bgr, dst=result, mask=mask)
 
-    result = cv2.add(roads, cv2.cvtColor(original_img, cv2.COLOR_RGB2BGR))
+    return result, mask
+
+
+def quantize_prediction(prediction: np.ndarray) -> np.ndarray:
+    """
+    Compact prediction for storing, probability p is stored as round(p * 255)
+    :param np.ndarray prediction: probabilities in [0, 1]
+    :return np.ndarray: uint8 prediction of the same shape
+    """
+    return cv2.convertScaleAbs(prediction, alpha=255)
+
+
+def split_to_crops(image: np.ndarray, crop_size: int, target_size: int = None) -> np.ndarray:
+    """
+    Stack image crops into a single model input. Crops are taken row by row
+    :param np.ndarray image: preprocessed image of shape (H, W, C)
+    :param int crop_size: size of each crop, remainder of the image is dropped
+    :param int target_size: (optional) size every crop should be resized to
+    :return np.ndarray: crops of shape (N, C, target_size, target_size)
+    """
+    n_rows, n_cols = image.shape[0] // crop_size, image.shape[1] // crop_size
+    image = image[:n_rows * crop_size, :n_cols * crop_size]
+
+    if target_size is not None and target_size != crop_size:
+        # Resizing the whole image equals resizing each crop, but it is done in one call
+        image = cv2.resize(image, (n_cols * target_size, n_rows * target_size), interpolation=cv2.INTER_NEAREST)
+        crop_size = target_size
+
+    # Only the final reshape copies the data, crops themselves are views
+    crops = image.reshape(n_rows, crop_size, n_cols, crop_size, image.shape[2]).transpose(0, 2, 4, 1, 3)
+    return crops.reshape(n_rows * n_cols, image.shape[2], crop_size, crop_size)
+
+
+def window_positions(length: int, window_size: int, stride: int) -> List[int]:
+    """
+    Start positions of sliding windows along one axis. The last window is shifted to end exactly at the border
+    :param int length: size of the axis
+    :param int window_size: size of the window
+    :param int stride: distance between starts of neighbouring windows
+    :return List[int]: start positions
+    """
+    if length <= window_size:
+        return [0]
+
+    positions = list(range(0, length - window_size + 1, stride))
+    if positions[-1] != length - window_size:
+        positions.append(length - window_size)
+    return positions
+
+
+def blend_weights(size: int, mode: str = "gaussian") -> np.ndarray:
+    """
+    Weight map for blending overlapping windows. Weights are highest in the center and positive at the borders
+    :param int size: size of the window
+    :param str mode: "gaussian" or "linear"
+    :return np.ndarray: weights of shape (size, size)
+    """
+    coords = (np.arange(size, dtype=np.float32) + 0.5) / size
+    if mode == "gaussian":
+        sigma = 1 / 8
+        line = np.exp(-((coords - 0.5) ** 2) / (2 * sigma ** 2))
+    elif mode == "linear":
+        line = 1 - np.abs(2 * coords - 1)
+    else:
+        raise ValueError(f"Unknown blend mode: {mode}")
 
-    return result, prediction
+    return np.outer(line, line).astype(np.float32)
@@ -0,0 +1,74 @@
+# Compares quantized models with fp32 one on local images
+# Run from the repository root: python -m forestbot.processes.compare_quantized <images_dir> [threshold]
+from forestbot.ml_backend.model import Model
+from forestbot.processes.quantization import load_tiles, iou
+from pathlib import Path
+import numpy as np
+import sys
+import time
+
+max_tiles = 500
+batch_size = 8
+default_threshold = 0.2  # same as ForestBot.default_threshold
+reference_variant = "fp32"
+
+
+def measure(session, tiles: np.ndarray, run_batch_size: int):
+    """
+    Run all tiles through the session
+    :return: (probabilities of shape (N, H, W), average latency per tile in ms)
+    """
+    input_name = session.get_inputs()[0].name
+    session.run(None, {input_name: tiles[:run_batch_size]})  # warm up
+
+    outputs = []
+    start = time.perf_counter()
+    for i in range(0, len(tiles), run_batch_size):
+        outputs.append(session.run(None, {input_name: tiles[i:i + run_batch_size]})[0])
+    latency = (time.perf_counter() - start) / len(tiles) * 1000
+
+    outputs = np.concatenate(outputs)
+    return Model.sigmoid(outputs.reshape(-1, *outputs.shape[-2:])), latency
+
+
+def run_variant(path: Path, tiles: np.ndarray):
+    """:return: (probabilities, latency with batch of 1, latency with batch_size or nan for fixed batch models)"""
+    session = Model.create_session(path)
+    fixed_batch = isinstance(session.get_inputs()[0].shape[0], int)
+    probabilities, latency = measure(session, tiles, 1)
+    batch_latency = measure(session, tiles, batch_size)[1] if not fixed_batch else float("nan")
+    return probabilities, latency, batch_latency
+
+
+def compare(images_dir: Path, threshold: float) -> None:
+    reference_path = Model.model_variants[reference_variant]
+    if not reference_path.is_file():
+        sys.exit(f"Reference model {reference_variant} not found: {reference_path}")
+
+    tiles = load_tiles(images_dir, max_tiles=max_tiles)
+    print(f"Loaded {len(tiles)} tiles from {images_dir}\n")
+
+    # Every variant is compared with fp32, whichever variants are present
+    reference, *reference_latencies = run_variant(reference_path, tiles)
+    print(f"{'variant':<14}{'ms/tile b=1':>12}{f'ms/tile b={batch_size}':>12}"
+          f"{'mean IoU':>10}{'min IoU':>10}{'max |dp|':>10}")
+    print(f"{reference_variant:<14}{reference_latencies[0]:>12.2f}{reference_latencies[1]:>12.2f}")
+    for variant, path in Model.model_variants.items():
+        if variant == reference_variant:
+            continue
+        if not path.is_file():
+            print(f"{variant:<14}not found: {path}")
+            continue
+
+        probabilities, latency, batch_latency = run_variant(path, tiles)
+        masks, reference_masks = probabilities >= threshold, reference >= threshold
+        ious = [iou(mask, reference_mask) for mask, reference_mask in zip(masks, reference_masks)]
+        print(f"{variant:<14}{latency:>12.2f}{batch_latency:>12.2f}"
+              f"{np.mean(ious):>10.4f}{np.min(ious):>10.4f}{np.abs(probabilities - reference).max():>10.4f}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3):
+        print("\nUsage: python -m forestbot.processes.compare_quantized <images_dir> [threshold]\n")
+    else:
+        compare(Path(sys.argv[1]), float(sys.argv[2]) if len(sys.argv) == 3 else default_threshold)
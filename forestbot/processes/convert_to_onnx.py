@@ -1,14 +1,21 @@
+# Run from the repository root: python -m forestbot.processes.convert_to_onnx
+# Resulting .onnx files should be placed into forestbot/processes
 import torch
 import segmentation_models_pytorch as smp
 import onnxruntime
 import numpy as np
 from pathlib import Path
+from forestbot.processes.quantization import load_tiles, quantize_dynamic_int8, quantize_static_int8
 import warnings
 
 warnings.filterwarnings("ignore")
 torch_model_path = Path('model_epoch059_loss0.pt')
 onnx_model_path = Path('model.onnx')
-model_input_shape = (1, 3, 224, 224)
+int8_dynamic_model_path = Path('model.int8_dynamic.onnx')
+int8_static_model_path = Path('model.int8_static.onnx')
+calibration_images_dir = Path('calibration_images')  # images similar to the ones sent by users
+max_calibration_tiles = 200
+model_input_shape = (4, 3, 224, 224)  # any batch size could be used after export
 
 if __name__ == "__main__":
     to_np = np.array
@@ -20,7 +27,9 @@ if __name__ == "__main__":
     torch_model.to("cpu")
     torch_model.eval()
 
-    torch.onnx.export(torch_model, to_tensor(sample_input), onnx_model_path)
+    torch.onnx.export(torch_model, to_tensor(sample_input), onnx_model_path,
+                      input_names=['input'], output_names=['output'],
+                      dynamic_axes={'input': {0: 'batch'}, 'output': {0: 'batch'}})
     onnx_model = onnxruntime.InferenceSession(str(onnx_model_path))
 
     onnx_input_name = onnx_model.get_inputs()[0].name
@@ -31,6 +40,21 @@ if __name__ == "__main__":
     assert np.array_equal(pred_onnx.shape, pred_torch.shape), "shape mismatch"
     assert np.allclose(pred_onnx, pred_torch), "predictions are different"
 
+    single_pred_onnx = to_np(onnx_model.run(None, {onnx_input_name: sample_input[:1]})).squeeze()
+    assert np.allclose(single_pred_onnx, pred_onnx[0], atol=1e-5), "batch axis is not dynamic"
+
     print(f"All tests passed. Model is correct.\nSaved in {onnx_model_path}")
 
+    quantize_dynamic_int8(onnx_model_path, int8_dynamic_model_path)
+    print(f"Dynamic INT8 model saved in {int8_dynamic_model_path}")
+
+    if calibration_images_dir.is_dir():
+        calibration_tiles = load_tiles(calibration_images_dir, model_input_shape[-1], max_calibration_tiles)
+        quantize_static_int8(onnx_model_path, int8_static_model_path, calibration_tiles)
+        print(f"Static INT8 model calibrated on {len(calibration_tiles)} tiles and saved in {int8_static_model_path}")
+    else:
+        print(f"Static INT8 model is skipped: put calibration images into {calibration_images_dir}")
+
+    print("Compare quality and speed of the models with: python -m forestbot.processes.compare_quantized <images_dir>")
+
 
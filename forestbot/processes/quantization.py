@@ -0,0 +1,93 @@
+from forestbot.ml_backend.utils import preprocess, split_to_crops
+from onnxruntime.quantization import (CalibrationDataReader, CalibrationMethod, QuantFormat, QuantType,
+                                      quantize_dynamic, quantize_static, quant_pre_process)
+from pathlib import Path
+from PIL import Image
+import numpy as np
+import onnxruntime
+
+image_formats = ['.png', '.jpeg', '.jpg', '.bmp']
+
+
+def load_tiles(images_dir: Path, tile_size: int = 224, max_tiles: int = None) -> np.ndarray:
+    """
+    Cut images from the folder into model inputs with the preprocessing of the bot. Unlike the bot, tiles do not
+    overlap, are not blended and the remainder of the image is dropped, so models are compared per tile
+    :param Path images_dir: folder with images
+    :param int tile_size: size of the model input
+    :param int max_tiles: (optional) stop after this number of tiles
+    :return np.ndarray: tiles of shape (N, 3, tile_size, tile_size)
+    """
+    tiles = []
+    n_tiles = 0
+    for path in sorted(images_dir.iterdir()):
+        if path.suffix.lower() not in image_formats:
+            continue
+        image = preprocess(np.asarray(Image.open(path).convert("RGB")))
+        if min(image.shape[:2]) < tile_size:
+            continue
+        tiles.append(split_to_crops(image, tile_size))
+        n_tiles += len(tiles[-1])
+        if max_tiles is not None and n_tiles >= max_tiles:
+            break
+
+    if not tiles:
+        raise ValueError(f"No images of at least {tile_size}x{tile_size} found in {images_dir}")
+    return np.concatenate(tiles)[:max_tiles]
+
+
+class TileCalibrationReader(CalibrationDataReader):
+    """
+    Feeds tiles to the static quantization calibrator one by one
+    """
+
+    def __init__(self, tiles: np.ndarray, input_name: str):
+        self.tiles = iter(tiles)
+        self.input_name = input_name
+
+    def get_next(self):
+        tile = next(self.tiles, None)
+        return None if tile is None else {self.input_name: tile[None]}
+
+
+def prepare_for_quantization(model_path: Path, output_path: Path) -> Path:
+    """
+    Run shape inference and graph optimizations recommended before quantization
+    :return Path: path to the prepared model, it should be deleted after quantization
+    """
+    prepared_path = output_path.with_name(f"{output_path.stem}.prepared.onnx")
+    quant_pre_process(str(model_path), str(prepared_path))
+    return prepared_path
+
+
+def quantize_dynamic_int8(model_path: Path, output_path: Path) -> None:
+    """
+    Quantize weights to INT8, activations are quantized on the fly. Does not need calibration data
+    """
+    prepared_path = prepare_for_quantization(model_path, output_path)
+    try:
+        quantize_dynamic(str(prepared_path), str(output_path), per_channel=True, weight_type=QuantType.QUInt8)
+    finally:
+        prepared_path.unlink()
+
+
+def quantize_static_int8(model_path: Path, output_path: Path, calibration_tiles: np.ndarray) -> None:
+    """
+    Quantize weights and activations to INT8 with activation ranges calibrated on real tiles
+    """
+    prepared_path = prepare_for_quantization(model_path, output_path)
+    try:
+        input_name = onnxruntime.InferenceSession(str(prepared_path)).get_inputs()[0].name
+        quantize_static(str(prepared_path), str(output_path), TileCalibrationReader(calibration_tiles, input_name),
+                        quant_format=QuantFormat.QDQ, per_channel=True, activation_type=QuantType.QUInt8,
+                        weight_type=QuantType.QInt8, calibrate_method=CalibrationMethod.MinMax)
+    finally:
+        prepared_path.unlink()
+
+
+def iou(first: np.ndarray, second: np.ndarray) -> float:
+    """Intersection over union of two boolean masks. Two empty masks are equal"""
+    union = np.logical_or(first, second).sum()
+    if union == 0:
+        return 1.0
+    return np.logical_and(first, second).sum() / union
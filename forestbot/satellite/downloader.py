@@ -0,0 +1,108 @@
+from threading import Thread, Lock
+from pathlib import Path
+import asyncio
+import aiohttp
+import os
+
+
+class Downloader:
+    """
+    Downloads files over a shared pool of HTTP connections. Requests run on a background asyncio loop,
+    so any thread can call download and wait for the result
+    """
+    retry_statuses = {429, 500, 502, 503, 504}
+
+    def __init__(self, max_connections: int = 8, max_retries: int = 3, backoff: float = 1.0,
+                 chunk_size: int = 1024 * 1024, timeout: float = 300):
+        """
+        :param max_connections: max number of downloads running at the same time
+        :param max_retries: number of retries after connection errors and responses like 503
+        :param backoff: delay before the first retry in seconds, doubled for every next one
+        :param chunk_size: size of the chunks written to disk
+        :param timeout: max time of a single attempt in seconds
+        """
+        self.max_connections = max_connections
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+
+        self.loop = None
+        self.session = None
+        self.semaphore = None
+        self.thread = None
+        self.start_lock = Lock()
+
+    def start(self) -> None:
+        """Start the loop. Called by the first download, if it was not called before"""
+        with self.start_lock:
+            if self.loop is not None:
+                return
+            loop = asyncio.new_event_loop()
+            self.thread = Thread(target=loop.run_forever, name="downloader_loop", daemon=True)
+            self.thread.start()
+            asyncio.run_coroutine_threadsafe(self.__init_session(), loop).result()
+            self.loop = loop
+
+    def stop(self) -> None:
+        with self.start_lock:
+            if self.loop is None:
+                return
+            asyncio.run_coroutine_threadsafe(self.session.close(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+            self.loop = None
+
+    def download(self, url: str, path: Path) -> Path:
+        """
+        Download the file, blocks until it is done
+        :param url: url of the file
+        :param path: where to save the file, it appears only when the download is complete
+        :return: path
+        """
+        self.start()
+        return asyncio.run_coroutine_threadsafe(self.download_async(url, path), self.loop).result()
+
+    async def download_async(self, url: str, path: Path) -> Path:
+        for attempt in range(self.max_retries + 1):
+            try:
+                # Connection is taken only for the attempt, other downloads use it while this one waits to retry
+                async with self.semaphore:
+                    await self.__download_once(url, path)
+                return path
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                retryable = not isinstance(e, aiohttp.ClientResponseError) or e.status in Downloader.retry_statuses
+                if not retryable or attempt == self.max_retries:
+                    raise
+                print(f"Download failed, retry {attempt + 1}/{self.max_retries}:\n{e}")
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+
+    async def __download_once(self, url: str, path: Path) -> None:
+        # Disk is accessed in the default executor of the loop, so slow writes do not stall other downloads
+        loop = asyncio.get_running_loop()
+        temp_path = path.with_name(f"{path.name}.part")
+        try:
+            async with self.session.get(url, raise_for_status=True) as response:
+                file = await loop.run_in_executor(None, open, temp_path, "wb")
+                try:
+                    async for chunk in response.content.iter_chunked(self.chunk_size):
+                        await loop.run_in_executor(None, file.write, chunk)
+                finally:
+                    await loop.run_in_executor(None, file.close)
+            await loop.run_in_executor(None, os.replace, temp_path, path)
+        finally:
+            await loop.run_in_executor(None, Downloader.__remove_part, temp_path)
+
+    @staticmethod
+    def __remove_part(temp_path: Path) -> None:
+        if temp_path.exists():
+            os.remove(temp_path)
+
+    async def __init_session(self) -> None:
+        # Created inside the loop, aiohttp objects are bound to the loop they are created in
+        self.semaphore = asyncio.Semaphore(self.max_connections)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_connections),
+            timeout=aiohttp.ClientTimeout(total=self.timeout)
+        )
@@ -5,7 +5,6 @@ import time
 import ee
 import os
 
-import requests
 import rasterio
 import pandas as pd
 import zipfile
@@ -13,10 +12,13 @@ import json
 from pathlib import Path
 import warnings
 from banet.geo import open_tif, merge, Region
-from threading import Thread
+from forestbot.satellite.downloader import Downloader
+from concurrent.futures import ThreadPoolExecutor
 
 from tqdm.auto import tqdm
 
+downloader = Downloader(max_connections=8, max_retries=3)  # shared by all downloads
+
 
 class RegionST(Region):
     "Defines a region in space and time with a name, a bounding box and the pixel size."
@@ -143,7 +145,12 @@ def n_least_cloudy(image_collection: ee.ImageCollection, n=5):
 
 
 def download_data(R: RegionST, times, products, bands, path_save, scale=None, max_cloud_fraction=None,
-                  use_least_cloudy=None, download_crop_size=1000, show_progress=False):
+                  use_least_cloudy=None, download_crop_size=1000, show_progress=False, merge_files=True):
+    """
+    :param merge_files: merge segments of each band into {R.name}.download.{band}.tif. Otherwise segment files are
+     kept, so they could be merged in memory
+    :return: files of each downloaded segment, listed in the order of bands
+    """
     if scale is None: scale = R.scale_meters
     orig_name = R.name
     path_save.mkdir(exist_ok=True, parents=True)
@@ -153,25 +160,22 @@ def download_data(R: RegionST, times, products, bands, path_save, scale=None, ma
         sR = [R] if min(R.shape) <= download_crop_size else split_region(R, size=download_crop_size, cls=RegionST)
         fsaves = []
         loop = enumerate(sR) if not show_progress else tqdm(enumerate(sR), total=len(sR))
-        processes = []
-        for j, R in loop:
-            p = Thread(target=download_image, args=(
-                R, bands, fsaves, j, max_cloud_fraction, path_save, products, scale, times, use_least_cloudy))
-            p.Daemon = True
-            processes.append(p)
-            p.start()
-        # download_image(R, bands, fsaves, j, max_cloud_fraction, path_save, products, scale, times, use_least_cloudy)
-        # Merge files
-        for p in processes:
-            p.join()
-        suffix = '.tif'
-        files = path_save.ls(include=[suffix])
-        file_groups = []
-        for band in bands:
-            file_groups.append([f for f in files if band in str(f)])
-        for fs, band in zip(file_groups, bands):
+        # Errors of the segments are raised here instead of being lost in the threads.
+        # Earth Engine calls are blocking, downloads themselves are limited by the downloader
+        with ThreadPoolExecutor(max_workers=min(len(sR), downloader.max_connections)) as executor:
+            for future in [executor.submit(download_image, R, bands, fsaves, j, max_cloud_fraction, path_save,
+                                           products, scale, times, use_least_cloudy) for j, R in loop]:
+                future.result()
+        # Use files written by this call only, other downloads may share the folder
+        segments = [[next(f for file_band, file_j, f in fsaves if file_band == band and file_j == j) for band in bands]
+                    for j in sorted({file_j for _, file_j, _ in fsaves})]
+        if not merge_files:
+            return segments
+        for band_index, band in enumerate(bands):
             fsave = f"{orig_name}.download.{band}.tif"
-            merge_tifs(fs, fsave, delete=True)
+            merge_tifs([segment[band_index] for segment in segments], fsave, delete=True)
+        return [[path_save / f"{orig_name}.download.{band}.tif" for band in bands]]
+    return [[path_save / f'download.{R.name}.{band}.tif' for band in bands]]
 
 
 def download_image(R, bands, fsaves, j, max_cloud_fraction, path_save, products, scale, times, use_least_cloudy):
@@ -205,22 +209,25 @@ def download_image(R, bands, fsaves, j, max_cloud_fraction, path_save, products,
             fnames_full = all([(path_save / f).is_file() for f in fnames_full])
             fnames_partial = all([(path_save / f).is_file() for f in fnames_partial0])
             if not fnames_full:
-                fsaves.append([path_save / f for f in fnames_partial0])
                 if not fnames_partial:
                     url = image.getDownloadURL(
                         # {'scale': scale, 'crs': 'EPSG:3857',
                         {'scale': scale, 'crs': 'EPSG:4326',
                          'region': f'{region}'})
-                    r1 = requests.get(url)
-                    # print(r1.status_code, r1.text)
-                    with open(str(path_save / f'data.{R.name}.zip'), 'wb') as f:
-                        f.write(r1.content)
-                    with zipfile.ZipFile(str(path_save / f'data.{R.name}.zip'), 'r') as f:
-                        for info in f.infolist():
-                            info.filename = f"{R.name}.{info.filename[:-4]}_{j}.tif"
-                            f.extract(info, path=str(path_save))
-                        # files1 = f.namelist()
-                        # f.extractall(str(path_save))
-                    os.remove(str(path_save / f'data.{R.name}.zip'))
+                    zip_path = path_save / f'data.{R.name}_{j}.zip'
+                    downloader.download(url, zip_path)
+                    try:
+                        with zipfile.ZipFile(str(zip_path), 'r') as f:
+                            for info in f.infolist():
+                                band = info.filename[:-4].split('.')[-1]
+                                info.filename = f"{R.name}.{info.filename[:-4]}_{j}.tif"
+                                f.extract(info, path=str(path_save))
+                                fsaves.append((band, j, path_save / info.filename))
+                            # files1 = f.namelist()
+                            # f.extractall(str(path_save))
+                    finally:
+                        os.remove(str(zip_path))
+                else:
+                    fsaves.extend((b, j, path_save / f) for b, f in zip(bands, fnames_partial0))
 
         # print(f"Done with segment {j}")
@@ -1,41 +1,73 @@
-from typing import Callable
+from typing import Callable, BinaryIO
 
 import numpy as np
-import cv2
-
-import xml.etree.ElementTree as ET
-
-
-def generate_osm(mask, coord_transform: Callable):
-    skel = np.zeros(mask.shape, np.uint8)
-    element = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
-    img = mask.copy()
-    for i in range(10):
-        open_morph = cv2.morphologyEx(img, cv2.MORPH_OPEN, element)
-        temp = cv2.subtract(img, open_morph)
-        eroded = cv2.erode(img, element)
-        if i > 0:
-            skel = cv2.bitwise_or(skel, temp)
-        img = eroded.copy()
-        if cv2.countNonZero(img) == 0:
-            break
-
-    cont, _ = cv2.findContours(skel, mode=cv2.RETR_LIST, method=cv2.CHAIN_APPROX_NONE)
-    cont = sorted(cont, key=lambda x: len(x), reverse=True)
-
-    osm = ET.Element("osm", attrib={"version": "0.6"})
-
-    nodes = {}
-    count = 1
-    for way in cont:
-        way_el = ET.SubElement(osm, "way", {"id": str(count), "version": "1"})
-        count += 1
-        for x, y in way.squeeze(1):
-            lat, lon = coord_transform(x, y)
-            if (lat, lon) not in nodes:
-                nodes[(lat, lon)] = count
-                ET.SubElement(osm, "node", {"id": str(count), "lat": str(lat), "lon": str(lon), "version": "1"})
-                count += 1
-            ET.SubElement(way_el, "nd", {"ref": str(nodes[(lat, lon)])})
-
-    return osm
+import gzip
+import io
+
+from forestbot.satellite.skeleton import thin, extract_lines, simplify_line
+
+batch_size = 10000  # number of elements formatted before a write
+
+
+def generate_osm(mask, coord_transform: Callable, pixel_size_m: float = 10.0, tolerance_m: float = 10.0,
+                 min_branch_m: float = 30.0, compress: bool = False) -> bytes:
+    """
+    Roads are thinned to one pixel lines, split at junctions and simplified, so every road is a single way
+    :param mask: mask of roads
+    :param coord_transform: function that accepts arrays of x and y coordinates of pixels
+     and returns arrays of latitudes and longitudes
+    :param pixel_size_m: size of the mask pixel in meters
+    :param tolerance_m: max distance between the road and its way in meters
+    :param min_branch_m: shorter roads with a loose end are considered noise, in meters
+    :param compress: gzip the document, it should be sent as .osm.gz
+    :return: content of .osm file
+    """
+    skeleton = thin(mask)
+    lines = extract_lines(skeleton, min_branch_length=min_branch_m / pixel_size_m)
+    cont = [simplify_line(line, tolerance_m / pixel_size_m) for line in lines]
+
+    buffer = io.BytesIO()
+    if compress:
+        with gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=6) as stream:
+            write_osm(stream, cont, coord_transform)
+    else:
+        write_osm(buffer, cont, coord_transform)
+    return buffer.getvalue()
+
+
+def write_osm(stream: BinaryIO, ways, coord_transform: Callable) -> None:
+    """
+    Write OSM XML document. Elements are formatted in batches and written right away, no document tree is built
+    :param stream: binary file or buffer
+    :param ways: arrays of (x, y) points of ways
+    :param coord_transform: see generate_osm
+    """
+    stream.write(b"<?xml version='1.0' encoding='UTF-8'?>\n<osm version=\"0.6\">\n")
+    if ways:
+        # All points are converted at once, points shared by ways become a single node
+        points = np.concatenate(ways)
+        pixels, point_to_pixel = np.unique(points, axis=0, return_inverse=True)
+        lats, lons = coord_transform(pixels[:, 0], pixels[:, 1])
+
+        first_node_id = len(ways) + 1
+        lats, lons = lats.tolist(), lons.tolist()
+        for start in range(0, len(lats), batch_size):
+            stream.write("".join(
+                f'<node id="{node_id}" lat="{lat}" lon="{lon}" version="1" />\n'
+                for node_id, lat, lon in zip(range(first_node_id + start, first_node_id + len(lats)),
+                                             lats[start:start + batch_size], lons[start:start + batch_size])
+            ).encode())
+
+        node_ids = (point_to_pixel.reshape(-1) + first_node_id).tolist()
+        start = 0
+        batch = []
+        for way_id, way in enumerate(ways, start=1):
+            batch.append(f'<way id="{way_id}" version="1">')
+            batch.extend(f'<nd ref="{node_id}" />' for node_id in node_ids[start:start + len(way)])
+            batch.append('</way>\n')
+            start += len(way)
+            if len(batch) >= batch_size:
+                stream.write("".join(batch).encode())
+                batch = []
+        stream.write("".join(batch).encode())
+    stream.write(b"</osm>\n")
@@ -0,0 +1,60 @@
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Sequence, Tuple, List
+from rasterio.io import MemoryFile
+from rasterio.merge import merge
+from rasterio.warp import calculate_default_transform, reproject, Resampling
+from affine import Affine
+from rasterio.crs import CRS
+import numpy as np
+import rasterio
+
+# Raster in memory: (data of shape (bands, H, W), transform, crs)
+Raster = Tuple[np.ndarray, Affine, CRS]
+
+
+def read_bands(paths: Sequence[Path]) -> Raster:
+    """
+    Read single band files of the same grid into one raster
+    :param paths: file of each band
+    """
+    channels = []
+    for path in paths:
+        with rasterio.open(path) as src:
+            channels.append(src.read(1))
+            transform, crs = src.transform, src.crs
+    return np.stack(channels), transform, crs
+
+
+def mosaic(rasters: List[Raster], bounds: Sequence[float] = None) -> Raster:
+    """
+    Merge rasters of the same crs in memory, all bands at once
+    :param rasters: rasters to merge, first one defines the resolution
+    :param bounds: (optional) left, bottom, right, top of the result in units of the crs
+    """
+    if len(rasters) == 1 and bounds is None:
+        return rasters[0]
+
+    crs = rasters[0][2]
+    with ExitStack() as stack:
+        datasets = []
+        for data, transform, _ in rasters:
+            memory_file = stack.enter_context(MemoryFile())
+            dataset = stack.enter_context(memory_file.open(
+                driver='GTiff', count=data.shape[0], height=data.shape[1], width=data.shape[2], dtype=data.dtype,
+                crs=crs, transform=transform, nodata=0))
+            dataset.write(data)
+            datasets.append(dataset)
+        data, transform = merge(datasets, bounds=bounds, res=datasets[0].res, nodata=0)
+    return data, transform, crs
+
+
+def reproject_raster(raster: Raster, dst_crs: str) -> Raster:
+    """Reproject all bands of the raster in memory"""
+    data, transform, crs = raster
+    dst_transform, width, height = calculate_default_transform(
+        crs, dst_crs, data.shape[2], data.shape[1], *rasterio.transform.array_bounds(*data.shape[1:], transform))
+    destination = np.zeros((data.shape[0], height, width), dtype=data.dtype)
+    reproject(source=data, destination=destination, src_transform=transform, src_crs=crs, src_nodata=0,
+              dst_transform=dst_transform, dst_crs=dst_crs, dst_nodata=0, resampling=Resampling.nearest)
+    return destination, dst_transform, CRS.from_user_input(dst_crs)
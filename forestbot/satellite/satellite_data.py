@@ -1,12 +1,14 @@
 import shutil
 from pathlib import Path
 import math
-from typing import Tuple
+from typing import Tuple, List, Callable
+from affine import Affine
+from concurrent.futures import Executor, ThreadPoolExecutor
+from functools import partial
 from forestbot.satellite.firehr_data import RegionST, download_data
-from PIL import Image
-import rasterio
+from forestbot.satellite.tile_cache import TileCache, Cell
+from forestbot.satellite.raster import Raster, read_bands, mosaic, reproject_raster
 import numpy as np
-from rasterio.warp import calculate_default_transform, reproject, Resampling
 
 products = ["COPERNICUS/S2"]
 bands = ['B4', 'B3', 'B2']  # Red, Green, Blue
@@ -15,89 +17,121 @@ time_start = '2020-05-01'
 time_end = '2020-09-25'
 
 brightness = 4
+earth_radius_m = 6378137  # sphere of EPSG:3857
+max_parallel_cells = 8  # Cells downloaded at the same time by all requests which do not pass their executor
+cell_executor = ThreadPoolExecutor(max_workers=max_parallel_cells, thread_name_prefix="cell_download")
 
 
 def epsg3857_to_epsg4326(x, y):
-    x = (x * 180) / 20037508.34
-    y = (y * 180) / 20037508.34
-    y = (math.atan(math.pow(math.e, y * (math.pi / 180))) * 360) / math.pi - 90
+    """Accepts numbers or arrays of the same shape, returns (latitude, longitude)"""
+    x = (np.asarray(x, dtype=np.float64) * 180) / 20037508.34
+    y = (np.asarray(y, dtype=np.float64) * 180) / 20037508.34
+    y = (np.arctan(np.exp(y * (math.pi / 180))) * 360) / math.pi - 90
     return y, x
 
 
-def download_rect(image_name, center: Tuple[float, float], radius: float, download_dir: Path):
+def get_pixel_to_coordinates(transform: Affine) -> Callable:
+    """
+    :param transform: transform of the image in EPSG:3857
+    :return: a function that accepts x and y coordinates of pixels, numbers or arrays,
+     and returns latitude and longitude of their centers
+    """
+
+    def pixel_to_coordinates(x, y):
+        # Same as rasterio.transform.xy, but for all points at once
+        x, y = np.asarray(x, dtype=np.float64) + 0.5, np.asarray(y, dtype=np.float64) + 0.5
+        return epsg3857_to_epsg4326(transform.a * x + transform.b * y + transform.c,
+                                    transform.d * x + transform.e * y + transform.f)
+
+    return pixel_to_coordinates
+
+
+def get_pixel_size_m(pixel_to_coordinates: Callable, x: float, y: float) -> float:
+    """
+    Ground size of the pixel in meters. Pixels of EPSG:3857 are square, but shrink on the ground by cos(latitude)
+    :param pixel_to_coordinates: function from get_pixel_to_coordinates
+    :param x, y: pixel, e.g. the center of the image, the size changes with latitude
+    """
+    (latitude, _), (longitude, next_longitude) = pixel_to_coordinates([x, x + 1], [y, y])
+    return math.radians(next_longitude - longitude) * earth_radius_m * math.cos(math.radians(latitude))
+
+
+def download_region(name: str, bbox: List[float], folder: Path) -> Raster:
+    """
+    Download bands of the region from Earth Engine and mosaic them in memory
+    :param name: name of the region
+    :param bbox: left, bottom, right, top in degrees
+    :param folder: empty folder to download into
+    :return: raster with a layer for each band
+    """
+    region = RegionST(name=name,
+                      bbox=bbox,
+                      scale_meters=10,
+                      time_start=time_start,
+                      time_end=time_end)
+
+    time_window = region.times[0], region.times[-1]
+    segments = download_data(region, time_window, products, bands, folder, use_least_cloudy=5,
+                             download_crop_size=1000, merge_files=False)
+    return mosaic([read_bands(segment) for segment in segments])
+
+
+def download_cell(cache: TileCache, source: str, cell: Cell, name: str, download_dir: Path) -> None:
+    """
+    Download bands of the grid cell and put them into the cache
+    :param download_dir: directory for temporary files, the download could outlive the request that started it,
+    so it has its own folder
+    """
+    folder = download_dir / f"temp_{name}"
+    folder.mkdir(parents=True, exist_ok=True)
+    try:
+        cache.put(source, cell, bands, download_region(name, cache.get_cell_bbox(cell), folder))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def download_rect(image_name, center: Tuple[float, float], radius: float, download_dir: Path,
+                  cache: TileCache = None, executor: Executor = None):
     """
     Must run ee.Initialize() at least once before
     :param image_name: name of the region
     :param center: center of the region in terms of geographical coordinates, (latitude, longitute) (широат, долгота)
     :param radius: radius (degrees)
-    :param download_dir: directory to place the downloaded file into
-    :return: a function that accepts x and y coordinates of a point in the image and returns the corresponding latitude and longitude
+    :param download_dir: directory for temporary files of the download
+    :param cache: (optional) cache of downloaded rasters, the region is assembled from its grid cells
+    :param executor: (optional) executor shared by all requests for downloads of cells, cell_executor by default.
+    It bounds the number of connections to Earth Engine
+    :return: (RGB image, a function that accepts x and y coordinates of a point in the image and returns the corresponding latitude and longitude)
 
-    The downloaded image will be at download_dir/{image_name}
-    Note: Format(.jpg, .png) must be specified in image_name
+    Image is not saved, so it could be passed to the model without encoding and decoding
     """
     left, bottom, right, top = center[1] - radius, center[0] - radius, center[1] + radius, center[0] + radius
-    region = RegionST(name=image_name,
-                      bbox=[left, bottom, right, top],
-                      scale_meters=10,
-                      time_start=time_start,
-                      time_end=time_end)
+    bbox = [left, bottom, right, top]
 
-    time_window = region.times[0], region.times[-1]
-    temp_folder = download_dir / f"temp_{image_name}"
-    download_data(region, time_window, products, bands, temp_folder, use_least_cloudy=5, download_crop_size=1000)
-    with rasterio.open(temp_folder / f'{image_name}.download.B2.tif') as b2_raster:
-        b2_data = b2_raster.read()
-        orig_transform = b2_raster.transform
-        crs = b2_raster.crs
-    with rasterio.open(temp_folder / f'{image_name}.download.B3.tif') as b3_raster:
-        b3_data = b3_raster.read()
-    with rasterio.open(temp_folder / f'{image_name}.download.B4.tif') as b4_raster:
-        b4_data = b4_raster.read()
-
-    channels = np.empty([3, b3_data.shape[1], b3_data.shape[2]], dtype=np.float32)
-    for index, image in enumerate([b4_data, b3_data, b2_data]):
-        channels[index, :, :] = image
-
-    combined_file = Path(temp_folder / f'{image_name}.combined.tiff')
-    reprojected_file = Path(temp_folder / f'{image_name}.reprojected.tiff')
-    num_chans, height, width = channels.shape
-
-    with rasterio.open(combined_file, 'w', driver='GTiff',
-                       height=height, width=width,
-                       count=num_chans, dtype=channels.dtype,
-                       crs=crs, transform=orig_transform, nodata=0.0) as dst:
-        dst.write(channels)
-        keys = ['4', '3', '2']
-        for index, chan_name in enumerate(keys):
-            dst.update_tags(index + 1, name=chan_name)
-
-    with rasterio.open(combined_file) as src:
-        new_transform, width, height = calculate_default_transform(src.crs, dst_crs, src.width, src.height, *src.bounds)
-        kwargs = src.meta.copy()
-        kwargs.update({
-            'crs': dst_crs,
-            'transform': new_transform,
-            'width': width,
-            'height': height
-        })
-
-        with rasterio.open(reprojected_file, 'w', **kwargs) as dst:
-            for i in range(1, src.count + 1):
-                reproject(
-                    source=rasterio.band(src, i),
-                    destination=rasterio.band(dst, i),
-                    src_transform=src.transform,
-                    src_crs=src.crs,
-                    dst_transform=new_transform,
-                    dst_crs=dst_crs,
-                    resampling=Resampling.nearest)
-
-    with rasterio.open(reprojected_file) as src:
-        img = src.read()
-        transform = src.transform
+    if cache is None:
+        temp_folder = download_dir / f"temp_{image_name}"
+        temp_folder.mkdir(parents=True, exist_ok=True)
+        try:
+            raster = download_region(image_name, bbox, temp_folder)
+        finally:
+            shutil.rmtree(temp_folder, ignore_errors=True)
+    else:
+        source = TileCache.get_source(products, time_start, time_end)
+        # Cells downloaded for this request are not evicted by other requests before they are read
+        with cache.pin(source, bbox, bands):
+            missing_cells = cache.get_missing_cells(source, bbox, bands)
+            if missing_cells:
+                # Cells are independent requests to Earth Engine, so they are downloaded in parallel
+                downloads = [cache.download(source, cell, partial(
+                    download_cell, cache, source, cell, f"{image_name}.{cell[0]}_{cell[1]}", download_dir),
+                                            cell_executor if executor is None else executor)
+                             for cell in missing_cells]
+                for download in downloads:
+                    download.result()
+            raster = cache.read(source, bbox, bands)
+
+    # Bands are merged and reprojected in memory
+    img, transform, _ = reproject_raster(raster, dst_crs)
     img = img.transpose(1, 2, 0).astype(np.float32) / 10000 * brightness * 255
-    img = Image.fromarray(img.clip(0, 255).astype(np.uint8))
-    img.save(download_dir / image_name)
-    shutil.rmtree(temp_folder)
-    return lambda y, x: epsg3857_to_epsg4326(*rasterio.transform.xy(transform, x, y))
+    img = np.ascontiguousarray(img.clip(0, 255).astype(np.uint8))
+    return img, get_pixel_to_coordinates(transform)
@@ -0,0 +1,184 @@
+from typing import List
+import numpy as np
+import cv2
+
+# Neighbours in the order of Zhang-Suen: P2 (north), P3, ..., P9 (north-west), as (dy, dx)
+neighbour_offsets = [(-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1)]
+
+
+def get_neighbour_bits(code: int) -> List[int]:
+    return [(code >> i) & 1 for i in range(8)]
+
+
+def build_thinning_tables():
+    """Which pixels are deleted by each sub-iteration of Zhang-Suen, indexed by the code of the neighbourhood"""
+    first, second = np.zeros(256, dtype=bool), np.zeros(256, dtype=bool)
+    for code in range(256):
+        p2, p3, p4, p5, p6, p7, p8, p9 = bits = get_neighbour_bits(code)
+        n_neighbours = sum(bits)
+        n_transitions = sum(bits[i] == 0 and bits[(i + 1) % 8] == 1 for i in range(8))
+        if 2 <= n_neighbours <= 6 and n_transitions == 1:
+            first[code] = p2 * p4 * p6 == 0 and p4 * p6 * p8 == 0
+            second[code] = p2 * p4 * p8 == 0 and p2 * p6 * p8 == 0
+    return first, second
+
+
+def build_simple_table():
+    """
+    Pixels which could be deleted without changing the topology: they have a background 4-neighbour
+    and their neighbours stay connected without them. Endpoints are kept, so lines are not shortened
+    """
+    # Pairs of neighbours touching each other: next in the ring, and orthogonal ones touching diagonally
+    touching = [(i, (i + 1) % 8) for i in range(8)] + [(i, (i + 2) % 8) for i in range(0, 8, 2)]
+    table = np.zeros(256, dtype=bool)
+    for code in range(256):
+        bits = get_neighbour_bits(code)
+        if sum(bits) < 2 or all(bits[i] for i in range(0, 8, 2)):
+            continue
+        components = list(range(8))
+        for first, second in touching:
+            if bits[first] and bits[second]:
+                old, new = components[second], components[first]
+                components = [new if component == old else component for component in components]
+        table[code] = len({components[i] for i in range(8) if bits[i]}) == 1
+    return table
+
+
+def build_direction_table():
+    """Offsets of the neighbours, indexed by the code of the neighbourhood"""
+    return [[neighbour_offsets[i] for i, bit in enumerate(get_neighbour_bits(code)) if bit] for code in range(256)]
+
+
+thinning_tables = build_thinning_tables()
+simple_table = build_simple_table()
+direction_table = build_direction_table()
+
+
+def get_neighbour_codes(image: np.ndarray) -> np.ndarray:
+    """
+    :param np.ndarray image: binary image with values 0 and 1
+    :return np.ndarray: for every pixel, bit i is set if its neighbour i from neighbour_offsets is set
+    """
+    padded = np.pad(image, 1)
+    height, width = image.shape
+    codes = np.zeros(image.shape, dtype=np.uint8)
+    for i, (dy, dx) in enumerate(neighbour_offsets):
+        codes |= padded[1 + dy:1 + dy + height, 1 + dx:1 + dx + width] << i
+    return codes
+
+
+def get_sparse_neighbour_codes(padded: np.ndarray, ys: np.ndarray, xs: np.ndarray) -> np.ndarray:
+    """Same as get_neighbour_codes, but only for the listed pixels of the image padded by one pixel"""
+    codes = np.zeros(len(ys), dtype=np.uint8)
+    for i, (dy, dx) in enumerate(neighbour_offsets):
+        codes |= padded[ys + dy, xs + dx] << i
+    return codes
+
+
+def thin(mask: np.ndarray) -> np.ndarray:
+    """
+    Zhang-Suen thinning followed by removal of pixels in the corners of staircases, so lines are one pixel wide
+    and every pixel inside a line has exactly two neighbours
+    :param np.ndarray mask: mask with non-zero foreground
+    :return np.ndarray: skeleton with values 0 and 1
+    """
+    padded = np.pad((mask > 0).astype(np.uint8), 1)
+    # Only foreground pixels are checked, roads are a small part of the image
+    ys, xs = np.nonzero(padded)
+
+    def delete_pixels(tables, subsets):
+        nonlocal ys, xs
+        changed = False
+        for table, subset in zip(tables, subsets):
+            deleted = table[get_sparse_neighbour_codes(padded, ys, xs)] & subset(ys, xs)
+            if deleted.any():
+                padded[ys[deleted], xs[deleted]] = 0
+                ys, xs = ys[~deleted], xs[~deleted]
+                changed = True
+        return changed
+
+    every_pixel = lambda y, x: True
+    while delete_pixels(thinning_tables, [every_pixel] * 2):
+        pass
+    # Pixels of the same subfield do not touch, so deleting them together keeps lines connected
+    subfields = [lambda y, x, i=i, j=j: (y % 2 == i) & (x % 2 == j) for i in range(2) for j in range(2)]
+    while delete_pixels([simple_table] * 4, subfields):
+        pass
+    return padded[1:-1, 1:-1].copy()
+
+
+def extract_lines(skeleton: np.ndarray, min_branch_length: float = 0) -> List[np.ndarray]:
+    """
+    Split skeleton into lines between endpoints and junctions.
+    Adjacent junction pixels are merged into one junction at their center, so lines meeting there share the point
+    :param np.ndarray skeleton: skeleton with values 0 and 1, see thin
+    :param float min_branch_length: lines with a loose end shorter than this are dropped, in pixels
+    :return: lines as arrays of (x, y) points
+    """
+    codes = get_neighbour_codes(skeleton)
+    n_neighbours = np.unpackbits(codes[..., None], axis=-1).sum(axis=-1)
+    is_node = (skeleton == 1) & (n_neighbours != 2)
+
+    n_labels, labels = cv2.connectedComponents(is_node.astype(np.uint8), connectivity=8)
+    node_ys, node_xs = np.nonzero(is_node)
+    node_labels = labels[node_ys, node_xs]
+    cluster_sizes = np.bincount(node_labels, minlength=n_labels)
+    centers = np.stack([np.bincount(node_labels, weights=node_xs, minlength=n_labels),
+                        np.bincount(node_labels, weights=node_ys, minlength=n_labels)], axis=1).astype(np.float64)
+    centers /= np.maximum(cluster_sizes, 1)[:, None]
+    is_endpoint = np.zeros(n_labels, dtype=bool)
+    is_endpoint[node_labels[n_neighbours[node_ys, node_xs] == 1]] = True
+    is_endpoint &= cluster_sizes == 1
+
+    visited = np.zeros(skeleton.shape, dtype=bool)
+    lines = []
+
+    def trace(start_y, start_x, y, x):
+        """Follow the line from the start pixel through (y, x), returns the points and the label it ends at"""
+        points = [(x, y)]
+        visited[y, x] = True
+        previous = start_y, start_x
+        while True:
+            next_y, next_x = next((y + dy, x + dx) for dy, dx in direction_table[codes[y, x]]
+                                  if (y + dy, x + dx) != previous)
+            if is_node[next_y, next_x]:
+                return points, labels[next_y, next_x]
+            if visited[next_y, next_x]:
+                # Returned to the start of a loop without junctions
+                points.append((next_x, next_y))
+                return points, 0
+            points.append((next_x, next_y))
+            visited[next_y, next_x] = True
+            previous, (y, x) = (y, x), (next_y, next_x)
+
+    for y, x, label in zip(node_ys, node_xs, node_labels):
+        for dy, dx in direction_table[codes[y, x]]:
+            if is_node[y + dy, x + dx] or visited[y + dy, x + dx]:
+                continue
+            points, end_label = trace(y, x, y + dy, x + dx)
+            if end_label == label and len(points) < 3:
+                continue  # pixel touching the junction twice
+            if (is_endpoint[label] or is_endpoint[end_label]) and len(points) + 1 < min_branch_length:
+                continue  # short spur left by thinning of a wide blob
+            end = [centers[end_label]] if end_label != 0 else []
+            lines.append(np.array([centers[label], *points, *end], dtype=np.float32))
+
+    # Loops without junctions, e.g. roundabouts
+    for y, x in zip(*np.nonzero((skeleton == 1) & ~is_node & ~visited)):
+        if visited[y, x]:
+            continue
+        dy, dx = direction_table[codes[y, x]][0]
+        visited[y, x] = True
+        points, _ = trace(y, x, y + dy, x + dx)
+        lines.append(np.array([(x, y), *points], dtype=np.float32))
+
+    return lines
+
+
+def simplify_line(line: np.ndarray, tolerance: float) -> np.ndarray:
+    """
+    Douglas-Peucker simplification, ends of the line are kept
+    :param np.ndarray line: array of (x, y) points
+    :param float tolerance: max distance between the line and the simplified one, in pixels
+    """
+    return cv2.approxPolyDP(line.reshape(-1, 1, 2), tolerance, closed=False).reshape(-1, 2)
@@ -0,0 +1,204 @@
+from collections import OrderedDict, Counter
+from concurrent.futures import Executor, Future
+from contextlib import contextmanager
+from threading import Lock, get_ident
+from pathlib import Path
+from typing import List, Tuple, Sequence, Callable
+from forestbot.satellite.raster import Raster, read_bands, mosaic
+import rasterio
+import math
+import time
+import os
+
+Cell = Tuple[int, int]  # (column, row) of the grid cell
+
+
+class TileCache:
+    """
+    Persistent cache of downloaded band rasters. The world is split into a grid of square cells in EPSG:4326,
+    every cell is downloaded once and stored as tiled compressed GeoTIFF per band. Requested regions are
+    assembled from the cells, so nearby requests reuse the same downloads.
+    Files are stored as cache_dir/{source}/{column}_{row}.{band}.tif,
+    where source describes the product and time window the rasters are made of.
+    Files of a request are pinned while it is served, so they are not evicted between download and read.
+    A cell requested by several requests at once is downloaded once, the others wait for the same download.
+    """
+    tile_profile = {'driver': 'GTiff', 'tiled': True, 'blockxsize': 256, 'blockysize': 256, 'compress': 'deflate'}
+
+    def __init__(self, cache_dir: Path, cell_size_deg: float = 0.05, max_bytes: int = 10 * 1024 ** 3,
+                 max_age_seconds: float = None):
+        """
+        :param Path cache_dir: folder for cached rasters
+        :param float cell_size_deg: side of the grid cell in degrees
+        :param int max_bytes: max total size of cached files, least recently used are deleted first
+        :param float max_age_seconds: (optional) files older than this are downloaded again
+        """
+        self.cache_dir = cache_dir
+        self.cell_size_deg = cell_size_deg
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+
+        self.files = OrderedDict()  # path -> file size, least recently used first
+        self.total_bytes = 0
+        self.pins = Counter()  # path -> number of requests using it
+        self.downloads = dict()  # (source, cell) -> Future of the download in progress
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        for path in sorted(self.cache_dir.glob("*/*.tif"), key=lambda x: x.stat().st_mtime):
+            self.files[path] = path.stat().st_size
+            self.total_bytes += self.files[path]
+
+    @staticmethod
+    def get_source(products: Sequence[str], time_start: str, time_end: str) -> str:
+        """Name of the folder for rasters of the products over the time window"""
+        return f"{'+'.join(products)}_{time_start}_{time_end}".replace("/", "-")
+
+    def get_cells(self, bbox: Sequence[float]) -> List[Cell]:
+        """
+        :param bbox: left, bottom, right, top in degrees
+        :return: grid cells covering the bbox
+        """
+        left, bottom, right, top = bbox
+        columns = range(math.floor(left / self.cell_size_deg), math.ceil(right / self.cell_size_deg))
+        rows = range(math.floor(bottom / self.cell_size_deg), math.ceil(top / self.cell_size_deg))
+        return [(column, row) for row in rows for column in columns]
+
+    def get_cell_bbox(self, cell: Cell) -> List[float]:
+        """:return: left, bottom, right, top of the cell in degrees"""
+        column, row = cell
+        return [column * self.cell_size_deg, row * self.cell_size_deg,
+                (column + 1) * self.cell_size_deg, (row + 1) * self.cell_size_deg]
+
+    def get_path(self, source: str, cell: Cell, band: str) -> Path:
+        return self.cache_dir / source / f"{cell[0]}_{cell[1]}.{band}.tif"
+
+    def get_missing_cells(self, source: str, bbox: Sequence[float], bands: Sequence[str]) -> List[Cell]:
+        """
+        Counts hits and misses, every cell is counted once
+        :return: cells of the bbox which have at least one band not cached
+        """
+        missing = []
+        with self.lock:
+            for cell in self.get_cells(bbox):
+                if all(self.__is_valid(self.get_path(source, cell, band)) for band in bands):
+                    self.hits += 1
+                else:
+                    self.misses += 1
+                    missing.append(cell)
+        return missing
+
+    @contextmanager
+    def pin(self, source: str, bbox: Sequence[float], bands: Sequence[str]):
+        """Files of the bbox are not evicted inside the context, even the ones which are not cached yet"""
+        paths = Counter(self.get_path(source, cell, band) for cell in self.get_cells(bbox) for band in bands)
+        with self.lock:
+            self.pins += paths
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.pins -= paths
+
+    def download(self, source: str, cell: Cell, download: Callable[[], None], executor: Executor) -> Future:
+        """
+        Run the download of the cell in the executor, unless the cell is being downloaded already
+        :param download: function which downloads the cell and puts it into the cache
+        :return: future of the download, shared by all requests of the cell
+        """
+        key = source, cell
+        with self.lock:
+            if key in self.downloads:
+                return self.downloads[key]
+            future = self.downloads[key] = Future()
+        try:
+            executor.submit(self.__run_download, key, future, download)
+        except Exception as e:
+            self.__finish_download(key, future, e)
+        return future
+
+    def put(self, source: str, cell: Cell, bands: Sequence[str], raster: Raster) -> None:
+        """
+        Store downloaded raster of the cell
+        :param raster: raster with a layer for each band
+        """
+        data, transform, crs = raster
+        for band, band_data in zip(bands, data):
+            path = self.get_path(source, cell, band)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # Written under temporary name, so concurrent readers never see a partial file
+            temp_path = path.with_name(f"{path.stem}.{os.getpid()}.{get_ident()}.tmp")
+            with rasterio.open(temp_path, 'w', height=band_data.shape[0], width=band_data.shape[1], count=1,
+                               dtype=band_data.dtype, crs=crs, transform=transform, nodata=0,
+                               **TileCache.tile_profile) as dst:
+                dst.write(band_data, 1)
+            os.replace(temp_path, path)
+
+            with self.lock:
+                self.total_bytes -= self.files.pop(path, 0)
+                self.files[path] = path.stat().st_size
+                self.total_bytes += self.files[path]
+                while self.total_bytes > self.max_bytes:
+                    # Files being read by other requests are kept, the cache could exceed max_bytes for a while
+                    evicted = next((x for x in self.files if x != path and x not in self.pins), None)
+                    if evicted is None:
+                        break
+                    self.__remove(evicted)
+
+    def read(self, source: str, bbox: Sequence[float], bands: Sequence[str]) -> Raster:
+        """
+        Assemble the bbox from cached cells. All cells must be cached
+        :return: raster with a layer for each band
+        """
+        cells = self.get_cells(bbox)
+        with self.lock:
+            for cell in cells:
+                for band in bands:
+                    if self.get_path(source, cell, band) in self.files:
+                        self.files.move_to_end(self.get_path(source, cell, band))
+
+        return mosaic([read_bands([self.get_path(source, cell, band) for band in bands]) for cell in cells],
+                      bounds=bbox)
+
+    def __is_valid(self, path: Path) -> bool:
+        if path not in self.files:
+            return False
+        if self.max_age_seconds is not None:
+            try:
+                expired = time.time() - path.stat().st_mtime > self.max_age_seconds
+            except OSError:
+                expired = True
+            if expired:
+                if path in self.pins:
+                    # File could be read by another request, it is replaced by the new download
+                    self.total_bytes -= self.files.pop(path)
+                else:
+                    self.__remove(path)
+                return False
+        return True
+
+    def __run_download(self, key, future: Future, download: Callable[[], None]) -> None:
+        try:
+            download()
+        except Exception as e:
+            self.__finish_download(key, future, e)
+        else:
+            self.__finish_download(key, future)
+
+    def __finish_download(self, key, future: Future, error: Exception = None) -> None:
+        # Requests coming after this one check the cache instead of waiting for the future
+        with self.lock:
+            del self.downloads[key]
+        if error is None:
+            future.set_result(None)
+        else:
+            future.set_exception(error)
+
+    def __remove(self, path: Path) -> None:
+        self.total_bytes -= self.files.pop(path)
+        try:
+            os.remove(path)
+        except OSError as e:
+            print(e)
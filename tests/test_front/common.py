@@ -8,9 +8,21 @@ class MockBot:
     def __init__(self):
         self.send_document = Mock()
         self.send_message = Mock()
+        self.send_photo = Mock()
 
     def init_send_message(self, n_exceptions):
         self.send_message.side_effect = [Exception()] * n_exceptions + [None]
 
     def init_send_document(self, n_exceptions):
         self.send_document.side_effect = [Exception()] * n_exceptions + [None]
+
+    def init_send_photo(self, n_exceptions):
+        self.send_photo.side_effect = [Exception()] * n_exceptions + [None]
+
+
+class ImmediateExecutor:
+    """Stand-in for ThreadPoolExecutor running tasks in the calling thread, so results are checked right away"""
+
+    @staticmethod
+    def submit(func, *args, **kwargs):
+        func(*args, **kwargs)
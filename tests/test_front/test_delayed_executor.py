@@ -0,0 +1,61 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock
+
+from forestbot.front.delayed_executor import DelayedExecutor
+from forestbot.front.forest_bot import ForestBot
+from tests.test_front.common import MockBot
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_tasks_run_in_order_of_due_time():
+    executor = DelayedExecutor()
+    executor.start()
+    order = []
+    executor.submit(0.2, lambda: order.append("late"))
+    executor.submit(0.05, lambda: order.append("early"))
+    executor.submit(0.1, lambda: 1 / 0)  # failed task does not stop the others
+
+    assert wait_for(lambda: len(order) == 2)
+    assert order == ["early", "late"]
+    executor.stop()
+
+
+def test_pending_tasks_are_dropped_after_stop():
+    executor = DelayedExecutor()
+    executor.start()
+    task = Mock()
+    executor.submit(0.1, task)
+    executor.stop()
+    executor.thread.join(timeout=1)
+
+    assert not executor.thread.is_alive()
+    time.sleep(0.2)
+    task.assert_not_called()
+
+
+def test_failed_sends_do_not_add_threads():
+    forestbot = object.__new__(ForestBot)
+    forestbot.bot = MockBot()
+    forestbot.bot.send_message.side_effect = Exception("Telegram is down")
+    forestbot.send_executor = ThreadPoolExecutor(max_workers=2)
+    forestbot.retry_executor = DelayedExecutor()
+    forestbot.retry_executor.start()
+    n_threads = threading.active_count()
+
+    n_messages = 50
+    for _ in range(n_messages):
+        forestbot.send_text_message(MockBot.chat_id, "text")
+    # Every message has failed and waits for its retry
+    assert wait_for(lambda: len(forestbot.retry_executor) == n_messages)
+    assert threading.active_count() <= n_threads + 2
+
+    forestbot.retry_executor.stop()
+    forestbot.send_executor.shutdown()
@@ -0,0 +1,89 @@
+import pytest
+import time
+from threading import Event, Lock
+
+from forestbot.front.download_executor import DownloadExecutor
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_round_robin_between_chats():
+    executor = DownloadExecutor(max_workers=1)
+    order = []
+
+    def download(chat_id, i):
+        order.append((chat_id, i))
+
+    for i in range(3):
+        executor.submit(1, download, chat_id=1, i=i)
+    executor.submit(2, download, chat_id=2, i=0)
+    executor.submit(3, download, chat_id=3, i=0)
+    executor.submit(2, download, chat_id=2, i=1)
+
+    executor.start()
+    assert wait_for(lambda: len(order) == 6)
+    executor.stop()
+    assert order == [(1, 0), (2, 0), (3, 0), (1, 1), (2, 1), (1, 2)]
+
+
+def test_submit_returns_position():
+    executor = DownloadExecutor(max_workers=1)
+    assert executor.submit(1, print) == 0
+    assert executor.submit(1, print) == 1
+    assert executor.submit(2, print) == 1  # served right after the first job of chat 1
+    assert executor.submit(3, print) == 2
+    assert executor.submit(2, print) == 4
+    assert len(executor) == 5
+
+
+def test_concurrency_limit():
+    executor = DownloadExecutor(max_workers=3)
+    release = Event()
+    lock = Lock()
+    running, max_running = [0], [0]
+
+    def download():
+        with lock:
+            running[0] += 1
+            max_running[0] = max(max_running[0], running[0])
+        release.wait(timeout=5)
+        with lock:
+            running[0] -= 1
+
+    for chat_id in range(6):
+        executor.submit(chat_id, download)
+    executor.start()
+    assert wait_for(lambda: running[0] == 3)
+    assert len(executor) == 6
+
+    release.set()
+    assert wait_for(lambda: len(executor) == 0)
+    executor.stop()
+    assert max_running[0] == 3
+
+
+def test_failed_download_does_not_stop_worker():
+    executor = DownloadExecutor(max_workers=1)
+    done = Event()
+    executor.submit(1, lambda: 1 / 0)
+    executor.submit(1, done.set)
+    executor.start()
+    assert done.wait(timeout=5)
+    executor.stop()
+    for worker in executor.workers:
+        worker.join(timeout=5)
+        assert not worker.is_alive()
+
+
+def test_estimate_wait_time():
+    executor = DownloadExecutor(max_workers=2)
+    assert executor.estimate_wait_time() == 0
+    executor.service_times.extend([10.0, 20.0])
+    for i in range(4):
+        executor.submit(i, lambda: None)
+    assert executor.estimate_wait_time() == pytest.approx(30.0)
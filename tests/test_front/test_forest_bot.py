@@ -1,16 +1,24 @@
+import time
 import pytest
+import numpy as np
+from pathlib import Path
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import Mock
 import telebot
 
 from forestbot.front.utils import *
 from forestbot.front.forest_bot import ForestBot
-from tests.test_front.common import MockBot
+from forestbot.front.image_store import ImageStore
+from forestbot.front.mask_store import MaskStore
+from tests.test_front.common import MockBot, ImmediateExecutor
 
 
 @pytest.fixture(scope='session')
 def forestbot():
     forestbot = object.__new__(ForestBot)
     forestbot.user_thresholds = dict()
+    forestbot.send_executor = ImmediateExecutor()
     forestbot.bot = telebot.TeleBot("123")
     forestbot._ForestBot__add_handlers()
     forestbot._ForestBot__init_messages()
@@ -144,3 +152,237 @@ def test_handle_other_types(forestbot, handlers, content_type):
 )
 def test_is_correct_format(file_format, is_valid):
     assert ForestBot.is_correct_format(file_format) == is_valid
+
+
+@pytest.mark.parametrize("n_exceptions", (0, 2))
+def test_send_image_from_memory(forestbot, tmp_path, monkeypatch, n_exceptions):
+    # Retries are scheduled instead of sleeping in the sending thread
+    run_later = Mock(side_effect=lambda delay, task: task())
+    monkeypatch.setattr(forestbot, "_ForestBot__run_later", run_later)
+    input_file = tmp_path / "input.png"
+    input_file.write_bytes(b"input")
+    forestbot.bot = MockBot()
+    forestbot.bot.init_send_photo(n_exceptions)
+
+    forestbot._ForestBot__send_image_with_retry(photo=b"encoded image", chat_id=MockBot.chat_id,
+                                                delete_files=[input_file])
+
+    assert forestbot.bot.send_photo.call_count == n_exceptions + 1
+    _, kwargs = forestbot.bot.send_photo.call_args
+    assert kwargs['chat_id'] == MockBot.chat_id
+    assert kwargs['photo'] == b"encoded image"
+    assert not input_file.exists()
+    assert run_later.call_count == n_exceptions
+
+
+@pytest.fixture
+def satellite_forestbot():
+    forestbot = object.__new__(ForestBot)
+    forestbot.user_thresholds = dict()
+    forestbot.img_to_mask = MaskStore(max_memory_bytes=10 ** 6, max_age_seconds=60)
+    forestbot.img_to_func = ImageStore(max_bytes=0, max_age_seconds=60)
+    forestbot.bot = MockBot()
+    forestbot.send_executor = ThreadPoolExecutor(max_workers=2)
+    forestbot.controller = Mock()
+    forestbot.satellite_images = ImageStore(max_bytes=10 ** 6)
+    forestbot.speculative_lock = Lock()
+    forestbot.speculative_running = dict()
+    forestbot.speculative_results = ImageStore(max_bytes=10 ** 6)
+    forestbot._ForestBot__send_image_with_retry = Mock()
+    forestbot.send_text_message = Mock()
+    forestbot.image_evicted_message = "evicted"
+    return forestbot
+
+
+def send_result(forestbot, image_name):
+    """Imitate the controller finishing the first queued artifact"""
+    artifact = forestbot.controller.request_queue.put.call_args_list[0].args[0]
+    forestbot._ForestBot__send_prediction_callback(b"result", artifact.chat_id, np.zeros(1), image_name=image_name)
+    return artifact
+
+
+def wait_for_sent(forestbot, n_photos, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while forestbot._ForestBot__send_image_with_retry.call_count < n_photos and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return forestbot._ForestBot__send_image_with_retry.call_count == n_photos
+
+
+def test_analysis_starts_from_image_in_memory(satellite_forestbot):
+    image = np.zeros((5, 5, 3), dtype=np.uint8)
+    satellite_forestbot.satellite_images.put("img.png", image)
+    satellite_forestbot._ForestBot__start_analysis(MockBot.chat_id, "img.png")
+
+    artifact = satellite_forestbot.controller.request_queue.put.call_args.args[0]
+    assert artifact.image is image
+    assert "img.png" not in satellite_forestbot.satellite_images
+
+
+def test_analysis_of_forgotten_image(satellite_forestbot):
+    satellite_forestbot._ForestBot__start_analysis(MockBot.chat_id, "forgotten.png")
+    satellite_forestbot.controller.request_queue.put.assert_not_called()
+    satellite_forestbot.send_text_message.assert_called_once_with(MockBot.chat_id, "evicted")
+
+
+def test_confirmed_analysis_keeps_export_button(satellite_forestbot, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("forestbot.front.image_store.time.monotonic", lambda: now[0])
+    satellite_forestbot.img_to_func.put("img.png", lambda x, y: (x, y))
+    satellite_forestbot.satellite_images.put("img.png", np.zeros((5, 5, 3), dtype=np.uint8))
+
+    now[0] += 50  # user thinks
+    satellite_forestbot._ForestBot__start_analysis(MockBot.chat_id, "img.png")
+    now[0] += 50  # analysis waits in the queue, longer than the transform lives after the download
+    send_result(satellite_forestbot, "img.png")
+
+    assert wait_for_sent(satellite_forestbot, 1)
+    _, kwargs = satellite_forestbot._ForestBot__send_image_with_retry.call_args
+    assert kwargs['reply_markup'] is not None
+    assert "img.png" in satellite_forestbot.img_to_mask
+
+
+@pytest.mark.parametrize("finished_before_answer", (True, False))
+def test_speculative_analysis_confirmed(satellite_forestbot, finished_before_answer):
+    image = np.zeros((5, 5, 3), dtype=np.uint8)
+    satellite_forestbot.satellite_images.put("img.png", image)
+    satellite_forestbot._ForestBot__start_speculative_analysis(MockBot.chat_id, "img.png", image)
+    assert satellite_forestbot.controller.request_queue.put.call_args.args[0].image is not image
+
+    if finished_before_answer:
+        send_result(satellite_forestbot, "img.png")
+        assert not wait_for_sent(satellite_forestbot, 1, timeout=0.2)
+    satellite_forestbot._ForestBot__start_analysis(MockBot.chat_id, "img.png")
+    if not finished_before_answer:
+        send_result(satellite_forestbot, "img.png")
+
+    assert wait_for_sent(satellite_forestbot, 1)
+    assert satellite_forestbot.controller.request_queue.put.call_count == 1
+    assert len(satellite_forestbot.satellite_images) == len(satellite_forestbot.speculative_results) == 0
+
+
+@pytest.mark.parametrize("finished_before_answer", (True, False))
+def test_speculative_analysis_refused(satellite_forestbot, finished_before_answer):
+    image = np.zeros((5, 5, 3), dtype=np.uint8)
+    satellite_forestbot.satellite_images.put("img.png", image)
+    satellite_forestbot._ForestBot__start_speculative_analysis(MockBot.chat_id, "img.png", image)
+
+    if finished_before_answer:
+        send_result(satellite_forestbot, "img.png")
+    satellite_forestbot._ForestBot__cancel_analysis("img.png")
+    if not finished_before_answer:
+        send_result(satellite_forestbot, "img.png")
+
+    assert not wait_for_sent(satellite_forestbot, 1, timeout=0.2)
+    assert len(satellite_forestbot.satellite_images) == len(satellite_forestbot.speculative_results) == 0
+    assert satellite_forestbot.speculative_running == dict()
+
+
+@pytest.mark.parametrize("failed_before_answer", (True, False))
+def test_failed_speculative_analysis_is_repeated(satellite_forestbot, failed_before_answer):
+    image = np.zeros((5, 5, 3), dtype=np.uint8)
+    satellite_forestbot.satellite_images.put("img.png", image)
+    satellite_forestbot._ForestBot__start_speculative_analysis(MockBot.chat_id, "img.png", image)
+
+    if failed_before_answer:
+        satellite_forestbot._ForestBot__handle_failed_prediction(MockBot.chat_id, "img.png")
+    satellite_forestbot._ForestBot__start_analysis(MockBot.chat_id, "img.png")
+    if not failed_before_answer:
+        assert "img.png" in satellite_forestbot.satellite_images
+        satellite_forestbot._ForestBot__handle_failed_prediction(MockBot.chat_id, "img.png")
+
+    artifact = satellite_forestbot.controller.request_queue.put.call_args.args[0]
+    assert satellite_forestbot.controller.request_queue.put.call_count == 2
+    assert artifact.image is image and artifact.persistent
+    assert satellite_forestbot.speculative_running == dict()
+    assert "img.png" not in satellite_forestbot.satellite_images
+
+
+@pytest.mark.parametrize("large", (True, False))
+def test_dropped_image_is_reported(satellite_forestbot, tmp_path, monkeypatch, large):
+    monkeypatch.chdir(tmp_path)
+    input_file = Path("input_photos") / "photo.png"
+    if large:
+        input_file.parent.mkdir()
+        input_file.write_bytes(b"large image")
+    satellite_forestbot.failed_to_send_message = "failed"
+    satellite_forestbot._ForestBot__handle_failed_prediction(MockBot.chat_id, "photo.png")
+
+    satellite_forestbot.send_text_message.assert_called_once_with(MockBot.chat_id, "failed")
+    satellite_forestbot.controller.request_queue.put.assert_not_called()
+    assert not input_file.exists()
+
+
+def test_speculative_analysis_with_changed_threshold(satellite_forestbot):
+    image = np.zeros((5, 5, 3), dtype=np.uint8)
+    satellite_forestbot.satellite_images.put("img.png", image)
+    satellite_forestbot._ForestBot__start_speculative_analysis(MockBot.chat_id, "img.png", image)
+    send_result(satellite_forestbot, "img.png")
+
+    satellite_forestbot.user_thresholds[MockBot.chat_id] = 0.9
+    satellite_forestbot._ForestBot__start_analysis(MockBot.chat_id, "img.png")
+
+    artifact = satellite_forestbot.controller.request_queue.put.call_args.args[0]
+    assert artifact.threshold == 0.9 and artifact.image is image
+
+
+def test_mask_is_kept_only_for_export(satellite_forestbot):
+    satellite_forestbot.img_to_func.put("satellite.png", lambda x, y: (x, y))
+    mask = np.full((5, 5), 255, dtype=np.uint8)
+    for image_name in ("satellite.png", "photo.png"):
+        satellite_forestbot._ForestBot__send_prediction_callback(b"result", MockBot.chat_id, mask, image_name)
+
+    assert wait_for_sent(satellite_forestbot, 2)
+    assert np.array_equal(satellite_forestbot.img_to_mask.get("satellite.png"), mask)
+    assert "photo.png" not in satellite_forestbot.img_to_mask
+
+
+@pytest.mark.parametrize(
+    ("n_images", "wait_time", "n_downloads", "with_download", "expected"),
+    (
+            (0, 0, 0, False, None),
+            (ForestBot.max_queued_images, 0, 0, False, 1),
+            (1, ForestBot.max_wait_minutes * 60 + 30, 0, False, ForestBot.max_wait_minutes + 1),
+            (1, 0, ForestBot.max_queued_downloads, False, None),
+            (1, 0, ForestBot.max_queued_downloads, True, 1),
+    )
+)
+def test_admission_control(satellite_forestbot, n_images, wait_time, n_downloads, with_download, expected):
+    satellite_forestbot.controller.request_queue.__len__ = Mock(return_value=n_images)
+    satellite_forestbot.controller.estimate_wait_time.return_value = wait_time
+    satellite_forestbot.download_executor = Mock()
+    satellite_forestbot.download_executor.__len__ = Mock(return_value=n_downloads)
+    satellite_forestbot.download_executor.estimate_wait_time.return_value = 0.0
+    assert satellite_forestbot._ForestBot__get_busy_minutes(with_download=with_download) == expected
+
+
+def test_busy_bot_refuses_coordinates(satellite_forestbot):
+    satellite_forestbot._ForestBot__get_busy_minutes = Mock(return_value=5)
+    satellite_forestbot.download_executor = Mock()
+    satellite_forestbot._ForestBot__handle_cords_input(MockBot.chat_id, (55.0, 37.0))
+    satellite_forestbot.download_executor.submit.assert_not_called()
+    assert "5 мин" in satellite_forestbot.send_text_message.call_args.args[1]
+
+
+def test_osm_is_generated_off_the_sending_threads(forestbot, monkeypatch):
+    monkeypatch.setattr(forestbot, "bot", telebot.TeleBot("123"))
+    forestbot._ForestBot__add_handlers()
+    handler = [x['function'] for x in forestbot.bot.callback_query_handlers
+               if x['function'].__name__ == "callback_for_osm"][0]
+    mask = np.zeros((5, 5), dtype=np.uint8)
+    forestbot.bot = MockBot()
+    monkeypatch.setattr(forestbot, "osm_executor", Mock(), raising=False)
+    monkeypatch.setattr(forestbot, "img_to_mask", MaskStore(max_memory_bytes=10 ** 6, max_age_seconds=60),
+                        raising=False)
+    monkeypatch.setattr(forestbot, "img_to_func", ImageStore(max_bytes=0, max_age_seconds=60), raising=False)
+    forestbot.img_to_mask.put("img.png", mask)
+    forestbot.img_to_func.put("img.png", lambda x, y: (y, x))
+    forestbot.bot.answer_callback_query = Mock()
+    forestbot.bot.edit_message_reply_markup = Mock()
+    call = Mock()
+    call.data = "osm img.png"
+    call.message.date = time.time()
+
+    handler(call)
+
+    forestbot.osm_executor.submit.assert_called_once()
+    forestbot.bot.send_document.assert_not_called()
@@ -0,0 +1,50 @@
+from unittest.mock import patch
+import numpy as np
+
+from forestbot.front.image_store import ImageStore
+
+
+def test_put_get_pop():
+    store = ImageStore(max_bytes=1000)
+    image = np.zeros((10, 10), dtype=np.uint8)
+    store.put("a", image)
+    assert "a" in store and store.get("a") is image
+    assert store.total_bytes == 100
+    assert store.pop("a") is image
+    assert store.pop("a") is None and store.get("a", 5) == 5
+    assert store.total_bytes == 0
+
+
+def test_least_recently_used_are_dropped():
+    store = ImageStore(max_bytes=250)
+    for name in "abc":
+        store.put(name, np.zeros(100, dtype=np.uint8))
+        if name == "b":
+            store.get("a")
+    assert list(store.items) == ["a", "c"]
+    assert store.total_bytes == 200
+
+
+def test_size_of_tuples():
+    store = ImageStore(max_bytes=1000)
+    store.put("a", (b"123", np.zeros(10, dtype=np.uint8), 0.2))
+    store.put("a", (b"12", np.zeros(10, dtype=np.uint8), 0.2))
+    assert store.total_bytes == 12 and len(store) == 1
+
+
+def test_items_expire():
+    store = ImageStore(max_bytes=1000, max_age_seconds=60)
+    with patch("forestbot.front.image_store.time.monotonic", return_value=0):
+        store.put("a", b"123")
+        store.put("b", b"456")
+    with patch("forestbot.front.image_store.time.monotonic", return_value=61):
+        assert store.get("a") is None
+        store.put("c", b"789")
+    assert list(store.items) == ["c"] and store.total_bytes == 3
+
+
+def test_max_items():
+    store = ImageStore(max_bytes=0, max_items=2)
+    for name in "abc":
+        store.put(name, lambda x: x)
+    assert list(store.items) == ["b", "c"]
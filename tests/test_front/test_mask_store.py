@@ -0,0 +1,49 @@
+import numpy as np
+from unittest.mock import patch
+
+from forestbot.front.mask_store import MaskStore
+
+
+def random_mask(shape=(37, 51)):
+    return ((np.random.rand(*shape) > 0.8) * 255).astype(np.uint8)
+
+
+def test_mask_is_packed():
+    store = MaskStore(max_memory_bytes=10 ** 6, max_age_seconds=60)
+    mask = random_mask()
+    store.put("a", mask)
+    assert store.memory_bytes == (mask.size + 7) // 8
+    assert np.array_equal(store.get("a"), mask)
+    assert store.get("b") is None
+
+
+def test_masks_are_spilled_to_disk(tmp_path):
+    masks = [random_mask() for _ in range(3)]
+    store = MaskStore(max_memory_bytes=300, max_age_seconds=60, spill_dir=tmp_path, max_disk_bytes=10 ** 6)
+    for i, mask in enumerate(masks):
+        store.put(str(i), mask)
+    assert len(store.memory) == 1 and len(store.disk) == 2 and len(list(tmp_path.glob("*.npy"))) == 2
+
+    for i, mask in enumerate(masks):
+        assert np.array_equal(store.get(str(i)), mask)
+    assert len(store) == 3
+
+
+def test_disk_budget(tmp_path):
+    store = MaskStore(max_memory_bytes=0, max_age_seconds=60, spill_dir=tmp_path, max_disk_bytes=500)
+    for i in range(4):
+        store.put(str(i), random_mask())
+    assert store.disk_bytes <= 500
+    assert "3" in store and "0" not in store
+
+
+def test_masks_expire(tmp_path):
+    store = MaskStore(max_memory_bytes=300, max_age_seconds=60, spill_dir=tmp_path, max_disk_bytes=10 ** 6)
+    with patch("forestbot.front.mask_store.time.monotonic", return_value=0):
+        store.put("old", random_mask())
+        store.put("older", random_mask())
+    with patch("forestbot.front.mask_store.time.monotonic", return_value=61):
+        store.put("new", random_mask())
+        assert store.get("old") is None and "older" not in store
+        assert "new" in store
+    assert len(store) == 1 and store.disk_bytes == 0 and not list(tmp_path.glob("*.npy"))
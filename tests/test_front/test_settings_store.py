@@ -0,0 +1,51 @@
+import pytest
+import sqlite3
+
+from forestbot.front.settings_store import SettingsStore
+
+
+def read_rows(path):
+    with sqlite3.connect(path) as connection:
+        return connection.execute("SELECT chat_id, name, value FROM settings ORDER BY chat_id").fetchall()
+
+
+def test_setting_is_dict_like(tmp_path):
+    thresholds = SettingsStore(tmp_path / "settings.db").get_setting("threshold")
+    assert thresholds.get(1, 0.2) == 0.2 and 1 not in thresholds
+    with pytest.raises(KeyError):
+        _ = thresholds[1]
+    thresholds[1] = 0.5
+    assert thresholds[1] == 0.5 and 1 in thresholds and 2 not in thresholds
+
+
+def test_changes_are_written_behind(tmp_path):
+    store = SettingsStore(tmp_path / "settings.db")
+    store.set(1, "threshold", 0.5)
+    store.set(2, "radius_deg", 0.01)
+    store.set(1, "threshold", 0.7)
+    assert read_rows(tmp_path / "settings.db") == []
+
+    store.flush()
+    assert read_rows(tmp_path / "settings.db") == [(1, "threshold", 0.7), (2, "radius_deg", 0.01)]
+
+
+def test_settings_survive_restart(tmp_path):
+    store = SettingsStore(tmp_path / "settings.db", flush_interval=0.01)
+    store.start()
+    store.get_setting("threshold")[1] = 0.5
+    store.stop()
+
+    restarted = SettingsStore(tmp_path / "settings.db")
+    assert restarted.chats == {}
+    assert restarted.get_setting("threshold")[1] == 0.5
+    assert list(restarted.chats) == [1]
+
+
+def test_failed_flush_keeps_changes(tmp_path):
+    store = SettingsStore(tmp_path / "settings.db")
+    store.set(1, "threshold", 0.5)
+    broken = sqlite3.connect(":memory:")
+    with pytest.raises(sqlite3.OperationalError):
+        store.flush(broken)
+    store.flush()
+    assert read_rows(tmp_path / "settings.db") == [(1, "threshold", 0.5)]
@@ -0,0 +1,72 @@
+import pytest
+import numpy as np
+from PIL import Image
+from unittest.mock import patch
+
+from forestbot.front.image_analyzer import size_analyzer
+from forestbot.front.image_analyzer.size_analyzer import fetch_image, is_size_correct, get_max_file_size
+
+
+def save_image(path, width, height, file_format="PNG"):
+    Image.fromarray((np.random.rand(height, width, 3) * 255).astype(np.uint8)).save(path, format=file_format)
+    return path
+
+
+@pytest.mark.parametrize(
+    ("width", "height", "file_format", "expected"),
+    (
+            (300, 400, "PNG", True),
+            (300, 400, "JPEG", True),
+            (100, 400, "PNG", False),
+            (300, 1200, "JPEG", False),
+    )
+)
+def test_fetch_image(tmp_path, width, height, file_format, expected):
+    path = save_image(tmp_path / "image", width, height, file_format)
+    success, content, size = fetch_image(path.as_uri(), max_size=1000, min_size=200)
+    assert success == expected
+    assert content == (path.read_bytes() if expected else None)
+    assert size == ((width, height) if expected else None)
+
+
+def test_fetch_image_stops_early(tmp_path):
+    path = save_image(tmp_path / "image.png", 1500, 1500)
+    read_sizes = []
+    original_urlopen = size_analyzer.request.urlopen
+
+    def urlopen(url):
+        file = original_urlopen(url)
+        original_read = file.read
+        file.read = lambda size: read_sizes.append(size) or original_read(size)
+        return file
+
+    with patch("forestbot.front.image_analyzer.size_analyzer.request.urlopen", side_effect=urlopen):
+        success, _, _ = fetch_image(path.as_uri(), max_size=1000, min_size=200)
+
+    assert not success
+    assert sum(read_sizes) < path.stat().st_size
+
+
+def test_fetch_image_too_big_file(tmp_path):
+    path = save_image(tmp_path / "image.png", 300, 300)
+    assert fetch_image(path.as_uri(), max_size=1000, min_size=200, max_size_bytes=100) == (False, None, None)
+
+
+@pytest.mark.parametrize("n_bytes", (7000, 2 * 1024 * 1024))
+def test_fetch_image_not_an_image(tmp_path, n_bytes):
+    path = tmp_path / "image.png"
+    path.write_bytes(np.random.default_rng(0).integers(0, 256, n_bytes, dtype=np.uint8).tobytes())
+    assert fetch_image(path.as_uri(), max_size=1000, min_size=200) == (False, None, None)
+
+
+def test_max_file_size_fits_largest_format(tmp_path):
+    path = save_image(tmp_path / "image.bmp", 1000, 1000, "BMP")
+    assert path.stat().st_size <= get_max_file_size(1000)
+    assert fetch_image(path.as_uri(), max_size=1000, min_size=200)[0]
+
+
+@pytest.mark.parametrize(
+    ("size", "expected"), (((200, 200), True), ((1000, 1000), True), ((199, 500), False), ((500, 1001), False))
+)
+def test_is_size_correct(size, expected):
+    assert is_size_correct(size, max_size=1000, min_size=200) == expected
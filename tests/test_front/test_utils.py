@@ -122,3 +122,28 @@ def test_convert_deg_to_km(deg):
 )
 def test_convert_km_to_deg(km):
     assert convert_km_to_deg(km) == pytest.approx(km / 111.1348)
+
+
+def test_send_document_from_memory():
+    mock_bot = MockBot()
+    mock_bot.init_send_document(2)
+    send_document_with_retry(bot=mock_bot, chat_id=MockBot.chat_id, document=b"<osm />", delay=0.01,
+                             max_attempts=10, visible_file_name="roads.osm")
+    assert mock_bot.send_document.call_count == 3
+    _, kwargs = mock_bot.send_document.call_args
+    assert kwargs['document'] == b"<osm />"
+    assert kwargs['visible_file_name'] == "roads.osm"
+
+
+def test_send_text_message_retry_is_scheduled():
+    mock_bot = MockBot()
+    mock_bot.init_send_message(1)
+    scheduled = []
+    send_text_message_with_retry(bot=mock_bot, chat_id=MockBot.chat_id, text="text",
+                                 schedule=lambda delay, retry: scheduled.append((delay, retry)))
+    assert mock_bot.send_message.call_count == 1
+    assert len(scheduled) == 1
+
+    delay, retry = scheduled[0]
+    retry()
+    assert mock_bot.send_message.call_count == 2
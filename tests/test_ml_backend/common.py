@@ -0,0 +1,36 @@
+from unittest.mock import Mock
+import numpy as np
+
+
+class MockSession:
+    """Stand-in for onnxruntime.InferenceSession. Output is the mean of input channels"""
+    input_name = "input"
+
+    def __init__(self, batch_dim="batch"):
+        model_input = Mock()
+        model_input.name = MockSession.input_name
+        model_input.shape = [batch_dim, 3, 224, 224]
+        self.get_inputs = Mock(return_value=[model_input])
+        self.run = Mock(side_effect=MockSession.forward)
+
+    @staticmethod
+    def forward(output_names, feed):
+        return [feed[MockSession.input_name].mean(axis=1, keepdims=True)]
+
+
+def save_tiny_onnx_model(path):
+    """Saves 3 -> 1 channel 1x1 convolution with dynamic batch axis, shaped like the real model"""
+    import onnx
+    from onnx import helper, TensorProto, numpy_helper
+
+    weight = numpy_helper.from_array(np.full((1, 3, 1, 1), 1 / 3, dtype=np.float32), name="weight")
+    graph = helper.make_graph(
+        nodes=[helper.make_node("Conv", ["input", "weight"], ["output"])],
+        name="tiny",
+        inputs=[helper.make_tensor_value_info("input", TensorProto.FLOAT, ["batch", 3, 224, 224])],
+        outputs=[helper.make_tensor_value_info("output", TensorProto.FLOAT, ["batch", 1, 224, 224])],
+        initializer=[weight]
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+    model.ir_version = 8
+    onnx.save(model, str(path))
@@ -0,0 +1,81 @@
+import pytest
+import numpy as np
+from threading import Thread, Barrier
+from unittest.mock import patch
+
+from forestbot.ml_backend.model import Model
+from forestbot.ml_backend.batch_scheduler import BatchScheduler
+from tests.test_ml_backend.common import MockSession
+
+
+@pytest.fixture
+def session():
+    return MockSession()
+
+
+@pytest.fixture
+def scheduler(session):
+    with patch("forestbot.ml_backend.model.onnxruntime.InferenceSession", return_value=session):
+        model = Model(input_size=224)
+    scheduler = BatchScheduler(model, max_batch_size=16, max_delay=0.05)
+    scheduler.start()
+    yield scheduler
+    scheduler.stop()
+
+
+def test_scheduler_routes_outputs_to_requests(scheduler, session):
+    images = [np.random.rand(*shape).astype(np.float32) for shape in ((300, 300, 3), (224, 224, 3), (500, 400, 3))]
+    results = [None] * len(images)
+
+    def predict(i):
+        results[i] = scheduler.predict_proba_sliding(images[i], window_size=224, overlap=0.25)
+
+    threads = [Thread(target=predict, args=(i,)) for i in range(len(images))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+
+    for image, result in zip(images, results):
+        assert result.shape == image.shape[:2]
+        assert np.allclose(result, Model.sigmoid(image.mean(axis=2)), atol=1e-5)
+
+    batch_sizes = [len(call.args[1][MockSession.input_name]) for call in session.run.call_args_list]
+    assert max(batch_sizes) <= 16
+    # 4 + 1 + 9 windows of three requests are run in fewer calls than requests
+    assert sum(batch_sizes) == 14
+    assert len(batch_sizes) < 14
+
+
+def test_scheduler_reports_model_errors(scheduler, session):
+    session.run.side_effect = RuntimeError("model failed")
+    with pytest.raises(RuntimeError):
+        scheduler.predict_proba_sliding(np.random.rand(224, 224, 3).astype(np.float32), window_size=224)
+
+
+def test_scheduler_runs_batches_concurrently(session):
+    with patch("forestbot.ml_backend.model.onnxruntime.InferenceSession", return_value=session):
+        model = Model(input_size=224)
+    scheduler = BatchScheduler(model, max_batch_size=1, max_delay=0, n_runners=2)
+    # Every batch waits for the other one, so images are predicted only if both batches are run at once
+    barrier = Barrier(2, timeout=5)
+    run = session.run.side_effect
+
+    def run_together(*args):
+        barrier.wait()
+        return run(*args)
+
+    session.run.side_effect = run_together
+    scheduler.start()
+    image = np.random.rand(300, 224, 3).astype(np.float32)
+    result = scheduler.predict_proba_sliding(image, window_size=224, overlap=0.25)
+    scheduler.stop()
+
+    assert session.run.call_count == 2
+    assert np.allclose(result, Model.sigmoid(image.mean(axis=2)), atol=1e-5)
+
+
+def test_scheduler_rejects_images_after_stop(scheduler):
+    scheduler.stop()
+    with pytest.raises(RuntimeError):
+        scheduler.predict_proba_sliding(np.random.rand(224, 224, 3).astype(np.float32), window_size=224)
@@ -0,0 +1,106 @@
+import time
+import pytest
+import numpy as np
+from pathlib import Path
+from threading import Barrier
+from unittest.mock import Mock, patch
+
+from forestbot.ml_backend.controller import Controller, Artifact
+from forestbot.ml_backend.prediction_cache import PredictionCache
+
+
+@pytest.fixture
+def controller():
+    with patch("forestbot.ml_backend.controller.Model"):
+        controller = Controller(callback=Mock(), model_input_size=224, crop_size=224, n_workers=2)
+    controller._Controller__analyse_image = Mock()
+    controller.start()
+    yield controller
+    controller.stop()
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_controller_processes_queue(controller):
+    artifacts = [Artifact(chat_id=i, img_name=f"img_{i}.png", threshold=0.5) for i in range(5)]
+    for artifact in artifacts:
+        controller.request_queue.put(artifact)
+
+    assert wait_for(lambda: controller._Controller__analyse_image.call_count == len(artifacts))
+    processed = [call.args[0] for call in controller._Controller__analyse_image.call_args_list]
+    assert sorted(processed, key=lambda x: x.chat_id) == artifacts
+    assert len(controller.wait_times) == len(artifacts)
+    # Blocking dispatch starts the job right away instead of waiting for the next poll
+    assert controller.average_wait_time() < Controller.wait_timeout
+
+
+def test_controller_survives_failed_image(controller):
+    controller._Controller__analyse_image.side_effect = [Exception(), None]
+    controller.request_queue.put(Artifact(chat_id=1, img_name="bad.png", threshold=0.5))
+    controller.request_queue.put(Artifact(chat_id=1, img_name="good.png", threshold=0.5))
+    assert wait_for(lambda: controller._Controller__analyse_image.call_count == 2)
+
+
+def test_controller_stop():
+    with patch("forestbot.ml_backend.controller.Model"):
+        controller = Controller(callback=Mock(), model_input_size=224, crop_size=224, n_workers=3)
+    controller.start()
+    controller.stop()
+    for worker in controller.workers:
+        worker.join(timeout=2 * Controller.wait_timeout)
+        assert not worker.is_alive()
+
+    # Stop signals of the stopped controller are not left for the next one
+    with patch("forestbot.ml_backend.controller.Model"):
+        next_controller = Controller(callback=Mock(), model_input_size=224, crop_size=224)
+    assert next_controller.request_queue.empty()
+
+
+def test_controller_reuses_cached_prediction():
+    with patch("forestbot.ml_backend.controller.Model"):
+        controller = Controller(callback=Mock(), model_input_size=224, crop_size=224,
+                                prediction_cache=PredictionCache(max_memory_bytes=10 ** 6))
+    controller.model.predict_proba_sliding.return_value = np.random.rand(30, 40).astype(np.float32)
+    image = (np.random.rand(30, 40, 3) * 255).astype(np.uint8)
+
+    for threshold in (0.2, 0.5):
+        controller._Controller__analyse_image(
+            Artifact(chat_id=1, img_name="img.png", threshold=threshold, image=image.copy()))
+
+    # Threshold change reruns only postprocessing
+    assert controller.model.predict_proba_sliding.call_count == 1
+    assert controller.callback.call_count == 2
+    first_mask, second_mask = (call.args[2] for call in controller.callback.call_args_list)
+    assert first_mask.sum() > second_mask.sum()
+
+
+def test_controller_processes_large_image_from_disk(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    image_path = tmp_path / "big.png"
+    image_path.write_bytes(b"")
+    with patch("forestbot.ml_backend.controller.Model"):
+        controller = Controller(callback=Mock(), model_input_size=224, crop_size=224)
+
+    with patch("forestbot.ml_backend.controller.process_large_image") as process_large_image:
+        controller._Controller__analyse_image(Artifact(chat_id=1, img_name="big.png", threshold=0.2, image=image_path))
+
+    assert process_large_image.call_args.args[1] == image_path
+    controller.callback.assert_called_once_with(Path("result_photos/big.tif"), 1, None, image_name="big.png")
+    # Input file is not needed anymore
+    assert not image_path.exists()
+
+
+def test_controller_workers_run_concurrently(controller):
+    # Every worker waits for the others, so the images are processed only if all workers run at once
+    barrier = Barrier(controller.n_workers, timeout=5)
+    controller._Controller__analyse_image.side_effect = lambda artifact: barrier.wait()
+    for i in range(controller.n_workers):
+        controller.request_queue.put(Artifact(chat_id=i, img_name=f"img_{i}.png", threshold=0.5))
+
+    assert wait_for(lambda: controller._Controller__analyse_image.call_count == controller.n_workers)
+    assert wait_for(lambda: barrier.n_waiting == 0 and not barrier.broken)
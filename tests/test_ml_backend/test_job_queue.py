@@ -0,0 +1,224 @@
+import queue
+import time
+import pytest
+import numpy as np
+from pathlib import Path
+from unittest.mock import patch, Mock
+
+from forestbot.ml_backend.controller import Controller, Artifact
+from forestbot.ml_backend.job_queue import JobQueue
+
+
+@pytest.mark.parametrize("image", (None, b"content", Path("input_photos/big.png"),
+                                   np.arange(24, dtype=np.uint8).reshape(2, 4, 3)))
+def test_put_get(tmp_path, image):
+    jobs = JobQueue(tmp_path / "jobs.db")
+    jobs.put(Artifact(chat_id=1, img_name="img.png", threshold=0.3, image=image))
+
+    artifact = jobs.get(timeout=0)
+    assert (artifact.chat_id, artifact.img_name, artifact.threshold) == (1, "img.png", 0.3)
+    if isinstance(image, np.ndarray):
+        assert np.array_equal(artifact.image, image)
+    else:
+        assert artifact.image == image
+    with pytest.raises(queue.Empty):
+        jobs.get(timeout=0)
+    assert jobs.complete(artifact) and len(jobs) == 0
+
+
+def test_image_of_job_which_is_not_persistent_stays_in_memory(tmp_path):
+    jobs = JobQueue(tmp_path / "jobs.db", retry_backoff=0)
+    image = np.zeros((5, 5, 3), dtype=np.uint8)
+    jobs.put(Artifact(chat_id=1, img_name="img.png", threshold=0.3, image=image, persistent=False))
+    assert jobs.connection.execute("SELECT image FROM jobs").fetchone() == (None,)
+
+    assert jobs.fail(jobs.get(timeout=0))
+    artifact = jobs.get(timeout=1)
+    assert artifact.image is image and not artifact.persistent
+    assert jobs.complete(artifact)
+    assert jobs.images == dict()
+
+
+def test_jobs_are_replayed_after_restart(tmp_path):
+    jobs = JobQueue(tmp_path / "jobs.db")
+    for i in range(3):
+        jobs.put(Artifact(chat_id=i, img_name=f"{i}.png", threshold=0.3, persistent=i != 2))
+    jobs.complete(jobs.get(timeout=0))
+    jobs.get(timeout=0)  # process dies while the job is running
+
+    restarted = JobQueue(tmp_path / "jobs.db")
+    assert restarted.get(timeout=0).img_name == "1.png"
+    with pytest.raises(queue.Empty):
+        restarted.get(timeout=0)
+
+
+def test_expired_lease(tmp_path):
+    jobs = JobQueue(tmp_path / "jobs.db", visibility_timeout=10)
+    jobs.put(Artifact(chat_id=1, img_name="img.png", threshold=0.3))
+    first = jobs.get(timeout=0)
+    with patch("forestbot.ml_backend.job_queue.time.time", return_value=first.enqueue_time + 10 ** 10):
+        second = jobs.get(timeout=0)
+
+    # Result of the job is delivered once
+    assert not jobs.complete(first)
+    assert jobs.complete(second)
+    assert not jobs.complete(second)
+
+
+def test_failed_job_is_retried_with_backoff(tmp_path):
+    jobs = JobQueue(tmp_path / "jobs.db", max_attempts=2, retry_backoff=100)
+    jobs.put(Artifact(chat_id=1, img_name="img.png", threshold=0.3))
+    assert jobs.fail(jobs.get(timeout=0))
+    with pytest.raises(queue.Empty):
+        jobs.get(timeout=0)
+
+    now = jobs.connection.execute("SELECT available_at FROM jobs").fetchone()[0]
+    with patch("forestbot.ml_backend.job_queue.time.time", return_value=now):
+        artifact = jobs.get(timeout=0)
+    assert not jobs.fail(artifact)
+    assert len(jobs) == 0
+
+
+def test_controller_with_job_queue(tmp_path):
+    jobs = JobQueue(tmp_path / "jobs.db", retry_backoff=0)
+    with patch("forestbot.ml_backend.controller.Model"):
+        controller = Controller(callback=Mock(), model_input_size=224, crop_size=224, job_queue=jobs)
+    controller.model.predict_proba_sliding.side_effect = [Exception(), np.zeros((5, 5), dtype=np.float32)]
+    image = np.zeros((5, 5, 3), dtype=np.uint8)
+    jobs.put(Artifact(chat_id=1, img_name="img.png", threshold=0.3, image=image))
+
+    controller.start()
+    try:
+        for _ in range(100):
+            if controller.callback.called:
+                break
+            controller.stop_event.wait(0.05)
+    finally:
+        controller.stop()
+    controller.callback.assert_called_once()
+    assert len(jobs) == 0
+    for worker in controller.workers:
+        worker.join(timeout=2 * Controller.wait_timeout)
+        assert not worker.is_alive()
+
+
+
+def test_controller_reports_dropped_job(tmp_path):
+    jobs = JobQueue(tmp_path / "jobs.db", max_attempts=2, retry_backoff=0)
+    with patch("forestbot.ml_backend.controller.Model"):
+        controller = Controller(callback=Mock(), failure_callback=Mock(), model_input_size=224, crop_size=224,
+                                job_queue=jobs)
+    controller.model.predict_proba_sliding.side_effect = Exception()
+    jobs.put(Artifact(chat_id=1, img_name="img.png", threshold=0.3, image=np.zeros((5, 5, 3), dtype=np.uint8)))
+
+    controller.start()
+    try:
+        for _ in range(100):
+            if controller.failure_callback.called:
+                break
+            controller.stop_event.wait(0.05)
+    finally:
+        controller.stop()
+    controller.failure_callback.assert_called_once_with(1, "img.png")
+    assert controller.model.predict_proba_sliding.call_count == 2
+    controller.callback.assert_not_called()
+    assert len(jobs) == 0
+
+def take_all(jobs):
+    taken = []
+    while True:
+        try:
+            artifact = jobs.get(timeout=0)
+        except queue.Empty:
+            return taken
+        jobs.complete(artifact)
+        taken.append(artifact.img_name)
+
+
+def test_chats_are_served_fairly(tmp_path):
+    jobs = JobQueue(tmp_path / "jobs.db")
+    positions = [jobs.put(Artifact(chat_id=1, img_name=f"a{i}", threshold=0.3, n_pixels=100)) for i in range(5)]
+    positions += [jobs.put(Artifact(chat_id=2, img_name=f"b{i}", threshold=0.3, n_pixels=100)) for i in range(2)]
+    # Queue positions are real: second job of the other chat goes after two jobs of the first one
+    assert positions == [0, 1, 2, 3, 4, 1, 3]
+    assert take_all(jobs) == ["a0", "b0", "a1", "b1", "a2", "a3", "a4"]
+
+
+def test_small_images_overtake_large_ones(tmp_path):
+    jobs = JobQueue(tmp_path / "jobs.db")
+    jobs.put(Artifact(chat_id=1, img_name="large", threshold=0.3, n_pixels=10 ** 8))
+    jobs.put(Artifact(chat_id=2, img_name="small", threshold=0.3, image=np.zeros((100, 100, 3), dtype=np.uint8)))
+    assert take_all(jobs) == ["small", "large"]
+
+
+def test_limits_per_chat(tmp_path):
+    jobs = JobQueue(tmp_path / "jobs.db", max_running_per_chat=1, max_queued_per_chat=2)
+    for name in ("a0", "a1"):
+        jobs.put(Artifact(chat_id=1, img_name=name, threshold=0.3))
+    with pytest.raises(queue.Full):
+        jobs.put(Artifact(chat_id=1, img_name="a2", threshold=0.3))
+    jobs.put(Artifact(chat_id=2, img_name="b0", threshold=0.3))
+    assert jobs.get_n_queued(1) == 2
+
+    first = jobs.get(timeout=0)
+    # Second job of the chat waits for the first one, the other chat is served meanwhile
+    assert jobs.get(timeout=0).img_name == "b0"
+    with pytest.raises(queue.Empty):
+        jobs.get(timeout=0)
+    jobs.complete(first)
+    assert jobs.get(timeout=0).img_name == "a1"
+
+
+def test_controller_estimates_wait_time(tmp_path):
+    jobs = JobQueue(tmp_path / "jobs.db")
+    with patch("forestbot.ml_backend.controller.Model"):
+        controller = Controller(callback=Mock(), model_input_size=224, crop_size=224, n_workers=2, job_queue=jobs)
+    assert controller.estimate_wait_time() == 0
+    controller.service_times.extend([1e-6, 3e-6])
+    for i in range(3):
+        jobs.put(Artifact(chat_id=i, img_name=f"{i}.png", threshold=0.3, n_pixels=10 ** 6))
+    assert controller.estimate_wait_time() == pytest.approx(3.0)
+
+
+def test_controller_renews_leases(tmp_path):
+    jobs = JobQueue(tmp_path / "jobs.db", visibility_timeout=0.3, retry_backoff=0.05)
+    with patch("forestbot.ml_backend.controller.Model"):
+        controller = Controller(callback=Mock(), model_input_size=224, crop_size=224, n_workers=2, job_queue=jobs)
+    # Job takes several visibility timeouts, it is not given to the second worker
+    controller.model.predict_proba_sliding.side_effect = \
+        lambda *args, **kwargs: time.sleep(1) or np.zeros((5, 5), dtype=np.float32)
+    jobs.put(Artifact(chat_id=1, img_name="img.png", threshold=0.3, image=np.zeros((5, 5, 3), dtype=np.uint8)))
+
+    controller.start()
+    try:
+        for _ in range(100):
+            if controller.callback.called:
+                break
+            controller.stop_event.wait(0.05)
+    finally:
+        controller.stop()
+    controller.callback.assert_called_once()
+    assert controller.model.predict_proba_sliding.call_count == 1
+
+
+def test_large_image_of_lost_lease(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "result_photos").mkdir()
+    input_path = tmp_path / "big.png"
+    input_path.write_bytes(b"input")
+    jobs = JobQueue(tmp_path / "jobs.db", visibility_timeout=0)
+    with patch("forestbot.ml_backend.controller.Model"):
+        controller = Controller(callback=Mock(), model_input_size=224, crop_size=224, job_queue=jobs)
+    jobs.put(Artifact(chat_id=1, img_name="big.png", threshold=0.3, image=input_path))
+    lost, current = jobs.get(timeout=0), jobs.get(timeout=0)  # first lease expires at once
+
+    with patch("forestbot.ml_backend.controller.process_large_image",
+               side_effect=lambda predictor, src, dst, *args, **kwargs: dst.write_bytes(b"result")):
+        controller._Controller__analyse_image(current)
+        controller._Controller__analyse_image(lost)
+
+    controller.callback.assert_called_once()
+    result_path = controller.callback.call_args.args[0]
+    assert current.lease in result_path.name and result_path.read_bytes() == b"result"
+    assert list(Path("result_photos").iterdir()) == [result_path]
+    assert not input_path.exists()
@@ -0,0 +1,45 @@
+import numpy as np
+import rasterio
+import cv2
+from PIL import Image
+
+from forestbot.ml_backend.large_image import process_large_image, get_band_height, block_size
+from forestbot.ml_backend.utils import postprocess
+
+
+class PixelPredictor:
+    """Prediction depends only on the pixel, so it does not change when the image is split into bands"""
+
+    def __init__(self):
+        self.shapes = []
+
+    def predict_proba_sliding(self, image, window_size, overlap, blend):
+        self.shapes.append(image.shape)
+        return image.mean(axis=2).astype(np.float32) / 255
+
+
+def test_get_band_height():
+    assert get_band_height(1000, 112, 10 ** 9) % block_size == 0
+    assert get_band_height(10 ** 6, 112, 10 ** 6) == block_size
+
+
+def test_process_large_image(tmp_path):
+    image = np.zeros((1500, 700, 3), dtype=np.uint8)
+    image[:, ::50] = 255
+    image[300:900, 100:400, 0] = 200
+    src_path, dst_path = tmp_path / "input.png", tmp_path / "result.tif"
+    Image.fromarray(image).save(src_path)
+    predictor = PixelPredictor()
+
+    process_large_image(predictor, src_path, dst_path, threshold=0.3, window_size=64, overlap=0.25,
+                        blend="gaussian", memory_budget_bytes=700 * 300 * 12)
+
+    assert len(predictor.shapes) > 1
+    assert max(shape[0] for shape in predictor.shapes) <= 256 + 64
+    with rasterio.open(dst_path) as result:
+        assert (result.width, result.height, result.count) == (700, 1500, 3)
+        banded = result.read().transpose(1, 2, 0)
+    expected, _ = postprocess(image.copy(), PixelPredictor().predict_proba_sliding(image, 64, 0.25, "gaussian"),
+                              0.3)
+    # Result is compressed with JPEG
+    assert np.abs(banded.astype(int) - cv2.cvtColor(expected, cv2.COLOR_BGR2RGB)).mean() < 3
@@ -0,0 +1,107 @@
+import pytest
+import numpy as np
+from unittest.mock import patch
+
+from forestbot.ml_backend.model import Model
+from forestbot.ml_backend.utils import split_to_crops, preprocess
+from tests.test_ml_backend.common import MockSession, save_tiny_onnx_model
+
+
+def create_model(session, input_size=224, batch_size=None):
+    with patch("forestbot.ml_backend.model.onnxruntime.InferenceSession", return_value=session):
+        return Model(input_size=input_size, batch_size=batch_size)
+
+
+@pytest.mark.parametrize(
+    ("n_rows", "n_cols", "crop_size"), ((1, 1, 4), (2, 3, 4), (3, 2, 5))
+)
+def test_split_to_crops(n_rows, n_cols, crop_size):
+    image = np.random.rand(n_rows * crop_size, n_cols * crop_size, 3).astype(np.float32)
+    crops = split_to_crops(image, crop_size)
+    assert crops.shape == (n_rows * n_cols, 3, crop_size, crop_size)
+    last_crop = image[-crop_size:, -crop_size:].transpose(2, 0, 1)
+    assert np.array_equal(crops[-1], last_crop)
+    assert np.array_equal(crops[0], image[:crop_size, :crop_size].transpose(2, 0, 1))
+
+
+def test_static_batch_model_falls_back():
+    session = MockSession(batch_dim=1)
+    with pytest.warns(UserWarning):
+        model = create_model(session, batch_size=8)
+    assert model.batch_size == 1
+
+
+@pytest.mark.parametrize(
+    ("height", "width", "overlap", "blend"),
+    ((500, 700, 0.25, "gaussian"), (500, 700, 0.5, "linear"), (150, 300, 0.0, "gaussian"))
+)
+def test_predict_proba_sliding(height, width, overlap, blend):
+    model = create_model(MockSession(), batch_size=4)
+    image = np.random.rand(height, width, 3).astype(np.float32)
+    prediction = model.predict_proba_sliding(image, window_size=224, overlap=overlap, blend=blend)
+    assert prediction.shape == (height, width)
+    assert np.allclose(prediction, Model.sigmoid(image.mean(axis=2)), atol=1e-5)
+
+
+def test_create_session_caches_optimized_model(tmp_path):
+    model_path = tmp_path / "model.onnx"
+    save_tiny_onnx_model(model_path)
+    optimized_path = Model.get_optimized_model_path(model_path)
+
+    Model.create_session(model_path, n_threads=1)
+    assert optimized_path.is_file()
+
+    session = Model.create_session(model_path, n_threads=1)
+    model_input = np.random.rand(2, 3, 224, 224).astype(np.float32)
+    output = session.run(None, {"input": model_input})[0]
+    assert output.shape == (2, 1, 224, 224)
+    assert np.allclose(output[:, 0], model_input.mean(axis=1), atol=1e-5)
+
+
+@pytest.mark.parametrize(("level", "cached_level"), (("all", "extended"), ("extended", "extended"), ("basic", "basic")))
+def test_optimized_model_is_cached_without_layout_optimizations(tmp_path, level, cached_level):
+    model_path = tmp_path / "model.onnx"
+    save_tiny_onnx_model(model_path)
+    optimized_path = model_path.with_name(f"model.{cached_level}.optimized.onnx")
+    with patch.object(Model, "graph_optimization_level", level):
+        Model.create_session(model_path, n_threads=1)
+        assert Model.get_optimized_model_path(model_path) == optimized_path
+        assert optimized_path.is_file()
+
+        with patch("forestbot.ml_backend.model.onnxruntime.InferenceSession") as session:
+            Model.create_session(model_path, n_threads=1)
+    session.assert_called_once()
+    assert session.call_args.args[0] == str(optimized_path)
+    # Cached graph is optimized already, only layout optimizations of "all" are left
+    expected_level = "all" if level == "all" else "disable"
+    assert session.call_args.kwargs["sess_options"].graph_optimization_level == Model.optimization_levels[expected_level]
+
+
+def test_create_session_options(tmp_path):
+    model_path = tmp_path / "model.onnx"
+    with patch("forestbot.ml_backend.model.onnxruntime.InferenceSession") as session, \
+            patch.object(Model, "execution_mode", "parallel"), \
+            patch.object(Model, "inter_op_num_threads", 2), \
+            patch.object(Model, "enable_cpu_mem_arena", False):
+        Model.create_session(model_path, n_threads=3)
+
+    # Graph is optimized without layout changes for the cache, then layout is optimized for this CPU
+    saving_options = session.call_args_list[0].kwargs["sess_options"]
+    assert saving_options.graph_optimization_level == Model.optimization_levels["extended"]
+    assert saving_options.optimized_model_filepath == str(Model.get_optimized_model_path(model_path))
+    assert session.call_args.args[0] == str(Model.get_optimized_model_path(model_path))
+    options = session.call_args.kwargs["sess_options"]
+    assert options.graph_optimization_level == Model.optimization_levels["all"]
+    assert options.intra_op_num_threads == 3
+    assert options.inter_op_num_threads == 2
+    assert options.execution_mode == Model.execution_modes["parallel"]
+    assert not options.enable_cpu_mem_arena
+    assert not options.optimized_model_filepath
+    assert session.call_args.kwargs["providers"] == Model.providers
+
+
+def test_predict_proba_sliding_raw_image():
+    model = create_model(MockSession(), batch_size=4)
+    image = (np.random.rand(300, 400, 3) * 255).astype(np.uint8)
+    raw_prediction = model.predict_proba_sliding(image, window_size=224)
+    assert np.allclose(raw_prediction, model.predict_proba_sliding(preprocess(image), window_size=224), atol=1e-6)
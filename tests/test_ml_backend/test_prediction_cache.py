@@ -0,0 +1,69 @@
+import numpy as np
+
+from forestbot.ml_backend.prediction_cache import PredictionCache
+
+
+def make_prediction(seed, shape=(10, 10)):
+    return np.random.default_rng(seed).integers(0, 256, shape, dtype=np.uint8)
+
+
+def test_key_depends_on_content_and_signature():
+    image = make_prediction(0, (5, 5, 3))
+    key = PredictionCache.get_key(image, "fp32")
+
+    assert PredictionCache.get_key(image.copy(), "fp32") == key
+    assert PredictionCache.get_key(image, "int8_static") != key
+    assert PredictionCache.get_key(make_prediction(1, (5, 5, 3)), "fp32") != key
+    assert PredictionCache.get_key(image.reshape(5, 3, 5), "fp32") != key
+
+
+def test_memory_hit_and_miss():
+    cache = PredictionCache(max_memory_bytes=1000)
+    prediction = make_prediction(0)
+
+    assert cache.get("a") is None
+    cache.put("a", prediction)
+    assert np.array_equal(cache.get("a"), prediction)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_memory_lru_eviction_without_disk():
+    cache = PredictionCache(max_memory_bytes=250)  # two predictions of 100 bytes
+    for key in "abc":
+        cache.put(key, make_prediction(0))
+        if key == "b":
+            cache.get("a")  # "b" becomes least recently used
+
+    assert list(cache.memory) == ["a", "c"]
+    assert cache.memory_bytes == 200
+    assert cache.get("b") is None
+
+
+def test_spill_to_disk_and_reload(tmp_path):
+    cache = PredictionCache(max_memory_bytes=150, cache_dir=tmp_path, max_disk_bytes=10 ** 6)
+    first, second = make_prediction(0), make_prediction(1)
+    cache.put("a", first)
+    cache.put("b", second)
+
+    assert list(cache.memory) == ["b"]
+    assert (tmp_path / "a.png").is_file()
+
+    # Predictions on disk survive restart
+    cache = PredictionCache(max_memory_bytes=150, cache_dir=tmp_path, max_disk_bytes=10 ** 6)
+    assert np.array_equal(cache.get("a"), first)
+    assert "a" in cache.memory and "a" not in cache.disk
+    assert not (tmp_path / "a.png").exists()
+
+
+def test_disk_budget(tmp_path):
+    cache = PredictionCache(max_memory_bytes=0, cache_dir=tmp_path, max_disk_bytes=10 ** 6)
+    cache.put("a", make_prediction(0))
+    max_disk_bytes = cache.disk_bytes * 2
+
+    cache = PredictionCache(max_memory_bytes=0, cache_dir=tmp_path, max_disk_bytes=max_disk_bytes)
+    for key in "bc":
+        cache.put(key, make_prediction(0))
+
+    assert cache.disk_bytes <= max_disk_bytes
+    assert list(cache.disk) == ["b", "c"]
+    assert sorted(path.stem for path in tmp_path.iterdir()) == ["b", "c"]
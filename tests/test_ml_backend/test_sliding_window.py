@@ -0,0 +1,56 @@
+import pytest
+import numpy as np
+
+from forestbot.ml_backend.sliding_window import SlidingWindow
+from forestbot.ml_backend.utils import window_positions, blend_weights
+
+
+@pytest.mark.parametrize(
+    ("length", "window_size", "stride", "expected"),
+    (
+            (100, 224, 168, [0]),
+            (224, 224, 168, [0]),
+            (500, 224, 224, [0, 224, 276]),
+            (500, 224, 168, [0, 168, 276]),
+            (448, 224, 224, [0, 224]),
+    )
+)
+def test_window_positions(length, window_size, stride, expected):
+    assert window_positions(length, window_size, stride) == expected
+
+
+@pytest.mark.parametrize("mode", ("gaussian", "linear"))
+def test_blend_weights(mode):
+    weights = blend_weights(16, mode)
+    assert weights.shape == (16, 16)
+    assert weights.min() > 0
+    assert weights[8, 8] == weights.max()
+    assert np.allclose(weights, weights.T)
+
+
+def test_blend_weights_unknown_mode():
+    with pytest.raises(ValueError):
+        blend_weights(16, "cubic")
+
+
+@pytest.mark.parametrize(
+    ("shape", "window_size", "overlap"),
+    (((100, 150, 3), 64, 0.0), ((100, 150, 3), 64, 0.5), ((40, 30, 3), 64, 0.25), ((64, 64, 3), 64, 0.25))
+)
+def test_sliding_window_covers_image(shape, window_size, overlap):
+    image = np.random.rand(*shape).astype(np.float32)
+    window = SlidingWindow(shape, window_size=window_size, overlap=overlap)
+    padded = window.pad(image)
+    batch = np.empty((len(window), 3, window_size, window_size), dtype=np.float32)
+    window.fill_batch(padded, range(len(window)), batch)
+    for index in range(len(window)):
+        window.add(index, batch[index, 0])
+
+    result = window.result()
+    assert result.shape == shape[:2]
+    assert np.allclose(result, image[:, :, 0], atol=1e-5)
+
+
+def test_sliding_window_wrong_overlap():
+    with pytest.raises(ValueError):
+        SlidingWindow((100, 100, 3), window_size=64, overlap=1)
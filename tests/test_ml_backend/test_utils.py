@@ -0,0 +1,75 @@
+import pytest
+import numpy as np
+import cv2
+
+from forestbot.ml_backend.utils import postprocess, preprocess, load_image, decode_image, encode_image, \
+    quantize_prediction
+from forestbot.ml_backend.model import Model
+
+
+def reference_postprocess(original_img, prediction, threshold):
+    """Straightforward version of postprocess, kept to check the fused one"""
+    prediction = cv2.resize(prediction, original_img.shape[0:2][::-1], interpolation=cv2.INTER_NEAREST)
+    prediction = ((prediction >= threshold) * 255).astype("uint8")
+    roads = cv2.cvtColor(prediction, cv2.COLOR_GRAY2BGR)
+    roads[np.where((roads == [255, 255, 255]).all(axis=2))] = [235, 56, 226]
+    return cv2.add(roads, cv2.cvtColor(original_img, cv2.COLOR_RGB2BGR)), prediction
+
+
+@pytest.mark.parametrize(
+    ("image_shape", "prediction_shape", "threshold"),
+    (((120, 80, 3), (120, 80), 0.5), ((120, 80, 3), (224, 224), 0.2), ((50, 50, 3), (50, 50), 0.9))
+)
+def test_postprocess(image_shape, prediction_shape, threshold):
+    image = (np.random.rand(*image_shape) * 255).astype(np.uint8)
+    prediction = np.random.rand(*prediction_shape).astype(np.float32)
+    expected_result, expected_mask = reference_postprocess(image, prediction, threshold)
+
+    result, mask = postprocess(image.copy(), prediction, threshold)
+    assert np.array_equal(mask, expected_mask)
+    assert np.array_equal(result, expected_result)
+
+
+def test_preprocess_into_buffer():
+    image = (np.random.rand(10, 20, 3) * 255).astype(np.uint8)
+    out = np.empty((3, 10, 20), dtype=np.float32)
+    preprocess(image.transpose(2, 0, 1), out=out)
+    assert np.allclose(out, preprocess(image).transpose(2, 0, 1))
+
+
+def test_load_image(tmp_path):
+    image = (np.random.rand(10, 20, 3) * 255).astype(np.uint8)
+    cv2.imwrite(str(tmp_path / "image.png"), cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+    loaded = load_image(tmp_path / "image.png")
+    assert loaded.flags.writeable
+    assert np.array_equal(loaded, image)
+
+
+def test_sigmoid_inplace():
+    x = np.random.randn(30, 40).astype(np.float32)
+    expected = Model.sigmoid(x)
+    assert np.allclose(Model.sigmoid_inplace(x), expected)
+    assert np.allclose(x, expected)
+
+
+def test_encode_decode_image():
+    image = (np.random.rand(10, 20, 3) * 255).astype(np.uint8)
+    decoded = decode_image(encode_image(cv2.cvtColor(image, cv2.COLOR_RGB2BGR), ".png"))
+    assert decoded.flags.writeable
+    assert np.array_equal(decoded, image)
+
+
+def test_decode_broken_image():
+    with pytest.raises(ValueError):
+        decode_image(b"not an image")
+
+
+@pytest.mark.parametrize("threshold", (0.0, 0.2, 0.5, 1.0))
+def test_postprocess_quantized_prediction(threshold):
+    image = (np.random.rand(30, 40, 3) * 255).astype(np.uint8)
+    prediction = quantize_prediction(np.random.rand(30, 40).astype(np.float32))
+
+    expected_result, expected_mask = reference_postprocess(image, prediction.astype(np.float32) / 255, threshold)
+    result, mask = postprocess(image.copy(), prediction, threshold)
+    assert np.array_equal(mask, expected_mask)
+    assert np.array_equal(result, expected_result)
@@ -0,0 +1,46 @@
+import pytest
+import numpy as np
+import onnxruntime
+from PIL import Image
+
+from forestbot.processes.quantization import load_tiles, quantize_dynamic_int8, quantize_static_int8, iou
+from tests.test_ml_backend.common import save_tiny_onnx_model
+
+
+@pytest.fixture
+def images_dir(tmp_path):
+    images_dir = tmp_path / "images"
+    images_dir.mkdir()
+    for i, shape in enumerate(((500, 460, 3), (224, 224, 3), (100, 100, 3))):
+        Image.fromarray((np.random.rand(*shape) * 255).astype(np.uint8)).save(images_dir / f"{i}.png")
+    (images_dir / "notes.txt").write_text("not an image")
+    return images_dir
+
+
+def test_load_tiles(images_dir):
+    assert load_tiles(images_dir).shape == (5, 3, 224, 224)
+    assert load_tiles(images_dir, max_tiles=3).shape == (3, 3, 224, 224)
+
+
+@pytest.mark.parametrize(
+    ("first", "second", "expected"),
+    (([0, 0], [0, 0], 1.0), ([1, 1], [1, 0], 0.5), ([1, 0], [0, 1], 0.0), ([1, 1], [1, 1], 1.0))
+)
+def test_iou(first, second, expected):
+    assert iou(np.array(first, dtype=bool), np.array(second, dtype=bool)) == pytest.approx(expected)
+
+
+@pytest.mark.parametrize("static", (False, True))
+def test_quantized_model_is_close_to_fp32(tmp_path, images_dir, static):
+    model_path, quantized_path = tmp_path / "model.onnx", tmp_path / "model.int8.onnx"
+    save_tiny_onnx_model(model_path)
+    tiles = load_tiles(images_dir)
+    if static:
+        quantize_static_int8(model_path, quantized_path, tiles)
+    else:
+        quantize_dynamic_int8(model_path, quantized_path)
+
+    reference = onnxruntime.InferenceSession(str(model_path)).run(None, {"input": tiles})[0]
+    quantized = onnxruntime.InferenceSession(str(quantized_path)).run(None, {"input": tiles})[0]
+    assert np.abs(reference - quantized).max() < 0.05
+    assert list(tmp_path.glob("*.prepared.onnx")) == []
@@ -0,0 +1,134 @@
+import asyncio
+import pytest
+import time
+from threading import Thread
+from aiohttp import web
+
+from forestbot.satellite.downloader import Downloader
+
+content = bytes(range(256)) * 4096  # 1 MB
+
+
+class LocalServer:
+    """HTTP stand-in for Earth Engine running on its own loop"""
+
+    def __init__(self):
+        self.n_requests = 0
+        self.n_failures = 0  # number of next requests answered with 503
+        self.running = 0
+        self.max_running = 0
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self.loop.run_forever, daemon=True)
+
+    async def handle_file(self, request):
+        self.n_requests += 1
+        if self.n_failures > 0:
+            self.n_failures -= 1
+            return web.Response(status=503)
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(0.05)
+            response = web.StreamResponse()
+            await response.prepare(request)
+            for i in range(0, len(content), 64 * 1024):
+                await response.write(content[i:i + 64 * 1024])
+            return response
+        finally:
+            self.running -= 1
+
+    async def handle_missing(self, request):
+        self.n_requests += 1
+        return web.Response(status=404)
+
+    async def __start(self):
+        app = web.Application()
+        app.router.add_get("/file.zip", self.handle_file)
+        app.router.add_get("/missing.zip", self.handle_missing)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        return self.runner.addresses[0][1]
+
+    def start(self):
+        self.thread.start()
+        self.url = f"http://127.0.0.1:{asyncio.run_coroutine_threadsafe(self.__start(), self.loop).result()}"
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+@pytest.fixture
+def server():
+    server = LocalServer()
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def downloader():
+    downloader = Downloader(max_connections=2, max_retries=2, backoff=0.01, chunk_size=1000)
+    yield downloader
+    downloader.stop()
+
+
+def test_download(server, downloader, tmp_path):
+    path = downloader.download(f"{server.url}/file.zip", tmp_path / "file.zip")
+    assert path.read_bytes() == content
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_retry(server, downloader, tmp_path):
+    server.n_failures = 2
+    path = downloader.download(f"{server.url}/file.zip", tmp_path / "file.zip")
+    assert path.read_bytes() == content
+    assert server.n_requests == 3
+
+
+def test_retries_are_limited(server, downloader, tmp_path):
+    server.n_failures = 3
+    with pytest.raises(Exception):
+        downloader.download(f"{server.url}/file.zip", tmp_path / "file.zip")
+    assert server.n_requests == 3
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_no_retry_on_client_error(server, downloader, tmp_path):
+    with pytest.raises(Exception):
+        downloader.download(f"{server.url}/missing.zip", tmp_path / "missing.zip")
+    assert server.n_requests == 1
+
+
+def test_concurrency_limit(server, downloader, tmp_path):
+    threads = [Thread(target=downloader.download, args=(f"{server.url}/file.zip", tmp_path / f"{i}.zip"))
+               for i in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert server.max_running == 2
+    assert all((tmp_path / f"{i}.zip").read_bytes() == content for i in range(6))
+
+
+def test_retry_backoff_frees_connection(server, tmp_path):
+    downloader = Downloader(max_connections=1, max_retries=1, backoff=1.0)
+    server.n_failures = 1
+    retried = Thread(target=downloader.download, args=(f"{server.url}/file.zip", tmp_path / "retried.zip"))
+    retried.start()
+    try:
+        while server.n_requests == 0:
+            time.sleep(0.01)
+        # Only connection is free while the first download waits to retry
+        start = time.monotonic()
+        path = downloader.download(f"{server.url}/file.zip", tmp_path / "other.zip")
+        assert time.monotonic() - start < 0.5
+        assert path.read_bytes() == content
+        retried.join()
+        assert (tmp_path / "retried.zip").read_bytes() == content
+    finally:
+        downloader.stop()
@@ -0,0 +1,98 @@
+import io
+import gzip
+import math
+import xml.etree.ElementTree as ET
+import numpy as np
+import cv2
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+from forestbot.satellite.osm_convert import generate_osm, write_osm
+from forestbot.satellite.satellite_data import epsg3857_to_epsg4326, get_pixel_to_coordinates, get_pixel_size_m
+
+transform = from_origin(4174000.0, 7502000.0, 10.0, 10.0)
+
+
+def reference_epsg3857_to_epsg4326(x, y):
+    """Scalar version the vectorized one replaced"""
+    x = (x * 180) / 20037508.34
+    y = (y * 180) / 20037508.34
+    y = (math.atan(math.pow(math.e, y * (math.pi / 180))) * 360) / math.pi - 90
+    return y, x
+
+
+def reference_epsg4326_to_epsg3857_y(latitude):
+    return math.log(math.tan(math.pi / 4 + math.radians(latitude) / 2)) * 20037508.34 / math.pi
+
+
+def make_mask():
+    mask = np.zeros((200, 300), dtype=np.uint8)
+    cv2.line(mask, (10, 20), (280, 150), 255, 7)
+    cv2.line(mask, (150, 10), (150, 190), 255, 5)
+    cv2.circle(mask, (60, 140), 40, 255, 6)
+    return mask
+
+
+def test_vectorized_transform_matches_scalar():
+    x, y = np.array([0, 17, 299]), np.array([0, 45, 199])
+    lats, lons = get_pixel_to_coordinates(transform)(x, y)
+    for i in range(len(x)):
+        expected = reference_epsg3857_to_epsg4326(*rasterio.transform.xy(transform, y[i], x[i]))
+        assert (lats[i], lons[i]) == pytest.approx(expected, abs=1e-12)
+
+    assert epsg3857_to_epsg4326(1000.0, 2000.0) == pytest.approx(reference_epsg3857_to_epsg4326(1000.0, 2000.0))
+
+
+@pytest.mark.parametrize("latitude", (0.0, 30.0, 60.0))
+def test_pixel_size_shrinks_with_latitude(latitude):
+    y = reference_epsg4326_to_epsg3857_y(latitude)
+    pixel_to_coordinates = get_pixel_to_coordinates(from_origin(0.0, y, 10.0, 10.0))
+    assert get_pixel_size_m(pixel_to_coordinates, 0, 0) == pytest.approx(10.0 * math.cos(math.radians(latitude)),
+                                                                         rel=1e-3)
+
+
+def test_generate_osm_converts_points_at_once():
+    calls = []
+    pixel_to_coordinates = get_pixel_to_coordinates(transform)
+
+    def coord_transform(x, y):
+        calls.append(len(x))
+        return pixel_to_coordinates(x, y)
+
+    osm = ET.fromstring(generate_osm(make_mask(), coord_transform))
+    nodes = {node.get("id"): (float(node.get("lat")), float(node.get("lon"))) for node in osm.iter("node")}
+    assert len(calls) == 1 and calls[0] == len(nodes)
+    assert len(set(nodes.values())) == len(nodes)
+
+    ways = list(osm.iter("way"))
+    assert 4 <= len(ways) <= 10
+    for way in ways:
+        assert all(nd.get("ref") in nodes for nd in way.iter("nd"))
+    # Simplified ways instead of a node per pixel on both sides of the road
+    assert len(nodes) < 50
+
+
+def test_generate_osm_empty_mask():
+    osm = ET.fromstring(generate_osm(np.zeros((50, 50), dtype=np.uint8), get_pixel_to_coordinates(transform)))
+    assert osm.tag == "osm" and len(osm) == 0
+
+
+def test_generate_compressed_osm():
+    document = generate_osm(make_mask(), get_pixel_to_coordinates(transform))
+    compressed = generate_osm(make_mask(), get_pixel_to_coordinates(transform), compress=True)
+    assert gzip.decompress(compressed) == document
+    assert len(compressed) < len(document)
+
+
+def test_write_osm_in_batches(monkeypatch):
+    monkeypatch.setattr("forestbot.satellite.osm_convert.batch_size", 3)
+    ways = [np.array([(x, 0) for x in range(i, i + 5)], dtype=np.float32) for i in range(0, 20, 4)]
+    stream = io.BytesIO()
+    write_osm(stream, ways, get_pixel_to_coordinates(transform))
+
+    osm = ET.fromstring(stream.getvalue())
+    assert osm.get("version") == "0.6"
+    assert len(osm.findall("node")) == 21  # ends of neighbouring ways are shared
+    assert len(osm.findall("way")) == 5
+    assert all(len(way.findall("nd")) == 5 for way in osm.findall("way"))
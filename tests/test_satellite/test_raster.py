@@ -0,0 +1,63 @@
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from rasterio.transform import from_origin
+from rasterio.warp import calculate_default_transform, reproject, Resampling
+
+from forestbot.satellite.raster import read_bands, mosaic, reproject_raster
+
+crs = CRS.from_epsg(4326)
+pixel_size = 0.0001
+
+
+def make_raster(left, top, n_bands=3, height=20, width=30, seed=0):
+    data = np.random.default_rng(seed).integers(1, 5000, (n_bands, height, width), dtype=np.uint16)
+    return data, from_origin(left, top, pixel_size, pixel_size), crs
+
+
+def test_read_bands(tmp_path):
+    data, transform, _ = make_raster(10, 50)
+    paths = []
+    for i, band_data in enumerate(data):
+        paths.append(tmp_path / f"{i}.tif")
+        with rasterio.open(paths[-1], 'w', driver='GTiff', height=20, width=30, count=1, dtype=data.dtype,
+                           crs=crs, transform=transform) as dst:
+            dst.write(band_data, 1)
+
+    result, result_transform, result_crs = read_bands(paths[::-1])
+    assert np.array_equal(result, data[::-1])
+    assert result_transform == transform and result_crs == crs
+
+
+def test_mosaic_all_bands_at_once():
+    left = make_raster(10, 50, seed=0)
+    right = make_raster(10 + 30 * pixel_size, 50, seed=1)
+    data, transform, result_crs = mosaic([left, right])
+    assert data.shape == (3, 20, 60)
+    assert np.array_equal(data[:, :, :30], left[0]) and np.array_equal(data[:, :, 30:], right[0])
+    assert transform.c == left[1].c and result_crs == crs
+
+    data = mosaic([left, right], bounds=[10 + 25 * pixel_size, 50 - 10 * pixel_size, 10 + 35 * pixel_size, 50])[0]
+    assert np.array_equal(data, np.concatenate([left[0][:, :10, 25:], right[0][:, :10, :5]], axis=2))
+
+
+def test_reproject_matches_file_pipeline(tmp_path):
+    data, transform, _ = make_raster(37.5, 55.7, height=40, width=60)
+    result, result_transform, result_crs = reproject_raster((data, transform, crs), 'EPSG:3857')
+
+    # Reference is the previous pipeline writing the raster and its reprojection to disk
+    with rasterio.open(tmp_path / "combined.tif", 'w', driver='GTiff', height=40, width=60, count=3,
+                       dtype=data.dtype, crs=crs, transform=transform, nodata=0) as dst:
+        dst.write(data)
+    with rasterio.open(tmp_path / "combined.tif") as src:
+        new_transform, width, height = calculate_default_transform(src.crs, 'EPSG:3857', src.width, src.height,
+                                                                   *src.bounds)
+        expected = np.zeros((3, height, width), dtype=data.dtype)
+        for i in range(3):
+            reproject(source=rasterio.band(src, i + 1), destination=expected[i], src_transform=src.transform,
+                      src_crs=src.crs, dst_transform=new_transform, dst_crs='EPSG:3857',
+                      resampling=Resampling.nearest)
+
+    assert result_transform == new_transform
+    assert result_crs.to_epsg() == 3857
+    assert np.array_equal(result, expected)
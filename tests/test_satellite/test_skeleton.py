@@ -0,0 +1,61 @@
+import numpy as np
+import cv2
+import pytest
+
+from forestbot.satellite.skeleton import thin, extract_lines, simplify_line, get_neighbour_codes
+
+
+def count_neighbours(skeleton):
+    return np.unpackbits(get_neighbour_codes(skeleton)[..., None], axis=-1).sum(axis=-1) * skeleton
+
+
+@pytest.mark.parametrize("thickness", (1, 4, 9))
+def test_thin_line(thickness):
+    mask = np.zeros((60, 100), dtype=np.uint8)
+    cv2.line(mask, (10, 10), (90, 45), 255, thickness)
+    skeleton = thin(mask)
+
+    n_neighbours = count_neighbours(skeleton)[skeleton == 1]
+    assert (n_neighbours == 1).sum() == 2
+    assert (n_neighbours == 2).sum() == skeleton.sum() - 2
+    assert cv2.connectedComponents(skeleton, connectivity=8)[0] == 2
+    assert skeleton.sum() >= 70
+
+
+def test_lines_of_cross_share_junction():
+    mask = np.zeros((100, 100), dtype=np.uint8)
+    cv2.line(mask, (10, 50), (90, 50), 255, 5)
+    cv2.line(mask, (50, 10), (50, 90), 255, 5)
+    lines = extract_lines(thin(mask), min_branch_length=5)
+
+    assert len(lines) == 4
+    junctions = {tuple(line[0]) for line in lines} | {tuple(line[-1]) for line in lines}
+    # 4 ends of the cross and one shared junction
+    assert len(junctions) == 5
+    center = max(junctions, key=lambda point: sum(tuple(line[0]) == point or tuple(line[-1]) == point
+                                                  for line in lines))
+    assert center == pytest.approx((50, 50), abs=2)
+
+
+def test_loop_without_junctions():
+    mask = np.zeros((100, 100), dtype=np.uint8)
+    cv2.circle(mask, (50, 50), 30, 255, 5)
+    lines = extract_lines(thin(mask))
+    assert len(lines) == 1
+    assert tuple(lines[0][0]) == tuple(lines[0][-1])
+    assert len(lines[0]) > 150
+
+
+def test_short_branches_are_dropped():
+    mask = np.zeros((100, 100), dtype=np.uint8)
+    cv2.line(mask, (10, 50), (90, 50), 255, 3)
+    cv2.line(mask, (50, 50), (50, 45), 255, 1)
+    assert len(extract_lines(thin(mask))) == 3
+    assert len(extract_lines(thin(mask), min_branch_length=10)) == 2
+
+
+def test_simplify_line():
+    line = np.array([(x, 10 + (x % 2) * 0.4) for x in range(50)], dtype=np.float32)
+    simplified = simplify_line(line, tolerance=1)
+    assert np.array_equal(simplified, line[[0, -1]])
+    assert len(simplify_line(line, tolerance=0.1)) == len(line)
@@ -0,0 +1,177 @@
+import os
+import time
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.crs import CRS
+from unittest.mock import patch
+
+from forestbot.satellite import satellite_data
+from forestbot.satellite.satellite_data import download_rect
+from forestbot.satellite.tile_cache import TileCache
+
+pixel_size = 0.001
+source = "product_2020-01-01_2020-02-01"
+
+
+def make_raster(bbox, n_bands=1, value=None):
+    """Raster of the bbox where every pixel is value or its column index if value is None"""
+    left, bottom, right, top = bbox
+    width, height = round((right - left) / pixel_size), round((top - bottom) / pixel_size)
+    data = np.tile(np.arange(width, dtype=np.uint16) + 1, (n_bands, height, 1)) if value is None \
+        else np.full((n_bands, height, width), value, dtype=np.uint16)
+    return data, from_origin(left, top, pixel_size, pixel_size), CRS.from_epsg(4326)
+
+
+def fill_cache(cache, bbox, bands, value=1000):
+    for cell in cache.get_missing_cells(source, bbox, bands):
+        cache.put(source, cell, bands, make_raster(cache.get_cell_bbox(cell), len(bands), value))
+
+
+def test_get_cells():
+    cache = object.__new__(TileCache)
+    cache.cell_size_deg = 0.05
+    assert cache.get_cells([0.01, -0.01, 0.11, 0.04]) == [(0, -1), (1, -1), (2, -1), (0, 0), (1, 0), (2, 0)]
+    assert cache.get_cell_bbox((1, -1)) == pytest.approx([0.05, -0.05, 0.1, 0.0])
+
+
+def test_put_and_read(tmp_path):
+    cache = TileCache(tmp_path / "cache", cell_size_deg=0.05)
+    bbox = [0.02, 0.03, 0.08, 0.07]
+    assert len(cache.get_missing_cells(source, bbox, ["B4", "B3"])) == 4
+    assert (cache.hits, cache.misses) == (0, 4)
+
+    fill_cache(cache, bbox, ["B4", "B3"])
+    assert cache.get_missing_cells(source, bbox, ["B4", "B3"]) == []
+    assert cache.hits == 4
+    assert cache.get_missing_cells(source, bbox, ["B4", "B3", "B2"]) != []
+
+    data, transform, crs = cache.read(source, bbox, ["B4", "B3"])
+    assert data.shape == (2, 40, 60)
+    assert (data == 1000).all()
+    assert transform.c == pytest.approx(0.02) and transform.f == pytest.approx(0.07)
+    assert crs.to_epsg() == 4326
+
+    with rasterio.open(cache.get_path(source, (0, 0), "B4")) as raster:
+        assert raster.profile["tiled"]
+        assert raster.compression is not None
+
+
+def test_read_keeps_cell_alignment(tmp_path):
+    cache = TileCache(tmp_path / "cache", cell_size_deg=0.05)
+    for cell in [(0, 0), (1, 0)]:
+        cache.put(source, cell, ["B2"], make_raster(cache.get_cell_bbox(cell)))
+    data = cache.read(source, [0.04, 0.01, 0.06, 0.02], ["B2"])[0][0]
+    assert data.shape == (10, 20)
+    assert np.array_equal(data[0], np.r_[41:51, 1:11])
+
+
+def test_eviction_by_size(tmp_path):
+    cache = TileCache(tmp_path / "cache", cell_size_deg=0.05)
+    fill_cache(cache, [0.01, 0.01, 0.02, 0.02], ["B2"])
+    file_size = cache.total_bytes
+
+    cache = TileCache(tmp_path / "cache", cell_size_deg=0.05, max_bytes=file_size * 2)
+    assert len(cache.files) == 1
+    fill_cache(cache, [0.06, 0.01, 0.14, 0.02], ["B2"])
+    assert cache.total_bytes <= file_size * 2
+    assert not cache.get_path(source, (0, 0), "B2").exists()
+    assert cache.get_missing_cells(source, [0.06, 0.01, 0.14, 0.02], ["B2"]) == []
+
+
+def test_pinned_files_are_not_evicted(tmp_path):
+    cache = TileCache(tmp_path / "cache", cell_size_deg=0.05)
+    pinned_bbox = [0.01, 0.01, 0.02, 0.02]
+    fill_cache(cache, pinned_bbox, ["B2"])
+    file_size = cache.total_bytes
+
+    cache = TileCache(tmp_path / "cache", cell_size_deg=0.05, max_bytes=file_size * 2)
+    with cache.pin(source, pinned_bbox, ["B2"]):
+        fill_cache(cache, [0.06, 0.01, 0.14, 0.02], ["B2"])
+        assert cache.get_path(source, (0, 0), "B2").exists()
+    assert not cache.pins
+
+    fill_cache(cache, [0.16, 0.01, 0.19, 0.02], ["B2"])
+    assert not cache.get_path(source, (0, 0), "B2").exists()
+
+
+def test_cell_is_downloaded_once(tmp_path):
+    cache = TileCache(tmp_path / "cache", cell_size_deg=0.05)
+    started, release = Event(), Event()
+    downloaded = []
+
+    def download():
+        started.set()
+        release.wait(timeout=5)
+        downloaded.append(1)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        first = cache.download(source, (0, 0), download, executor)
+        assert started.wait(timeout=5)
+        assert cache.download(source, (0, 0), download, executor) is first
+        release.set()
+        first.result(timeout=5)
+
+    assert downloaded == [1]
+    assert not cache.downloads
+
+
+def test_eviction_by_age(tmp_path):
+    cache = TileCache(tmp_path / "cache", cell_size_deg=0.05, max_age_seconds=60)
+    bbox = [0.01, 0.01, 0.02, 0.02]
+    fill_cache(cache, bbox, ["B2"])
+    assert cache.get_missing_cells(source, bbox, ["B2"]) == []
+
+    path = cache.get_path(source, (0, 0), "B2")
+    os.utime(path, (time.time() - 120, time.time() - 120))
+    assert cache.get_missing_cells(source, bbox, ["B2"]) == [(0, 0)]
+    assert not path.exists()
+    assert cache.total_bytes == 0
+
+
+def test_download_rect_reuses_cells(tmp_path):
+    cache = TileCache(tmp_path / "cache", cell_size_deg=0.05)
+    downloaded = []
+
+    def download_region(name, bbox, folder):
+        downloaded.append(name)
+        return make_raster(bbox, len(satellite_data.bands), 500)
+
+    with patch("forestbot.satellite.satellite_data.download_region", side_effect=download_region):
+        download_rect("first.png", center=(0.03, 0.03), radius=0.01, download_dir=tmp_path, cache=cache)
+        assert len(downloaded) == 1
+        image, to_coordinates = download_rect("second.png", center=(0.031, 0.029), radius=0.01, download_dir=tmp_path,
+                                       cache=cache)
+        assert len(downloaded) == 1
+
+    assert image.shape[2] == 3 and image.dtype == np.uint8
+    assert image.flags.c_contiguous and image.flags.writeable
+    assert not (tmp_path / "temp_second.png").exists()
+    latitude, longitude = to_coordinates(0, 0)
+    assert latitude == pytest.approx(0.039, abs=0.002) and longitude == pytest.approx(0.021, abs=0.002)
+
+
+def test_download_rect_bounds_parallel_downloads(tmp_path):
+    cache = TileCache(tmp_path / "cache", cell_size_deg=0.05)
+    lock = Lock()
+    running, max_running = [0], [0]
+
+    def download_region(name, bbox, folder):
+        with lock:
+            running[0] += 1
+            max_running[0] = max(max_running[0], running[0])
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+        return make_raster(bbox, len(satellite_data.bands), 500)
+
+    with patch("forestbot.satellite.satellite_data.download_region", side_effect=download_region), \
+            ThreadPoolExecutor(max_workers=2) as executor:
+        download_rect("wide.png", center=(0.05, 0.05), radius=0.06, download_dir=tmp_path, cache=cache,
+                      executor=executor)
+
+    assert cache.misses == 16
+    assert max_running[0] == 2